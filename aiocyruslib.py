@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kedros, a.s. www.kedros.sk
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA.
+#
+# Requires python >= 3.7
+#
+
+__all__ = [ 'AsyncCYRUS' ]
+__doc__ = """asyncio Cyrus admin client
+
+AsyncCYRUS offers the CYRUS admin commands as coroutines on top of
+asyncio streams. Every command gets its own tag, so many commands may
+be in flight on one connection; responses are parsed as in cyruslib.
+
+"""
+
+import asyncio
+import imaplib
+import imapparse
+import imaputf7
+import random
+import re
+import ssl
+from sys import stdout
+
+from cyruslib import CYRUS, CYRUSError, DEFAULT_SEP, DQUOTE, Separators, ok, tostr, \
+    quote, quotalist, annotationlist, listsep, re_url
+
+CRLF = b'\r\n'
+
+re_tagged = re.compile(br'(?P<tag>[A-Z]+\d+) (?P<type>[A-Z]+)( (?P<data>.*))?')
+
+def imapquote(text):
+    return quote(text.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+class AsyncCYRUS:
+    """
+    asyncio variant of CYRUS
+
+        imap = AsyncCYRUS("imaps://127.0.0.1:993")
+        await imap.connect()
+        await imap.login("admin", "password")
+        mailboxes = await imap.lm("user/%")
+        await imap.logout()
+
+    Untagged responses are given to the oldest command still waiting
+    for its tagged response, as Cyrus answers commands in order.
+    """
+
+    ERROR = CYRUS.ERROR
+    ENCODING_LIST = CYRUS.ENCODING_LIST
+
+    def __init__(self, url = 'imap://localhost:143', ssl_context=None):
+        self.VERBOSE = False
+        self.AUTH = False
+        self.USERNAME = None
+        self.ADMINACL = "c"
+        self.SEP = DEFAULT_SEP
+        self.NORMALIZE = False
+        self.ENCODING = 'imap'
+        self.LOGFD = stdout
+        match = re_url.match(url)
+        if not match:
+            self.__doraise("INVALID_URL")
+        self.host = match.group(2)
+        if match.group(3):
+            self.port = int(match.group(3))
+        else:
+            self.port = 143
+        self.ssl = match.group(1) == 'imaps'
+        self.starttls = match.group(1) == 'imap+starttls'
+        if (self.ssl or self.starttls) and ssl_context is None:
+            ssl_context = ssl.create_default_context()
+        self.ssl_context = ssl_context
+        self.reader = self.writer = self.task = None
+        self.tagpre = imaplib.Int2AP(random.randint(4096, 65535))
+        self.tagnum = 0
+        self.pending = {} # tag: (future, untagged responses), oldest first
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        if self.AUTH:
+            await self.logout()
+        else:
+            self.close()
+
+    def __verbose(self, msg):
+        if self.VERBOSE:
+            print(msg, file=self.LOGFD)
+
+    def __doexception(self, function, msg=None, *args):
+        if msg is None:
+            try:
+                msg = self.ERROR.get(function.upper())[1]
+            except:
+                msg = self.ERROR.get("IMAPLIB")[1]
+        value = ""
+        for arg in args:
+            if arg is not None:
+                value = "%s %s" % (value, arg)
+
+        self.__verbose( '[%s%s] %s: %s' % (function.upper(), value, "BAD", msg) )
+        self.__doraise( function.upper(), msg )
+
+    def __doraise(self, mode, msg=None):
+        idError = self.ERROR.get(mode)
+        if idError:
+            if msg is None:
+                msg = idError[1]
+        else:
+            idError = [self.ERROR.get("IMAPLIB")[0]]
+        raise CYRUSError( idError[0], mode, msg )
+
+    def __doresponse(self, function, res, msg, *args):
+        """Raise the CYRUSError of a NO or BAD tagged response"""
+        msg = tostr(msg[0])
+        value = ""
+        for arg in args:
+            if arg is not None:
+                value = "%s %s" % (value, arg)
+        self.__verbose( '[%s%s] %s: %s' % (function.upper(), value, res, msg) )
+        idError = self.ERROR.get(function.upper(), self.ERROR["IMAPLIB"])
+        raise CYRUSError( idError[0], function.upper(), msg, res )
+
+    def __prepare(self, command, mailbox=True):
+        if not self.AUTH:
+            self.__doexception(command, self.ERROR.get("NOAUTH")[1])
+        elif not mailbox:
+            self.__doexception(command, self.ERROR.get("MBXNULL")[1])
+
+    async def connect(self):
+        """Open the connection and read the server greeting"""
+        try:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port, ssl=self.ssl_context if self.ssl else None,
+                limit=2**20)
+            greeting = await self.reader.readline()
+            if greeting.startswith(b'* OK') and self.starttls:
+                await self.__starttls()
+        except (OSError, ssl.SSLError, EOFError) as info:
+            self.close()
+            self.__doraise("CONNECT", str(info))
+        if not greeting.startswith(b'* OK'):
+            self.close()
+            self.__doraise("CONNECT", tostr(greeting.strip()))
+        self.task = asyncio.ensure_future(self.__readloop())
+
+    async def __starttls(self):
+        """STARTTLS, before the read loop runs"""
+        if not hasattr(self.writer, 'start_tls'):
+            self.__doraise("CONNECT", "STARTTLS requires python >= 3.11")
+        self.tagnum += 1
+        tag = ('%s%d' % (tostr(self.tagpre), self.tagnum)).encode()
+        self.writer.write(tag + b' STARTTLS' + CRLF)
+        while True:
+            match = re_tagged.match(await self.__readline())
+            if match and match.group('tag') == tag:
+                break
+        if match.group('type') != b'OK':
+            self.close()
+            self.__doraise("CONNECT", tostr(match.group('data')))
+        await self.writer.start_tls(self.ssl_context, server_hostname=self.host)
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.AUTH = False
+
+    async def __readline(self):
+        line = await self.reader.readline()
+        if not line:
+            raise EOFError('socket error: EOF')
+        return line[:-2]
+
+    async def __readloop(self):
+        try:
+            while True:
+                line = await self.__readline()
+                match = re_tagged.match(line)
+                if match and match.group('tag') in self.pending:
+                    future, untagged = self.pending.pop(match.group('tag'))
+                    if not future.done():
+                        future.set_result((tostr(match.group('type')), [match.group('data')], untagged))
+                    continue
+                match = imaplib.Untagged_response.match(line)
+                if match is None:
+                    match = imaplib.Untagged_status.match(line)
+                if match is None:
+                    continue # continuation, we never send literals
+                typ = tostr(match.group('type'))
+                dat = match.group('data') or b''
+                # Read literals direct from connection, as imaplib does
+                while imaplib.Literal.match(dat):
+                    size = int(imaplib.Literal.match(dat).group('size'))
+                    literal = await self.reader.readexactly(size)
+                    self.__untagged(typ, (dat, literal))
+                    dat = await self.__readline()
+                self.__untagged(typ, dat)
+        except asyncio.CancelledError:
+            raise
+        except Exception as info:
+            for future, untagged in self.pending.values():
+                if not future.done():
+                    future.set_exception(CYRUSError(self.ERROR["CONNECT"][0], "CONNECT", str(info)))
+            self.pending.clear()
+            self.task = None
+            self.close()
+
+    def __untagged(self, typ, dat):
+        for future, untagged in self.pending.values():
+            untagged.setdefault(typ, []).append(dat)
+            break
+
+    async def _command(self, name, *args):
+        """Send a tagged command, returns (typ, data, untagged)"""
+        if self.writer is None:
+            self.__doraise("CONNECT")
+        self.tagnum += 1
+        tag = ('%s%d' % (tostr(self.tagpre), self.tagnum)).encode()
+        data = [tag, name.encode()]
+        for arg in args:
+            if arg is None: continue
+            if isinstance(arg, str):
+                arg = arg.encode()
+            data.append(arg)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[tag] = (future, {})
+        self.writer.write(b' '.join(data) + CRLF)
+        await self.writer.drain()
+        return await future
+
+    async def __docommand(self, function, *args):
+        typ, dat, untagged = await self._command(function.upper(), *args)
+        if not ok(typ):
+            self.__doresponse(function, typ, dat, *args)
+        return typ, dat, untagged
+
+    def _normalize(self, mailbox):
+        return CYRUS._normalize(self, mailbox)
+
+    def _unnormalize(self, mailbox):
+        return CYRUS._unnormalize(self, mailbox)
+
+    def setNormalize(self, mode):
+        """Set mailbox normalize enabled"""
+        if type(True) == type(mode):
+            self.NORMALIZE = mode
+
+    def getEncoding(self):
+        """Get current input/ouput codification"""
+        return self.ENCODING
+
+    def setEncoding(self, enc = None):
+        """Set current input/ouput codification"""
+        if enc is None:
+            self.ENCODING = 'imap'
+        elif enc in self.ENCODING_LIST:
+            self.ENCODING = enc
+        else:
+            raise self.__doraise("ENCODING")
+
+    def encode(self, text):
+        text = self._normalize(text)
+        if self.ENCODING == 'imap':
+            return text
+        return imaputf7.decode(text)
+
+    def decode(self, text):
+        text = self._unnormalize(text)
+        if self.ENCODING == 'imap':
+            return text
+        return imaputf7.encode(text)
+
+    async def login(self, username, password):
+        if self.AUTH:
+            self.__doexception("LOGIN", self.ERROR.get("AUTH")[1])
+        server = "%s:%d" % (self.host, self.port)
+        sep = Separators.get(server)
+        if sep is None:
+            # the separator discovery goes along with LOGIN, see CYRUS.login()
+            (typ, dat, untagged), (ltyp, ldat, luntagged) = await asyncio.gather(
+                self._command('LOGIN', imapquote(username), imapquote(password)),
+                self._command('LIST', DQUOTE, DQUOTE))
+            if ok(typ) and ok(ltyp):
+                sep = listsep(luntagged.get('LIST', [None]))
+                if sep:
+                    Separators[server] = sep
+        else:
+            typ, dat, untagged = await self._command('LOGIN', imapquote(username), imapquote(password))
+        if not ok(typ):
+            self.__doresponse("LOGIN", typ, dat, username)
+        self.SEP = sep or DEFAULT_SEP
+        self.AUTH = True
+        self.USERNAME = username
+        self.__verbose( '[LOGIN %s] %s: %s' % (username, typ, tostr(dat[0])) )
+
+    async def logout(self):
+        try:
+            typ, dat, untagged = await self._command('LOGOUT')
+        except CYRUSError:
+            typ, dat = 'BYE', [None]
+        self.close()
+        self.__verbose( '[LOGOUT] %s: %s' % (typ, tostr(dat[0])) )
+
+    async def lm(self, pattern="*"):
+        """List mailboxes, see CYRUS.lm()"""
+        self.__prepare('LIST')
+        if pattern == '': pattern = "*"
+        if pattern == '%':
+            res, ml, untagged = await self.__docommand('list', DQUOTE, '%')
+        else:
+            res, ml, untagged = await self.__docommand('list', '*', self.decode(pattern))
+
+        mb = []
+        for mailbox in imapparse.responses(untagged.get('LIST', [])):
+            try:
+                flags, sep, mbe = imapparse.parse_list(mailbox)
+            except ValueError:
+                continue
+            if 'Noselect' in flags: continue
+            mb.append(self.encode(mbe))
+        if not mb:
+            self.__verbose( '[LIST] No results' )
+        return mb
+
+    async def cm(self, mailbox, partition=None):
+        """Create mailbox"""
+        self.__prepare('CREATE', mailbox)
+        res, msg, untagged = await self.__docommand('create', self.decode(mailbox), partition)
+        self.__verbose( '[CREATE %s partition=%s] %s: %s' % (mailbox, partition, res, tostr(msg[0])) )
+
+    async def __dm(self, mailbox, failures):
+        try:
+            await self.__docommand("setacl", self.decode(mailbox), self.USERNAME, self.ADMINACL)
+            res, msg, untagged = await self.__docommand("delete", self.decode(mailbox))
+        except CYRUSError as info:
+            failures[mailbox] = info
+            return False, '%s: %s' % (info.command, info.message)
+        self.__verbose( '[DELETE %s] %s: %s' % (mailbox, res, tostr(msg[0])) )
+        return True, None
+
+    async def dm(self, mailbox, recursive=True):
+        """Delete mailbox, see CYRUS.dm()"""
+        self.__prepare('DELETE', mailbox)
+        mbxList = []
+        mbxTmp = mailbox.split(self.SEP)
+        # Cyrus is not recursive for user subfolders and global folders
+        if (recursive and mbxTmp[0] != "user") or (len(mbxTmp) > 2):
+            mbxList = await self.lm("%s%s*" % (mailbox, self.SEP))
+        waves = {}
+        for mbox in mbxList + [mailbox]:
+            waves.setdefault(mbox.count(self.SEP), []).append(mbox)
+        result = {}
+        failures = {}
+        for depth in sorted(waves, reverse=True):
+            results = await asyncio.gather(*[self.__dm(mbox, failures) for mbox in waves[depth]])
+            result.update(zip(waves[depth], results))
+        ### the error of the command which failed, SETACL or DELETE
+        if mailbox in failures:
+            raise failures[mailbox]
+        return result
+
+    async def rename(self, fromMbx, toMbx, partition=None):
+        """Rename or change partition"""
+        self.__prepare('RENAME', fromMbx)
+        res, msg, untagged = await self.__docommand("rename", self.decode(fromMbx), self.decode(toMbx), partition)
+        self.__verbose( '[RENAME %s %s] %s: %s' % (fromMbx, toMbx, res, tostr(msg[0])) )
+
+    async def lam(self, mailbox):
+        """List ACLs"""
+        self.__prepare('GETACL', mailbox)
+        res, msg, untagged = await self.__docommand("getacl", self.decode(mailbox))
+        acls = {}
+        try:
+            rights = imapparse.parse_acl(list(imapparse.responses(untagged.get('ACL', []))).pop()).rights
+        except (IndexError, ValueError) as info:
+            self.__verbose( '[GETACL %s] BAD: %s' % (mailbox, info) )
+            raise self.__doraise("GETACL")
+        for userid in rights:
+            self.__verbose( '[GETACL %s] %s %s' % (mailbox, userid, rights[userid]) )
+            acls[self.encode(userid)] = rights[userid]
+        return acls
+
+    async def sam(self, mailbox, userid, rights):
+        """Set ACL"""
+        self.__prepare('SETACL', mailbox)
+        res, msg, untagged = await self.__docommand("setacl", self.decode(mailbox), userid, rights)
+        self.__verbose( '[SETACL %s %s %s] %s: %s' % (mailbox, userid, rights, res, tostr(msg[0])) )
+
+    async def lq(self, mailbox):
+        """List Quota"""
+        self.__prepare('GETQUOTA', mailbox)
+        res, msg, untagged = await self.__docommand("getquota", self.decode(mailbox))
+        try:
+            root, quota = imapparse.parse_quota(list(imapparse.responses(untagged.get('QUOTA', []))).pop())
+        except (IndexError, ValueError):
+            self.__verbose( '[GETQUOTA %s] BAD: Error while parsing results' % mailbox )
+            return 0, 0
+        if 'STORAGE' not in quota:
+            self.__verbose( '[GETQUOTA %s] QUOTA (Unlimited)' % mailbox )
+            return 0, 0
+        used, quota = quota['STORAGE']
+        self.__verbose( '[GETQUOTA %s] %s: QUOTA (%d/%d)' % (mailbox, res, used, quota) )
+        return used, quota
+
+    async def sq(self, mailbox, limit):
+        """Set Quota"""
+        self.__prepare('SETQUOTA', mailbox)
+        try:
+            limit = int(limit)
+        except ValueError as e:
+            self.__verbose( '[SETQUOTA %s] BAD: %s %s' % (mailbox, self.ERROR.get("SETQUOTA")[1], limit) )
+            raise self.__doraise("SETQUOTA")
+        res, msg, untagged = await self.__docommand("setquota", self.decode(mailbox), quotalist(limit))
+        self.__verbose( '[SETQUOTA %s %s] %s: %s' % (mailbox, limit, res, tostr(msg[0])) )
+
+    async def getannotation(self, mailbox, pattern='*'):
+        """Get Annotation"""
+        self.__prepare('GETANNOTATION')
+        res, msg, untagged = await self.__docommand('getannotation', self.decode(mailbox), quote(pattern), quote('value.shared'))
+        ann = {}
+        for annotation in imapparse.responses(untagged.get('ANNOTATION', [])):
+            try:
+                mbx, key, attributes = imapparse.parse_annotation(annotation)
+            except ValueError:
+                attributes = {}
+            if 'value.shared' not in attributes:
+                self.__verbose( '[GETANNOTATION] Invalid annotation entry' )
+                continue
+            mbx = self.encode(mbx)
+            value = attributes['value.shared']
+            self.__verbose( '[GETANNOTATION %s] %s: %s' % (mbx, key, value) )
+            if mbx not in ann:
+                ann[mbx] = {}
+            if key not in ann[mbx]:
+                ann[mbx][key] = value
+        return ann
+
+    async def setannotation(self, mailbox, annotation, value):
+        """Set Annotation"""
+        self.__prepare('SETANNOTATION')
+        res, msg, untagged = await self.__docommand("setannotation", self.decode(mailbox), quote(annotation), annotationlist(value))
+        self.__verbose( '[SETANNOTATION %s] %s: %s' % (mailbox, res, tostr(msg[0])) )
+
+    async def __reconstruct(self, mailbox):
+        res, msg, untagged = await self.__docommand("reconstruct", self.decode(mailbox))
+        self.__verbose( '[RECONSTRUCT %s] %s: %s' % (mailbox, res, tostr(msg[0])) )
+
+    async def reconstruct(self, mailbox, recursive=True):
+        """Reconstruct, children are reconstructed concurrently"""
+        self.__prepare('RECONSTRUCT', mailbox)
+        # Cyrus is not recursive for remote reconstruct
+        if recursive:
+            mbxList = await self.lm("%s%s*" % (mailbox, self.SEP))
+            await asyncio.gather(*[self.__reconstruct(mbox) for mbox in mbxList])
+        await self.__reconstruct(mailbox)
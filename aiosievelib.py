@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kedros, a.s. www.kedros.sk
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA.
+#
+# Requires python >= 3.7, STARTTLS requires python >= 3.11
+#
+
+__all__ = [ 'AsyncManageSieve' ]
+__doc__ = """asyncio Sieve management client
+
+AsyncManageSieve offers the MANAGESIEVE commands as coroutines on top
+of asyncio streams, so thousands of user sessions fit in one process.
+Responses are parsed with the grammar of sievelib. MANAGESIEVE has no
+tags: commands issued concurrently on one connection are written at
+once and their responses read back in order.
+
+"""
+
+import asyncio
+import ssl
+
+import sievelib
+from sievelib import MANAGESIEVE, SIEVE_PORT, Oknobye, re_literal, \
+    re_dquote, re_esc_quote, re_strings, sieve_name, sieve_string, \
+    sasl_plain
+
+CRLF = b'\r\n'
+
+
+class AsyncManageSieve:
+    """
+    asyncio variant of MANAGESIEVE
+
+        sieve = AsyncManageSieve("127.0.0.1", 4190, ssl.create_default_context())
+        await sieve.connect()
+        await sieve.login("PLAIN", "rei", "password", "admin")
+        typ, scripts = await sieve.listscripts()
+        await sieve.logout()
+
+    With an ssl_context, connect() negotiates STARTTLS before any
+    command. Commands return the same values as those of MANAGESIEVE.
+    response_code and response_text are those of the last response
+    read.
+    """
+
+    error = MANAGESIEVE.error
+    abort = MANAGESIEVE.abort
+
+    def __init__(self, host='', port=SIEVE_PORT, ssl_context=None):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.debug = sievelib.Debug
+        self.state = 'NONAUTH'
+        self.alive = False
+        self.tls = False
+
+        self.response_text = self.response_code = None
+
+        self.capabilities = []
+        self.loginmechs = []
+        self.implementation = ''
+        self.supports_tsl = 0
+        self.supports_unauthenticate = 0
+
+        self.reader = self.writer = None
+        self.last = None # future of the last command, done once its response is read
+        self.drainer = None # lock of write() and drain(), which takes one waiter before python 3.10
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        if self.alive:
+            try:
+                await self.logout()
+            except self.error:
+                self.close()
+
+    def _mesg(self, s, secs=None):
+        return MANAGESIEVE._mesg(self, s, secs)
+
+    def _log(self, s, secs=None):
+        pass
+
+    def _parse_capabilities(self, lines):
+        return MANAGESIEVE._parse_capabilities(self, lines)
+
+    def _format(self, name, arg1=None, arg2=None, *options):
+        return MANAGESIEVE._format(self, name, arg1, arg2, *options)
+
+    async def connect(self):
+        """Open the connection and read the server capabilities"""
+        try:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port, limit=2**20)
+        except OSError as val:
+            raise self.abort('socket error: %s' % val)
+        self.alive = True
+        if __debug__:
+            if self.debug >= 1:
+                self._mesg('managesieve version %s' % sievelib.__version__)
+        typ, data = await self._get_response()
+        if typ == 'OK':
+            self._parse_capabilities(data)
+        if self.ssl_context is not None:
+            typ = await self.starttls()
+            if typ != 'OK':
+                self.close()
+                raise self.abort('STARTTLS failed: %s' % self.response_text)
+
+    def close(self):
+        self.alive = False
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def _get_line(self):
+        try:
+            line = await self.reader.readuntil(CRLF)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, OSError) as val:
+            raise self.abort('socket error: %s' % (val or 'EOF'))
+        line = line[:-2].decode('utf-8')
+        if __debug__:
+            if self.debug >= 4:
+                self._mesg('< %s' % line)
+            else:
+                self._log('< %s' % line)
+        return line
+
+    async def _read(self, size):
+        """Read 'size' bytes from remote."""
+        try:
+            return await self.reader.readexactly(size)
+        except (asyncio.IncompleteReadError, OSError) as val:
+            raise self.abort('socket error: %s' % (val or 'EOF'))
+
+    async def _strings(self, line):
+        """Strings of a response line, see MANAGESIEVE._strings()"""
+        res = []
+        pos = 0
+        end = len(line)
+        while 1:
+            char = line[pos:pos + 1]
+            if char == '"':
+                mo = re_dquote.match(line, pos)
+                if mo is None:
+                    raise self.error('Unmatched quote: %r' % line)
+                value = mo.group(1)
+                if '\\' in value:
+                    value = re_esc_quote.sub(r'\1', value)
+                pos = mo.end()
+            elif char == ' ':
+                raise self.error('Unexpected space: %r' % line)
+            else:
+                mo = None
+                if char == '{':
+                    mo = re_literal.match(line, pos)
+                if mo is not None:
+                    value = (await self._read(int(mo.group('size')))).decode('utf-8')
+                    line = await self._get_line()
+                    pos = 0
+                    end = len(line)
+                else:
+                    start = pos
+                    pos = line.find(' ', start)
+                    if pos < 0:
+                        pos = end
+                    value = line[start:pos]
+            res.append(value)
+            if pos >= end or line[pos] != ' ':
+                return res
+            pos += 1
+
+    async def _get_response(self):
+        """(typ, data) of the next response, see MANAGESIEVE._get_response()"""
+        data = []
+        while 1:
+            resp = await self._get_line()
+            mo = None
+            if resp[:1] not in ('"', '{'):
+                mo = Oknobye.match(resp)
+            if mo is None:
+                mo = re_strings.match(resp)
+                if mo is None:
+                    data.append(await self._strings(resp))
+                elif mo.lastindex == 1:
+                    data.append([mo.group(1)])
+                else:
+                    data.append([mo.group(1), mo.group(mo.lastindex)])
+                continue
+            typ, code, dat = mo.group('type','code','data')
+            if __debug__:
+                if self.debug >= 1:
+                    self._mesg('%s response: %s %s' % (typ, code, dat))
+            self.response_code = code
+            self.response_text = None
+            if dat:
+                self.response_text = (await self._strings(dat))[0]
+            return typ, data
+
+    async def _command(self, name, arg1=None, arg2=None, *options):
+        """Send a command, returns (typ, data) once its response is read"""
+        if not self.alive:
+            raise self.abort('socket error: not connected')
+        data = self._format(name, arg1, arg2, *options)
+        # Responses come in the order of the commands: wait for the
+        # previous command to have read its own
+        previous = self.last
+        done = self.last = asyncio.get_running_loop().create_future()
+        try:
+            # one command at a time into the transport, each drained
+            # before the next: large or many commands do not pile up
+            # there. The lock is FIFO, commands keep their order.
+            if self.drainer is None:
+                self.drainer = asyncio.Lock()
+            async with self.drainer:
+                if self.writer is None:
+                    raise self.abort('socket error: connection closed')
+                self.writer.write(data)
+                try:
+                    await self.writer.drain()
+                except OSError as val:
+                    raise self.abort('socket error: %s' % val)
+            if previous is not None:
+                await asyncio.shield(previous)
+            if not self.alive:
+                raise self.abort('socket error: connection closed')
+            return await self._get_response()
+        except BaseException:
+            # a response left unread would be given to the next command
+            self.close()
+            raise
+        finally:
+            done.set_result(None)
+            if self.last is done:
+                self.last = None
+
+    async def _simple_command(self, *args):
+        return (await self._command(*args))[0]
+
+    ### Public methods ###
+    async def starttls(self, ssl_context=None):
+        """Negotiate TLS, the capabilities are read again."""
+        # command-starttls      = "STARTTLS" CRLF
+        # response-starttls     = response-oknobye
+        if ssl_context is None:
+            ssl_context = self.ssl_context or ssl.create_default_context()
+        if not hasattr(self.writer, 'start_tls'):
+            raise self.error('STARTTLS requires python >= 3.11')
+        typ = await self._simple_command('STARTTLS')
+        if typ != 'OK':
+            return typ
+        try:
+            await self.writer.start_tls(ssl_context, server_hostname=self.host or None)
+        except (OSError, ssl.SSLError) as val:
+            self.close()
+            raise self.abort('TLS error: %s' % val)
+        self.tls = True
+        # the server sends its capabilities again, they may have changed
+        self.capabilities = []
+        self.loginmechs = []
+        self.supports_tsl = 0
+        self.supports_unauthenticate = 0
+        typ, data = await self._get_response()
+        if typ == 'OK':
+            self._parse_capabilities(data)
+        return typ
+
+    async def login(self, mechanism, user, password, admin=""):
+        """Authenticate with PLAIN, as user or as admin for user."""
+        mech = mechanism.upper()
+        if not mech in self.loginmechs:
+            raise self.error("Server doesn't allow %s authentication." % mech)
+        if mech != 'PLAIN':
+            raise self.error("Authentication %s dont implemented." % mech)
+        encoded = sasl_plain(user, admin or user, password)
+        typ, data = await self._command('AUTHENTICATE',
+                                        sieve_name(mech)+" {"+str(len(encoded))+"+}",
+                                        None, encoded)
+        if typ == 'OK':
+            self.state = 'AUTH'
+            return True
+        else:
+            return False
+
+    async def unauthenticate(self):
+        """Return to the non-authenticated state (RFC 5804)."""
+        typ = await self._simple_command('UNAUTHENTICATE')
+        if typ == 'OK':
+            self.state = 'NONAUTH'
+        return typ
+
+    async def logout(self):
+        """Terminate connection to server."""
+        try:
+            typ = await self._simple_command('LOGOUT')
+        finally:
+            self.state = 'LOGOUT'
+            writer = self.writer
+            self.close()
+        if writer is not None:
+            try:
+                await writer.wait_closed()
+            except (OSError, ssl.SSLError):
+                pass
+        return typ
+
+    async def listscripts(self):
+        """(typ, [(scriptname, active), ...])"""
+        typ, data = await self._command('LISTSCRIPTS')
+        if typ != 'OK': return typ, data
+        return typ, [(dat[0], len(dat) == 2) for dat in data]
+
+    async def getscript(self, scriptname):
+        """(typ, scriptdata)"""
+        typ, data = await self._command('GETSCRIPT', sieve_name(scriptname))
+        if typ != 'OK': return typ, data
+        if len(data) != 1:
+            raise self.error('GETSCRIPT returned more than one string/script')
+        return typ, data[0][0]
+
+    async def putscript(self, scriptname, scriptdata):
+        """Put a script onto the server, str or UTF-8 bytes."""
+        return await self._simple_command('PUTSCRIPT',
+                                          sieve_name(scriptname),
+                                          sieve_string(scriptdata))
+
+    async def deletescript(self, scriptname):
+        return await self._simple_command('DELETESCRIPT', sieve_name(scriptname))
+
+    async def setactive(self, scriptname=''):
+        """Mark a script as the 'active' one, '' deactivates."""
+        return await self._simple_command('SETACTIVE', sieve_name(scriptname))
+
+    async def havespace(self, scriptname, size):
+        return await self._simple_command('HAVESPACE',
+                                          sieve_name(scriptname),
+                                          str(size))
+
+    async def capability(self):
+        """(typ, data), the capability attributes are reset on success"""
+        typ, data = await self._command('CAPABILITY')
+        if typ == 'OK':
+            self._parse_capabilities(data)
+        return typ, data
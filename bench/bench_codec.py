@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+#
+# Mailbox name codec benchmark
+#
+#   python3 bench/bench_codec.py [names]
+#
+# Decodes and encodes a synthetic listing of user mailboxes (default
+# one million names, a third with accented folders) with imaputf7 and
+# with the re.sub/utf-7 chain cyruslib used before, ported to Python 3.
+#
+
+import os, re, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import imaputf7
+
+FOLDERS = ['Sent', 'Trash', 'Drafts', 'Spam', 'Archív', 'Koš', 'Odoslané', 'Café/2020']
+
+def listing(count):
+    names = []
+    for i in range(count):
+        user = 'user/u%06d' % (i // len(FOLDERS))
+        names.append('%s/%s' % (user, imaputf7.encode(FOLDERS[i % len(FOLDERS)])))
+    return names
+
+def old_decode(text):
+    if re.search("&", text):
+        text = re.sub("/", "+AC8-", text)
+        text = re.sub("&", "+", text)
+        text = text.encode('ascii').decode('utf-7')
+    return text
+
+def old_encode(text):
+    text = re.sub("/", "-&", text)
+    text = re.sub(" ", "-@", text)
+    text = text.encode('utf-7').decode('ascii')
+    text = re.sub("-@", " ", text)
+    text = re.sub("-&", "/", text)
+    text = re.sub(r"\+", "&", text)
+    return text
+
+def timeit(name, function, names):
+    start = time.perf_counter()
+    for text in names:
+        function(text)
+    elapsed = time.perf_counter() - start
+    print("%-22s %8.3f s  %10.0f names/s" % (name, elapsed, len(names) / elapsed))
+    return elapsed
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    names = listing(count)
+    decoded = [imaputf7.decode(text) for text in names]
+    old = timeit("decode (re.sub/utf-7)", old_decode, names)
+    new = timeit("decode (imaputf7)", imaputf7.decode, names)
+    print("decode speedup: %.1fx" % (old / new))
+    old = timeit("encode (re.sub/utf-7)", old_encode, decoded)
+    new = timeit("encode (imaputf7)", imaputf7.encode, decoded)
+    print("encode speedup: %.1fx" % (old / new))
@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+#
+# CYRUS admin command benchmark against the fake Cyrus IMAP server
+#
+#   python3 bench/bench_imap.py [mailboxes,...] [latency-ms]
+#
+# For each population (default 1000 and 100000 mailboxes, pass
+# 1000,100000,1000000 for the large one) times lm() over every mailbox
+# and over the users, the same listing decoded to UTF-8, and lam(),
+# lq(), reconstruct() and dm() on a sample of users. The server runs in
+# this process: its CPU time is part of the figures, compare runs on
+# the same machine only.
+#
+
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cyruslib
+import fakeimapd
+
+SAMPLE = 1000 # mailboxes for the per-mailbox commands
+USERS = 100   # users for reconstruct() and dm()
+
+def timeit(name, function, items):
+    start = time.perf_counter()
+    for item in items:
+        function(item)
+    elapsed = time.perf_counter() - start
+    print("  %-24s %8.3f s  %10.0f /s" % (name, elapsed, len(items) / elapsed))
+    return elapsed
+
+def listing(name, imap, pattern, encoding='imap'):
+    imap.setEncoding(encoding)
+    start = time.perf_counter()
+    count = len(imap.lm(pattern))
+    elapsed = time.perf_counter() - start
+    imap.setEncoding('imap')
+    print("  %-24s %8.3f s  %10.0f mailboxes/s" % (name, elapsed, count / elapsed))
+    return elapsed
+
+def bench(count, latency):
+    server, state = fakeimapd.start(fakeimapd.State(latency=latency))
+    state.populate(count, quota=10240)
+    users = state.listing('user/%')
+    step = max(1, len(users) // SAMPLE)
+    sample = users[::step][:SAMPLE]
+    victims = users[1::step][:USERS]
+    print("%d mailboxes, %d users, latency %.1f ms" % (len(state.mailboxes), len(users), latency * 1000))
+    imap = cyruslib.CYRUS("imap://127.0.0.1:%d" % server.server_address[1])
+    imap.login("cyrus", "password")
+    try:
+        listing("lm('user/*')", imap, 'user/*')
+        listing("lm('user/*') utf-8", imap, 'user/*', 'utf-8')
+        listing("lm('user/%')", imap, 'user/%')
+        timeit("lam()", imap.lam, sample)
+        timeit("lq()", imap.lq, sample)
+        timeit("reconstruct()", imap.reconstruct, victims)
+        timeit("dm()", imap.dm, victims)
+    finally:
+        imap.logout()
+        server.shutdown()
+        server.server_close()
+
+if __name__ == '__main__':
+    counts = [int(count) for count in (sys.argv[1] if len(sys.argv) > 1 else '1000,100000').split(',')]
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.0
+    for count in counts:
+        bench(count, latency)
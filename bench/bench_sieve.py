@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+#
+# MANAGESIEVE client benchmark against the fake MANAGESIEVE server
+#
+#   python3 bench/bench_sieve.py [users] [script-bytes,...] [latency-ms]
+#
+# For each script size (default 1024 and 65536 bytes) times connects
+# (greeting only, and with AUTHENTICATE), sequential and pipelined
+# PUTSCRIPT and GETSCRIPT on one connection, SievePool.deploy() and
+# sync_scripts() over the users, and as many AsyncManageSieve sessions
+# at once. The client CPU time per MB is that of the benchmark thread
+# only, the parser and the I/O layer. The server runs in this process:
+# compare runs on the same machine only.
+#
+
+import asyncio, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sievelib
+import aiosievelib
+import fakesieved
+
+POOL = 8 # connections of the pool
+
+def report(name, elapsed, count, unit='/s', size=None, cpu=None):
+    line = "  %-28s %8.3f s  %10.0f %s" % (name, elapsed, count / elapsed, unit)
+    if size is not None:
+        line += "  %8.1f MB/s" % (size / elapsed / 1e6)
+    if cpu is not None:
+        line += "  %6.1f ms CPU/MB" % (cpu * 1000 / (size / 1e6))
+    print(line)
+
+def timeit(name, function, count, size=None):
+    """Run function(), which does count of something over size bytes"""
+    start = time.perf_counter()
+    cpu = time.thread_time()
+    function()
+    cpu = time.thread_time() - cpu
+    elapsed = time.perf_counter() - start
+    report(name, elapsed, count, size=size, cpu=cpu if size else None)
+
+def connect(port, count, login):
+    for i in range(count):
+        sieve = sievelib.MANAGESIEVE('127.0.0.1', port)
+        if login:
+            sieve.login('PLAIN', 'u%06d' % i, 'password', 'cyrus')
+        sieve.logout()
+
+def sessions(port, users):
+    async def session(user):
+        async with aiosievelib.AsyncManageSieve('127.0.0.1', port) as sieve:
+            await sieve.login('PLAIN', user, 'password', 'cyrus')
+            typ, scripts = await sieve.listscripts()
+            for name, active in scripts:
+                await sieve.getscript(name)
+
+    async def main():
+        await asyncio.gather(*[session(user) for user in users])
+    asyncio.run(main())
+
+def bench(users, size, latency):
+    server, state = fakesieved.start(fakesieved.State(latency=latency))
+    state.populate(users, size=size)
+    port = server.server_address[1]
+    data = fakesieved.script(size)
+    count = min(users, 1000)
+    print("%d users, %d byte scripts, latency %.1f ms" % (users, len(data), latency * 1000))
+    try:
+        timeit("connect", lambda: connect(port, count, False), count)
+        timeit("connect + login", lambda: connect(port, count, True), count)
+
+        sieve = sievelib.MANAGESIEVE('127.0.0.1', port)
+        sieve.login('PLAIN', 'bench', 'password', 'cyrus')
+        names = ['script%05d' % i for i in range(count)]
+        def put():
+            for name in names:
+                sieve.putscript(name, data)
+        def get():
+            for name in names:
+                sieve.getscript(name)
+        timeit("putscript()", put, count, count * len(data))
+        timeit("getscript()", get, count, count * len(data))
+        timeit("pipeline() PUTSCRIPT", lambda: sieve.pipeline(
+            [('PUTSCRIPT', sievelib.sieve_name(name), sievelib.sieve_string(data))
+             for name in names]), count, count * len(data))
+        timeit("getscripts()", sieve.getscripts, count, count * len(data))
+        sieve.logout()
+
+        pool = sievelib.SievePool('127.0.0.1', port, 'cyrus', 'password', POOL)
+        desired = dict([(user, ('script0', data + b'#\r\n')) for user in state.users()])
+        timeit("SievePool.deploy()", lambda: pool.deploy(desired), users)
+        timeit("SievePool.sync_scripts()", lambda: pool.sync_scripts(desired), users)
+        pool.close()
+
+        timeit("AsyncManageSieve sessions", lambda: sessions(port, state.users()[:count]), count)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+if __name__ == '__main__':
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    sizes = [int(size) for size in (sys.argv[2] if len(sys.argv) > 2 else '1024,65536').split(',')]
+    latency = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.0
+    for size in sizes:
+        bench(users, size, latency)
@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+#
+# MANAGESIEVE response parser benchmark
+#
+#   python3 bench/bench_sieve_parse.py [rounds]
+#
+# Replays large LISTSCRIPTS, CAPABILITY and GETSCRIPT responses from
+# memory through MANAGESIEVE._get_response(), and through the
+# per-character _readstring() parser sievelib used before, both on
+# the same buffered I/O layer.
+#
+
+import os, re, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sievelib
+
+def listscripts(count):
+    lines = ['"script-%05d"%s' % (i, ' ACTIVE' if i == 0 else '') for i in range(count)]
+    return ('\r\n'.join(lines) + '\r\nOK "Listscripts completed."\r\n').encode()
+
+def capability(count):
+    lines = ['"IMPLEMENTATION" "Cyrus timsieved v3.0.8"',
+             '"SASL" "PLAIN LOGIN GSSAPI"',
+             '"SIEVE" "%s"' % ' '.join(['ext%03d' % i for i in range(count)]),
+             '"UNAUTHENTICATE"',
+             '"VERSION" "1.0"']
+    return ('\r\n'.join(lines) + '\r\nOK\r\n').encode()
+
+def getscript(size):
+    line = 'if header :contains "subject" "café" { fileinto "INBOX.Spam"; }\r\n'
+    script = (line * (size // len(line) + 1)).encode()[:size]
+    return b'{%d}\r\n%s\r\nOK\r\n' % (len(script), script)
+
+class Replay(sievelib.MANAGESIEVE):
+    """MANAGESIEVE reading a canned response instead of a socket"""
+
+    def __init__(self, data):
+        sievelib.MANAGESIEVE.__init__(self)
+        self.data = data
+
+    def _open(self, host, port):
+        raise OSError('no network')
+
+    def rewind(self):
+        self.rbuf = bytearray(self.data)
+        self.lines = []
+
+class OldReplay(Replay):
+    """The parser sievelib used before, on the same I/O layer"""
+
+    def _match(self, cre, s):
+        self.mo = cre.match(s)
+        return self.mo is not None
+
+    def _readstring(self, data):
+        if data[0] == ' ':
+            raise self.error('Unexpected space: %r' % data)
+        elif data[0] == '"':
+            if not self._match(re.compile(r'"(([^"\\]|\\.)*)"'), data):
+                raise self.error('Unmatched quote: %r' % data)
+            snippet = self.mo.group(1)
+            return sievelib.re_esc_quote.sub(r'\1', snippet), data[self.mo.end():]
+        elif self._match(sievelib.Literal, data):
+            size = int(self.mo.group('size'))
+            return self._read(size).decode('utf-8'), self._get_line()
+        else:
+            for i in range(len(data)):
+                if data[i] == ' ':
+                    return data[:i], data[i+1:]
+            else:
+                return data, ''
+
+    def _get_response(self):
+        data = [] ; dat = None
+        resp = self._get_line()
+        while 1:
+            if self._match(sievelib.Oknobye, resp):
+                typ, code, dat = self.mo.group('type','code','data')
+                self.response_code = code
+                self.response_text = None
+                if dat:
+                    self.response_text = self._readstring(dat)[0]
+                return typ, data
+            else:
+                dat = []
+                while 1:
+                    dat1, resp = self._readstring(resp)
+                    dat.append(dat1)
+                    if not resp.startswith(' '):
+                        break
+                    resp = resp[1:]
+                data.append(dat)
+                resp = self._get_line()
+
+def timeit(name, cls, data, rounds):
+    sieve = cls(data)
+    start = time.perf_counter()
+    for i in range(rounds):
+        sieve.rewind()
+        typ, res = sieve._get_response()
+    elapsed = time.perf_counter() - start
+    print("%-28s %8.3f s  %8.1f MB/s" % (name, elapsed, len(data) * rounds / elapsed / 1e6))
+    return elapsed, res
+
+if __name__ == '__main__':
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    for name, data in (("LISTSCRIPTS 100k scripts", listscripts(100000)),
+                       ("CAPABILITY 50k extensions", capability(50000)),
+                       ("GETSCRIPT 4 MB", getscript(4 * 1024 * 1024))):
+        old, res_old = timeit("%s (old)" % name, OldReplay, data, rounds)
+        new, res_new = timeit("%s (new)" % name, Replay, data, rounds)
+        assert res_old == res_new
+        print("%s speedup: %.1fx" % (name, old / new))
@@ -0,0 +1,500 @@
+#!/usr/bin/python3
+#
+# Fake Cyrus IMAP server for benchmarks
+#
+#   python3 bench/fakeimapd.py [port] [mailboxes] [latency-ms]
+#
+# An in-process stand-in for the Cyrus admin subset cyruslib uses:
+# LIST, CREATE, DELETE, RENAME, SETACL/DELETEACL/GETACL, the QUOTA
+# commands, GETANNOTATION/SETANNOTATION, GETMETADATA/SETMETADATA,
+# RECONSTRUCT, ID, LOGIN/AUTHENTICATE PLAIN and STARTTLS. Any password
+# is taken unless State.password is set.
+#
+# Responses leave latency seconds after their command arrived, as over
+# a link with that round trip: pipelined commands overlap as they do
+# against a real server, serial ones pay the latency each.
+#
+#   srv, state = fakeimapd.start(fakeimapd.State(latency=0.001))
+#   state.populate(100000)
+#   imap = cyruslib.CYRUS("imap://127.0.0.1:%d" % srv.server_address[1])
+#
+
+import base64, bisect, fnmatch, os, queue, re, socketserver, ssl, sys, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import imaputf7
+
+ADMIN_RIGHTS = 'lrswipkxtecda'
+FOLDERS = ['Sent', 'Trash', 'Drafts', 'Spam', 'Archív']
+CAPABILITY = 'IMAP4rev1 LITERAL+ ID AUTH=PLAIN SASL-IR ANNOTATEMORE QUOTA ACL'
+NONAUTH = ('CAPABILITY', 'NOOP', 'LOGOUT', 'ID', 'STARTTLS', 'LOGIN', 'AUTHENTICATE')
+
+re_token = re.compile(r' *(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|\{(\d+)\+?\}$|([^ ()"]+))')
+re_esc   = re.compile(r'\\(.)')
+
+
+class State:
+    """Mailboxes and counters shared by all connections"""
+
+    def __init__(self, sep='/', latency=0.0, metadata=True, admin='cyrus'):
+        self.sep = sep
+        self.latency = latency
+        self.metadata = metadata # METADATA next to ANNOTATEMORE
+        self.admin = admin
+        self.password = None     # checked by LOGIN and AUTHENTICATE when set
+        self.tls = None          # server SSLContext, offers STARTTLS
+        self.mailboxes = {}      # name: None, attributes are kept apart
+        self.acls = {}           # name: {identifier: rights}, if not the default
+        self.quotas = {}         # root: limit in KB
+        self.usage = {}          # root: used KB
+        self.annotations = {}    # name: {entry: value}, '' for the server
+        self.names = None        # sorted names, None to sort again
+        self.lock = threading.Lock()
+        self.commands = 0
+        self.sessions = 0
+
+    def add(self, name):
+        self.mailboxes[name] = None
+        if self.names is not None:
+            bisect.insort(self.names, name)
+
+    def remove(self, name):
+        del self.mailboxes[name]
+        for attributes in (self.acls, self.quotas, self.usage, self.annotations):
+            attributes.pop(name, None)
+        if self.names is not None:
+            del self.names[bisect.bisect_left(self.names, name)]
+
+    def populate(self, count, folders=FOLDERS, quota=None):
+        """Add count mailboxes: users with their folders (UTF-7 names)"""
+        folders = [imaputf7.encode(folder) for folder in folders]
+        per_user = len(folders) + 1
+        for user in range((count + per_user - 1) // per_user):
+            inbox = 'user%su%06d' % (self.sep, user)
+            self.mailboxes[inbox] = None
+            if quota is not None:
+                self.quotas[inbox] = quota
+            for folder in folders[:count - user * per_user - 1]:
+                self.mailboxes[inbox + self.sep + folder] = None
+        self.names = None
+
+    def sorted(self):
+        if self.names is None:
+            self.names = sorted(self.mailboxes)
+        return self.names
+
+    def prefixed(self, prefix):
+        """Sorted names starting with prefix"""
+        names = self.sorted()
+        start = bisect.bisect_left(names, prefix)
+        end = bisect.bisect_left(names, prefix + '\uffff')
+        return names[start:end]
+
+    def children(self, name):
+        return self.prefixed(name + self.sep)
+
+    def listing(self, pattern):
+        """Names matching a LIST pattern, * and % wildcards"""
+        prefix = re.split(r'[*%]', pattern, 1)[0]
+        if prefix == pattern:
+            return [pattern] if pattern in self.mailboxes else []
+        regex = re.compile(re.escape(pattern).replace(r'\*', '.*').replace(
+            '%', '[^%s]*' % re.escape(self.sep)) + '$')
+        return [name for name in self.prefixed(prefix) if regex.match(name)]
+
+    def acl(self, name):
+        return self.acls.get(name) or {self.admin: ADMIN_RIGHTS}
+
+
+def quote(text):
+    return '"%s"' % text.replace('\\', '\\\\').replace('"', '\\"')
+
+def tokenize(line, stack):
+    """
+    Add the arguments of line to the list stack[-1], a parenthesized
+    list pushes a new one. Returns the size of a trailing literal.
+    """
+    pos = 0
+    while pos < len(line):
+        mo = re_token.match(line, pos)
+        if mo is None:
+            raise ValueError('unexpected: %r' % line[pos:])
+        pos = mo.end()
+        if mo.group(1):
+            stack.append([])
+            stack[-2].append(stack[-1])
+        elif mo.group(2):
+            if len(stack) == 1:
+                raise ValueError('unmatched ): %r' % line)
+            stack.pop()
+        elif mo.group(3) is not None:
+            stack[-1].append(re_esc.sub(r'\1', mo.group(3)))
+        elif mo.group(4):
+            return int(mo.group(4))
+        elif mo.group(5):
+            stack[-1].append(mo.group(5))
+    return None
+
+
+class Handler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.due = 0
+        self.out = queue.Queue() # (due, bytes or threading.Event)
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+    def finish(self):
+        self.out.put((0, None))
+        self.thread.join()
+        socketserver.StreamRequestHandler.finish(self)
+
+    def send(self, *lines):
+        self.out.put((self.due, ''.join([line + '\r\n' for line in lines]).encode()))
+
+    def flush(self):
+        """Wait until the responses queued so far are written"""
+        flushed = threading.Event()
+        self.out.put((self.due, flushed))
+        flushed.wait()
+
+    def writer(self):
+        while True:
+            due, data = self.out.get()
+            if data is None:
+                return
+            if isinstance(data, threading.Event):
+                data.set()
+                continue
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            chunks = [data]
+            # what is due already leaves in the same write
+            while not self.out.empty():
+                due, data = self.out.queue[0]
+                if not isinstance(data, bytes) or due > time.time():
+                    break
+                chunks.append(self.out.get()[1])
+            try:
+                self.wfile.write(b''.join(chunks))
+            except OSError:
+                return
+
+    def capability(self):
+        st = self.server.state
+        capability = CAPABILITY
+        if st.metadata:
+            capability += ' METADATA'
+        if st.tls is not None and not isinstance(self.connection, ssl.SSLSocket):
+            capability += ' STARTTLS'
+        return capability
+
+    def readline(self):
+        line = self.rfile.readline()
+        if not line:
+            raise EOFError
+        return line.decode('utf-8').rstrip('\r\n')
+
+    def handle(self):
+        st = self.server.state
+        st.sessions += 1
+        self.user = None
+        self.send('* OK [CAPABILITY %s] fake Cyrus IMAP server ready' % self.capability())
+        while True:
+            args = []
+            stack = [args]
+            try:
+                line = self.readline()
+                size = tokenize(line, stack)
+                while size is not None:
+                    if not line.endswith('+}'):
+                        self.send('+ go ahead')
+                    stack[-1].append(self.rfile.read(size).decode('utf-8'))
+                    line = self.readline()
+                    size = tokenize(line, stack)
+            except (EOFError, OSError):
+                return
+            except ValueError as info:
+                self.send('* BAD %s' % info)
+                continue
+            if len(args) < 2:
+                continue
+            tag, command, args = args[0], args[1].upper(), args[2:]
+            self.due = time.time() + st.latency
+            st.commands += 1
+            function = getattr(self, 'do_' + command, None)
+            if function is None:
+                self.send('%s BAD Unrecognized command' % tag)
+                continue
+            if self.user is None and command not in NONAUTH:
+                self.send('%s BAD Please login first' % tag)
+                continue
+            try:
+                with st.lock:
+                    if function(tag, args) is False:
+                        return
+            except (IndexError, KeyError, TypeError, ValueError) as info:
+                self.send('%s BAD Invalid arguments: %s' % (tag, info))
+
+    def ok(self, tag, text='Completed'):
+        self.send('%s OK %s' % (tag, text))
+
+    def nonexistent(self, tag, name):
+        st = self.server.state
+        if name in st.mailboxes:
+            return False
+        self.send('%s NO [NONEXISTENT] Mailbox does not exist' % tag)
+        return True
+
+    def login(self, tag, user, password):
+        st = self.server.state
+        if st.password is not None and password != st.password:
+            return self.send('%s NO [AUTHENTICATIONFAILED] Invalid credentials' % tag)
+        self.user = user
+        self.ok(tag, '[CAPABILITY %s] User logged in' % self.capability())
+
+    ### Any state
+    def do_CAPABILITY(self, tag, args):
+        self.send('* CAPABILITY %s' % self.capability())
+        self.ok(tag)
+
+    def do_NOOP(self, tag, args):
+        self.ok(tag)
+
+    def do_LOGOUT(self, tag, args):
+        self.send('* BYE LOGOUT received')
+        self.ok(tag)
+        return False
+
+    def do_ID(self, tag, args):
+        self.send('* ID ("name" "Cyrus IMAPD" "version" "fake")')
+        self.ok(tag)
+
+    ### Not authenticated
+    def do_STARTTLS(self, tag, args):
+        st = self.server.state
+        if st.tls is None or isinstance(self.connection, ssl.SSLSocket):
+            return self.send('%s BAD Unrecognized command' % tag)
+        self.ok(tag, 'Begin TLS negotiation now')
+        self.flush()
+        self.connection = st.tls.wrap_socket(self.connection, server_side=True)
+        self.rfile = self.connection.makefile('rb', self.rbufsize)
+        self.wfile = socketserver._SocketWriter(self.connection)
+
+    def do_LOGIN(self, tag, args):
+        self.login(tag, args[0], args[1])
+
+    def do_AUTHENTICATE(self, tag, args):
+        if args[0].upper() != 'PLAIN':
+            return self.send('%s NO Unsupported mechanism' % tag)
+        if len(args) > 1:
+            response = args[1]
+        else:
+            self.send('+ ')
+            self.flush()
+            response = self.readline()
+        authzid, authcid, password = base64.b64decode(response).decode('utf-8').split('\0')
+        self.login(tag, authzid or authcid, password)
+
+    ### Authenticated
+    def do_LIST(self, tag, args):
+        st = self.server.state
+        if args[1] == '':
+            return self.send('* LIST (\\Noselect) "%s" ""' % st.sep, '%s OK Completed' % tag)
+        lines = ['* LIST (\\HasNoChildren) "%s" %s' % (st.sep, quote(name))
+                 for name in st.listing(args[1])]
+        lines.append('%s OK Completed' % tag)
+        self.send(*lines)
+
+    def do_CREATE(self, tag, args):
+        st = self.server.state
+        if args[0] in st.mailboxes:
+            return self.send('%s NO Mailbox already exists' % tag)
+        st.add(args[0])
+        self.ok(tag)
+
+    def do_DELETE(self, tag, args):
+        st = self.server.state
+        if self.nonexistent(tag, args[0]):
+            return
+        # a user is deleted with its folders
+        if args[0].startswith('user' + st.sep) and st.sep not in args[0][5:]:
+            for name in st.children(args[0]):
+                st.remove(name)
+        st.remove(args[0])
+        self.ok(tag)
+
+    def do_RENAME(self, tag, args):
+        st = self.server.state
+        if self.nonexistent(tag, args[0]):
+            return
+        if args[1] in st.mailboxes:
+            return self.send('%s NO Mailbox already exists' % tag)
+        for name in [args[0]] + st.children(args[0]):
+            new = args[1] + name[len(args[0]):]
+            st.mailboxes[new] = st.mailboxes.pop(name)
+            for attributes in (st.acls, st.quotas, st.usage, st.annotations):
+                if name in attributes:
+                    attributes[new] = attributes.pop(name)
+        st.names = None
+        self.ok(tag)
+
+    def do_SETACL(self, tag, args):
+        st = self.server.state
+        if self.nonexistent(tag, args[0]):
+            return
+        st.acls[args[0]] = dict(st.acl(args[0]), **{args[1]: args[2]})
+        self.ok(tag)
+
+    def do_DELETEACL(self, tag, args):
+        st = self.server.state
+        if self.nonexistent(tag, args[0]):
+            return
+        acl = dict(st.acl(args[0]))
+        acl.pop(args[1], None)
+        st.acls[args[0]] = acl
+        self.ok(tag)
+
+    def do_GETACL(self, tag, args):
+        st = self.server.state
+        if self.nonexistent(tag, args[0]):
+            return
+        rights = ' '.join(['%s %s' % (quote(userid), right) for userid, right in st.acl(args[0]).items()])
+        self.send('* ACL %s %s' % (quote(args[0]), rights), '%s OK Completed' % tag)
+
+    def quota(self, root):
+        st = self.server.state
+        used = st.usage.get(root, 0)
+        limit = st.quotas[root]
+        return '* QUOTA %s (STORAGE %d %d MESSAGE %d %d)' % (quote(root), used, limit, used // 10, limit // 10)
+
+    def do_GETQUOTA(self, tag, args):
+        if args[0] not in self.server.state.quotas:
+            return self.send('%s NO Quota root does not exist' % tag)
+        self.send(self.quota(args[0]), '%s OK Completed' % tag)
+
+    def do_GETQUOTAROOT(self, tag, args):
+        st = self.server.state
+        if self.nonexistent(tag, args[0]):
+            return
+        root = args[0]
+        while root not in st.quotas and st.sep in root:
+            root = root.rsplit(st.sep, 1)[0]
+        if root not in st.quotas:
+            return self.send('* QUOTAROOT %s' % quote(args[0]), '%s OK Completed' % tag)
+        self.send('* QUOTAROOT %s %s' % (quote(args[0]), quote(root)), self.quota(root),
+                  '%s OK Completed' % tag)
+
+    def do_SETQUOTA(self, tag, args):
+        st = self.server.state
+        if self.nonexistent(tag, args[0]):
+            return
+        if args[1]:
+            st.quotas[args[0]] = int(args[1][1])
+        else:
+            st.quotas.pop(args[0], None)
+        self.ok(tag)
+
+    def annotations(self, name):
+        st = self.server.state
+        return st.annotations.setdefault(name, {})
+
+    def do_GETANNOTATION(self, tag, args):
+        st = self.server.state
+        pattern = args[1] if isinstance(args[1], str) else args[1][0]
+        if '*' in args[0] or '%' in args[0]:
+            names = st.listing(args[0])
+        elif args[0] == '' or args[0] in st.mailboxes:
+            names = [args[0]]
+        else:
+            names = []
+        lines = []
+        for name in names:
+            for entry, value in sorted(st.annotations.get(name, {}).items()):
+                if fnmatch.fnmatch(entry, pattern):
+                    lines.append('* ANNOTATION %s %s ("value.shared" %s)' % (
+                        quote(name), quote(entry), quote(value)))
+        lines.append('%s OK Completed' % tag)
+        self.send(*lines)
+
+    def do_SETANNOTATION(self, tag, args):
+        if args[0] and self.nonexistent(tag, args[0]):
+            return
+        annotations = self.annotations(args[0])
+        value = args[2][1]
+        if value == 'NIL':
+            annotations.pop(args[1], None)
+        else:
+            annotations[args[1]] = value
+        self.ok(tag)
+
+    def do_GETMETADATA(self, tag, args):
+        st = self.server.state
+        if not st.metadata:
+            return self.send('%s BAD Unrecognized command' % tag)
+        depth = '0'
+        if isinstance(args[0], list):
+            depth = args[0][args[0].index('DEPTH') + 1]
+            args = args[1:]
+        name, entries = args[0], args[1] if isinstance(args[1], list) else [args[1]]
+        if name and self.nonexistent(tag, name):
+            return
+        values = []
+        for entry in entries:
+            entry = entry[len('/shared'):]
+            for key, value in sorted(st.annotations.get(name, {}).items()):
+                if key == entry or (depth != '0' and key.startswith(entry + '/') and
+                                    (depth == 'infinity' or key.count('/') == entry.count('/') + 1)):
+                    values.append('%s %s' % (quote('/shared' + key), quote(value)))
+        lines = ['%s OK Completed' % tag]
+        if values:
+            lines.insert(0, '* METADATA %s (%s)' % (quote(name), ' '.join(values)))
+        self.send(*lines)
+
+    def do_SETMETADATA(self, tag, args):
+        if not self.server.state.metadata:
+            return self.send('%s BAD Unrecognized command' % tag)
+        if args[0] and self.nonexistent(tag, args[0]):
+            return
+        annotations = self.annotations(args[0])
+        values = args[1]
+        for i in range(0, len(values) - 1, 2):
+            entry = values[i][len('/shared'):]
+            if values[i + 1] == 'NIL':
+                annotations.pop(entry, None)
+            else:
+                annotations[entry] = values[i + 1]
+        self.ok(tag)
+
+    def do_RECONSTRUCT(self, tag, args):
+        if self.nonexistent(tag, args[0]):
+            return
+        self.ok(tag)
+
+
+class Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def start(state=None, port=0):
+    """Serve state on 127.0.0.1 from a thread, returns (server, state)"""
+    state = state or State()
+    server = Server(('127.0.0.1', port), Handler)
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 1143
+    state = State(latency=float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.0)
+    state.populate(int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
+    server = Server(('127.0.0.1', port), Handler)
+    server.state = state
+    print("fake Cyrus IMAP server on 127.0.0.1:%d, %d mailboxes" % (port, len(state.mailboxes)))
+    server.serve_forever()
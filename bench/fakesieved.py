@@ -0,0 +1,332 @@
+#!/usr/bin/python3
+#
+# Fake MANAGESIEVE server for benchmarks
+#
+#   python3 bench/fakesieved.py [port] [users] [script-bytes] [latency-ms]
+#
+# An in-process stand-in for timsieved: greeting, CAPABILITY, STARTTLS,
+# AUTHENTICATE PLAIN (initial response inline, as a literal or after a
+# continuation), UNAUTHENTICATE, LISTSCRIPTS, GETSCRIPT, PUTSCRIPT,
+# SETACTIVE, DELETESCRIPT, HAVESPACE, NOOP and LOGOUT. Scripts are
+# kept as bytes. Any password is taken unless State.password is set,
+# the admins may authorize as any user.
+#
+# Responses leave latency seconds after their command arrived, as over
+# a link with that round trip: pipelined commands overlap as they do
+# against a real server, serial ones pay the latency each.
+#
+#   srv, state = fakesieved.start(fakesieved.State(latency=0.001))
+#   state.populate(1000, size=4096)
+#   sieve = sievelib.MANAGESIEVE("127.0.0.1", srv.server_address[1])
+#
+
+import base64, queue, re, socketserver, ssl, sys, threading, time
+
+EXTENSIONS = 'fileinto reject envelope vacation imapflags notify subaddress relational regex'
+REQUIRE = b'require ["fileinto"];\r\n'
+RULE = 'if header :contains "subject" "rule %d café" {\r\n    fileinto "INBOX.Folder%d";\r\n}\r\n'
+
+re_token = re.compile(rb' *(?:"((?:[^"\\]|\\.)*)"|\{(\d+)\+?\}$|([^ "]+))')
+re_esc   = re.compile(rb'\\(.)')
+
+
+def script(size):
+    """A sieve script of at least size bytes, UTF-8 encoded"""
+    rules = [REQUIRE]
+    length = len(REQUIRE)
+    while length < size:
+        rules.append((RULE % (len(rules), len(rules))).encode('utf-8'))
+        length += len(rules[-1])
+    return b''.join(rules)
+
+
+class State:
+    """Scripts and counters shared by all connections"""
+
+    def __init__(self, latency=0.0, unauthenticate=True, admins=('cyrus',), maxsize=None):
+        self.latency = latency
+        self.unauthenticate = unauthenticate # offer UNAUTHENTICATE
+        self.admins = admins     # may authorize as any user
+        self.maxsize = maxsize   # script size limit, for HAVESPACE and PUTSCRIPT
+        self.password = None     # checked by AUTHENTICATE when set
+        self.tls = None          # server SSLContext, offers STARTTLS
+        self.scripts = {}        # user: {scriptname: bytes}
+        self.active = {}         # user: active scriptname
+        self.lock = threading.Lock()
+        self.commands = 0
+        self.sessions = 0
+        self.auths = 0
+
+    def populate(self, count, scripts=1, size=1024, prefix='u'):
+        """Add count users with scripts of size bytes, the first active"""
+        data = script(size)
+        for user in range(count):
+            name = '%s%06d' % (prefix, user)
+            self.scripts[name] = dict([('script%d' % i, data) for i in range(scripts)])
+            if scripts:
+                self.active[name] = 'script0'
+
+    def users(self):
+        return sorted(self.scripts)
+
+
+def tokenize(line):
+    """
+    Arguments of line as bytes, and the size of a trailing literal
+    or None
+    """
+    args = []
+    pos = 0
+    while pos < len(line):
+        mo = re_token.match(line, pos)
+        if mo is None:
+            raise ValueError('unexpected: %r' % line[pos:])
+        pos = mo.end()
+        if mo.group(1) is not None:
+            args.append(re_esc.sub(rb'\1', mo.group(1)))
+        elif mo.group(2):
+            return args, int(mo.group(2))
+        elif mo.group(3):
+            args.append(mo.group(3))
+    return args, None
+
+
+class Handler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.due = 0
+        self.out = queue.Queue() # (due, bytes or threading.Event)
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+    def finish(self):
+        self.out.put((0, None))
+        self.thread.join()
+        socketserver.StreamRequestHandler.finish(self)
+
+    def send(self, *lines):
+        self.out.put((self.due, b''.join([
+            (line.encode('utf-8') if isinstance(line, str) else line) + b'\r\n'
+            for line in lines])))
+
+    def flush(self):
+        """Wait until the responses queued so far are written"""
+        flushed = threading.Event()
+        self.out.put((self.due, flushed))
+        flushed.wait()
+
+    def writer(self):
+        while True:
+            due, data = self.out.get()
+            if data is None:
+                return
+            if isinstance(data, threading.Event):
+                data.set()
+                continue
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            chunks = [data]
+            # what is due already leaves in the same write
+            while not self.out.empty():
+                due, data = self.out.queue[0]
+                if not isinstance(data, bytes) or due > time.time():
+                    break
+                chunks.append(self.out.get()[1])
+            try:
+                self.wfile.write(b''.join(chunks))
+            except OSError:
+                return
+
+    def capability(self):
+        st = self.server.state
+        lines = ['"IMPLEMENTATION" "fake timsieved"', '"SASL" "PLAIN"']
+        if st.tls is not None and not isinstance(self.connection, ssl.SSLSocket):
+            lines.append('"STARTTLS"')
+        lines.append('"SIEVE" "%s"' % EXTENSIONS)
+        if st.unauthenticate:
+            lines.append('"UNAUTHENTICATE"')
+        lines.append('"VERSION" "1.0"')
+        return lines
+
+    def readline(self):
+        line = self.rfile.readline()
+        if not line:
+            raise EOFError
+        return line.rstrip(b'\r\n')
+
+    def handle(self):
+        st = self.server.state
+        st.sessions += 1
+        self.user = None
+        self.send(*self.capability() + ['OK "fake timsieved ready"'])
+        while True:
+            try:
+                line = self.readline()
+                args, size = tokenize(line)
+                while size is not None:
+                    # literals are only taken non-synchronizing, {n+}
+                    args.append(self.rfile.read(size))
+                    more, size = tokenize(self.readline())
+                    args.extend(more)
+            except (EOFError, OSError):
+                return
+            except ValueError as info:
+                self.send('NO "%s"' % info)
+                continue
+            if not args:
+                continue
+            command, args = args[0].decode('utf-8').upper(), args[1:]
+            self.due = time.time() + st.latency
+            st.commands += 1
+            function = getattr(self, 'do_' + command, None)
+            if function is None:
+                self.send('NO "Unrecognized command"')
+                continue
+            if command not in ('CAPABILITY', 'NOOP', 'LOGOUT', 'STARTTLS', 'AUTHENTICATE') \
+                    and self.user is None:
+                self.send('NO "Authenticate first"')
+                continue
+            try:
+                with st.lock:
+                    if function(args) is False:
+                        return
+            except (IndexError, KeyError, TypeError, ValueError) as info:
+                self.send('NO "Invalid arguments: %s"' % info)
+
+    def ok(self, text=None):
+        self.send('OK "%s"' % text if text else 'OK')
+
+    def name(self, args, i=0):
+        return args[i].decode('utf-8')
+
+    def scripts(self):
+        return self.server.state.scripts.setdefault(self.user, {})
+
+    def toolarge(self, size):
+        st = self.server.state
+        if st.maxsize is None or size <= st.maxsize:
+            return False
+        self.send('NO (QUOTA/MAXSIZE) "Script size exceeds %d bytes"' % st.maxsize)
+        return True
+
+    ### Any state
+    def do_CAPABILITY(self, args):
+        self.send(*self.capability() + ['OK'])
+
+    def do_NOOP(self, args):
+        self.ok('NOOP completed')
+
+    def do_LOGOUT(self, args):
+        self.ok('Logout completed')
+        return False
+
+    ### Not authenticated
+    def do_STARTTLS(self, args):
+        st = self.server.state
+        if st.tls is None or isinstance(self.connection, ssl.SSLSocket):
+            return self.send('NO "Unrecognized command"')
+        self.ok('Begin TLS negotiation now')
+        self.flush()
+        self.connection = st.tls.wrap_socket(self.connection, server_side=True)
+        self.rfile = self.connection.makefile('rb', self.rbufsize)
+        self.wfile = socketserver._SocketWriter(self.connection)
+        self.send(*self.capability() + ['OK'])
+
+    def do_AUTHENTICATE(self, args):
+        st = self.server.state
+        if self.user is not None:
+            return self.send('NO "Already authenticated"')
+        if self.name(args).upper() != 'PLAIN':
+            return self.send('NO "Unsupported mechanism"')
+        if len(args) > 1:
+            response = args[1]
+        else:
+            self.send('""')
+            self.flush()
+            response = self.readline().strip(b'"')
+        authzid, authcid, password = base64.b64decode(response).decode('utf-8').split('\0')
+        if st.password is not None and password != st.password \
+                or authzid and authzid != authcid and authcid not in st.admins:
+            return self.send('NO "Authentication failed"')
+        self.user = authzid or authcid
+        st.auths += 1
+        self.ok()
+
+    ### Authenticated
+    def do_UNAUTHENTICATE(self, args):
+        if not self.server.state.unauthenticate:
+            return self.send('NO "Unrecognized command"')
+        self.user = None
+        self.ok()
+
+    def do_LISTSCRIPTS(self, args):
+        active = self.server.state.active.get(self.user)
+        lines = ['"%s"%s' % (name, ' ACTIVE' if name == active else '')
+                 for name in sorted(self.scripts())]
+        self.send(*lines + ['OK'])
+
+    def do_GETSCRIPT(self, args):
+        data = self.scripts().get(self.name(args))
+        if data is None:
+            return self.send('NO (NONEXISTENT) "Script does not exist"')
+        self.send(b'{%d}\r\n%s' % (len(data), data), b'OK')
+
+    def do_PUTSCRIPT(self, args):
+        if self.toolarge(len(args[1])):
+            return
+        self.scripts()[self.name(args)] = args[1]
+        self.ok()
+
+    def do_HAVESPACE(self, args):
+        if self.toolarge(int(args[1])):
+            return
+        self.ok()
+
+    def do_SETACTIVE(self, args):
+        st = self.server.state
+        name = self.name(args)
+        if name == '':
+            st.active.pop(self.user, None)
+        elif name not in self.scripts():
+            return self.send('NO (NONEXISTENT) "Script does not exist"')
+        else:
+            st.active[self.user] = name
+        self.ok()
+
+    def do_DELETESCRIPT(self, args):
+        st = self.server.state
+        name = self.name(args)
+        if st.active.get(self.user) == name:
+            return self.send('NO (ACTIVE) "Script is active"')
+        if self.scripts().pop(name, None) is None:
+            return self.send('NO (NONEXISTENT) "Script does not exist"')
+        self.ok()
+
+
+class Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def start(state=None, port=0):
+    """Serve state on 127.0.0.1 from a thread, returns (server, state)"""
+    state = state or State()
+    server = Server(('127.0.0.1', port), Handler)
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 4190
+    state = State(latency=float(sys.argv[4]) / 1000 if len(sys.argv) > 4 else 0.0)
+    state.populate(int(sys.argv[2]) if len(sys.argv) > 2 else 1000,
+                   size=int(sys.argv[3]) if len(sys.argv) > 3 else 1024)
+    server = Server(('127.0.0.1', port), Handler)
+    server.state = state
+    print("fake MANAGESIEVE server on 127.0.0.1:%d, %d users" % (port, len(state.scripts)))
+    server.serve_forever()
@@ -23,7 +23,7 @@
 #
 
 __version__ = '0.8.5'
-__all__ = [ 'CYRUS' ]
+__all__ = [ 'CYRUS', 'CyrusPool', 'CyrusCluster' ]
 __doc__ = """Cyrus admin wrapper
 Adds cyrus-specific commands to imaplib IMAP4 Class
 and defines new CYRUS class for cyrus imapd commands
@@ -33,8 +33,18 @@ and defines new CYRUS class for cyrus imapd commands
 from sys import exit, stdout
 
 try:
+    import cyrusmetrics
     import imaplib
+    import imapparse
+    import imaputf7
     import re
+    import ssl
+    import threading
+    import time
+    import weakref
+    from concurrent.futures import ThreadPoolExecutor
+    from time import perf_counter
+    from contextlib import contextmanager
     from binascii import b2a_base64
 except ImportError as e:
     print(e)
@@ -45,12 +55,53 @@ Commands = {
         'DUMP'         : ('AUTH',), # To check admin status
         'ID'           : ('AUTH',), # Only one ID allowed in non auth mode
         'GETANNOTATION': ('AUTH',),
-        'SETANNOTATION': ('AUTH',)
+        'SETANNOTATION': ('AUTH',),
+        'GETMETADATA'  : ('AUTH',),
+        'SETMETADATA'  : ('AUTH',)
         }
 
 imaplib.Commands.update(Commands)
 
+### CYRUS function: (IMAP command, untagged response returned on OK)
+Dispatch = {
+        'create'       : ('CREATE', None),
+        'rename'       : ('RENAME', None),
+        'getacl'       : ('GETACL', 'ACL'),
+        'setacl'       : ('SETACL', None),
+        'getquota'     : ('GETQUOTA', 'QUOTA'),
+        'setquota'     : ('SETQUOTA', None),
+        'getannotation': ('GETANNOTATION', 'ANNOTATION'),
+        'setannotation': ('SETANNOTATION', None),
+        'reconstruct'  : ('RECONSTRUCT', None),
+        'lsub'         : ('LSUB', 'LSUB'),
+        'subscribe'    : ('SUBSCRIBE', None),
+        'unsubscribe'  : ('UNSUBSCRIBE', None)
+        }
+
+### IMAP command: position of its mailbox argument, for instruments
+MailboxArgs = dict([(name, 0) for name in (
+        'CREATE', 'DELETE', 'RENAME', 'GETACL', 'SETACL', 'DELETEACL',
+        'LISTRIGHTS', 'MYRIGHTS', 'GETQUOTA', 'GETQUOTAROOT', 'SETQUOTA',
+        'GETANNOTATION', 'SETANNOTATION', 'GETMETADATA', 'SETMETADATA',
+        'RECONSTRUCT', 'SUBSCRIBE', 'UNSUBSCRIBE', 'SELECT', 'EXAMINE',
+        'STATUS')])
+MailboxArgs.update({'LIST': 1, 'LSUB': 1})
+
+def mailboxarg(name, args):
+    """Mailbox argument of an IMAP command, None if it has none"""
+    i = MailboxArgs.get(name)
+    if i is None:
+        return None
+    ### GETMETADATA options come before the mailbox
+    if args and args[0] and tostr(args[0])[:1] == '(':
+        i += 1
+    if len(args) <= i:
+        return None
+    return tostr(args[i]).strip('"')
+
 DEFAULT_SEP = '.'
+### host:port: hierarchy separator learned at login, see CYRUS.login()
+Separators = {}
 QUOTE       = '"'
 DQUOTE      = '""'
 
@@ -58,17 +109,34 @@ re_ns  = re.compile(r'.*\(\(\".*(\.|/)\"\)\).*')
 re_q0  = re.compile(r'(.*)\s\(\)')
 re_q   = re.compile(r'(.*)\s\(STORAGE (\d+) (\d+)\)')
 re_mb  = re.compile(r'\((.*)\)\s\".\"\s(.*)')
-re_url = re.compile(r'^(imaps?)://(.+?):?(\d{0,5})$')
+re_url = re.compile(r'^(imaps?|imap\+starttls)://(.+?):?(\d{0,5})$')
+re_rcode = re.compile(r'\[([^\] ]+)')
+re_capability = re.compile(r'\[CAPABILITY ([^\]]*)\]', re.I)
 
 def ok(res):
     return res.upper().startswith('OK')
 
+def tostr(data):
+    if isinstance(data, bytes):
+        return data.decode()
+    return data
+
 def quote(text, qchar=QUOTE):
     return text.join([qchar, qchar])
 
 def unquote(text, qchar=QUOTE):
     return ''.join(text.split(qchar))
 
+def sasl_plain(authzid, authcid, password):
+    return ("%s\0%s\0%s" % (authzid, authcid, password)).encode('utf-8')
+
+def listsep(data):
+    """Separator of a LIST "" "" response, None if there is none"""
+    try:
+        return imapparse.parse_list(data[0]).sep
+    except:
+        return None
+
 def getflags(test):
     flags = []
     for flag in test.split('\\'):
@@ -103,20 +171,274 @@ def res2dict(data):
         res[data[i]] = data[i+1]
     return True, res
 
+### regular expression of a LIST pattern, * matches any
+### character and % any character but the separator
+def listpattern(pattern, sep):
+    pattern = re.escape(pattern).replace(r'\*', '.*')
+    return re.compile(pattern.replace('%', '[^%s]*' % re.escape(sep)) + '$')
+
+### IMAP argument lists shared by the single and the pipelined commands
+def quotalist(limit):
+    if limit == 0:
+        return '()'
+    return '(STORAGE %s)' % limit
+
+def annotationlist(value):
+    if value:
+        value = quote(value)
+    else:
+        value = "NIL"
+    return "(%s %s)" % (quote('value.shared'), value)
+
+### METADATA (RFC 5464) keeps the value.shared of an annotation
+### entry as the /shared entry of the same name
+SHARED = '/shared'
 
-class CYRUSError(Exception): pass
+def metadatalist(entry, value):
+    if value:
+        value = quote(value)
+    else:
+        value = "NIL"
+    return "(%s %s)" % (quote(SHARED + entry), value)
+
+### (entry, DEPTH, regex) of GETMETADATA for an annotation entry pattern
+def metadatapattern(pattern):
+    wild = re.search(r'[*%]', pattern)
+    if wild is None:
+        return SHARED + pattern, '0', None
+    ### no '/' before the wildcard: everything below /shared
+    prefix = pattern[:max(pattern.rfind('/', 0, wild.start()), 0)]
+    return SHARED + prefix, 'infinity', listpattern(pattern, '/')
+
+
+class CYRUSError(Exception):
+    """
+    CYRUSError(code, COMMAND, description), args as before. Errors of
+    a NO or BAD tagged response also have its status and the response
+    code in brackets, if any, as rcode (e.g. 'NONEXISTENT')
+    """
+
+    def __init__(self, code, command, message, status=None):
+        Exception.__init__(self, code, command, message)
+        self.code = code
+        self.command = command
+        self.message = message
+        self.status = status
+        self.rcode = None
+        if status is not None and message:
+            match = re_rcode.match(message)
+            if match:
+                self.rcode = match.group(1).upper()
+
+class MailboxTree:
+    """
+    Local copy of the mailbox hierarchy answering LIST patterns
+    without a round trip. Nodes are [flags, children], flags is None
+    for a hierarchy level which is not a mailbox itself. Names are
+    kept as the server sends them, CYRUS encodes them when listing.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.sep = DEFAULT_SEP
+        self.root = [None, {}]
+        self.loaded = None
+
+    def load(self, mailboxes, sep):
+        """Replace the tree with (mailbox, flags) pairs"""
+        self.sep = sep
+        self.root = [None, {}]
+        for mailbox, flags in mailboxes:
+            self.add(mailbox, flags)
+        self.loaded = time.time()
+
+    def expired(self):
+        if self.loaded is None:
+            return True
+        return self.ttl is not None and time.time() - self.loaded > self.ttl
+
+    def __path(self, mailbox):
+        """Nodes from the root down to mailbox, None if not in the tree"""
+        nodes = [self.root]
+        for name in mailbox.split(self.sep):
+            node = nodes[-1][1].get(name)
+            if node is None:
+                return None
+            nodes.append(node)
+        return nodes
+
+    def __prune(self, mailbox, nodes):
+        names = mailbox.split(self.sep)
+        for i in range(len(names), 0, -1):
+            if nodes[i][0] is not None or nodes[i][1]:
+                break
+            del nodes[i - 1][1][names[i - 1]]
+
+    def add(self, mailbox, flags=()):
+        node = self.root
+        for name in mailbox.split(self.sep):
+            node = node[1].setdefault(name, [None, {}])
+        node[0] = list(flags)
+
+    def remove(self, mailbox, children=False):
+        nodes = self.__path(mailbox)
+        if nodes is None:
+            return
+        nodes[-1][0] = None
+        if children:
+            nodes[-1][1].clear()
+        self.__prune(mailbox, nodes)
+
+    def rename(self, fromMbx, toMbx):
+        nodes = self.__path(fromMbx)
+        if nodes is None or fromMbx == toMbx:
+            return
+        node = nodes.pop()
+        names = fromMbx.split(self.sep)
+        del nodes[-1][1][names[-1]]
+        if len(names) > 1:
+            self.__prune(self.sep.join(names[:-1]), nodes)
+        parent = self.root
+        names = toMbx.split(self.sep)
+        for name in names[:-1]:
+            parent = parent[1].setdefault(name, [None, {}])
+        parent[1][names[-1]] = node
+
+    def match(self, pattern):
+        """Yields (mailbox, flags) matching the LIST pattern"""
+        names = pattern.split(self.sep)
+        node = self.root
+        prefix = []
+        # Walk down the levels without wildcards
+        while len(names) > 1 and '*' not in names[0] and '%' not in names[0]:
+            node = node[1].get(names[0])
+            if node is None:
+                return
+            prefix.append(names.pop(0))
+        rest = self.sep.join(names)
+        depth = None
+        if '*' not in rest:
+            depth = len(names)
+        for mailbox in self.__walk(node, prefix, [], depth, listpattern(rest, self.sep)):
+            yield mailbox
+
+    def __walk(self, node, prefix, names, depth, regex):
+        for name in sorted(node[1]):
+            child = node[1][name]
+            path = names + [name]
+            if child[0] is not None and regex.match(self.sep.join(path)):
+                yield self.sep.join(prefix + path), child[0]
+            if depth is None or len(path) < depth:
+                for mailbox in self.__walk(child, prefix, path, depth, regex):
+                    yield mailbox
+
+class Responses:
+    """
+    Iterator over the untagged responses of tag, read directly
+    from the imaplib connection. Yields (type, data), data with
+    literals is a (data, literal, ...) tuple as imapparse takes it.
+    When exhausted, result holds the (type, text) of the tagged response.
+
+    Live iterators are kept in m.streams, in command order: before
+    another command reads its response (see CyrusIMAP.drain()), the
+    rest of their responses is read into their buffer.
+    """
+
+    def __init__(self, m, tag):
+        self.m = m
+        self.tag = tag + b' '
+        self.result = None
+        self.buffer = None
+        if not m.streams:
+            m.streams = []
+        m.streams.append(self)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.buffer:
+            return self.buffer.pop(0)
+        if self.result is not None:
+            raise StopIteration
+        if self.m.streams[0] is not self:
+            # responses of the commands sent before come first
+            self.m.drain(self)
+        return self.__read()
+
+    def drain(self):
+        """Read the rest of the response into the buffer"""
+        if self.buffer is None:
+            self.buffer = []
+        while self.result is None:
+            try:
+                self.buffer.append(self.__read())
+            except StopIteration:
+                pass
+
+    def __done(self, result):
+        self.result = result
+        self.m.streams.remove(self)
+
+    def __read(self):
+        try:
+            line = self.m._get_line()
+            if line.startswith(self.tag):
+                del self.m.tagged_commands[self.tag[:-1]]
+                typ, msg = (line[len(self.tag):].split(b' ', 1) + [b''])[:2]
+                self.__done((tostr(typ), tostr(msg)))
+                if self.m.instruments:
+                    self.m._finish(self.tag[:-1], self.result[0])
+                raise StopIteration
+            match = imaplib.Untagged_response.match(line)
+            if match is None:
+                return None, line
+            data = match.group('data') or b''
+            literal = imaplib.Literal.match(data)
+            if literal is None:
+                return tostr(match.group('type')), data
+            literals = []
+            while literal:
+                literals.append(self.m.read(int(literal.group('size'))))
+                line = self.m._get_line()
+                data = data + line
+                literal = imaplib.Literal.match(line)
+            return tostr(match.group('type')), tuple([data] + literals)
+        except self.m.abort as info:
+            self.__done(('BAD', str(info)))
+            if self.m.instruments:
+                self.m._finish(self.tag[:-1], 'ABORT')
+            raise StopIteration
+
+class CyrusIMAP:
+    """
+    Cyrus commands, mixed into every imaplib transport class: a new
+    transport only has to provide the connection (see Transports)
+    """
 
-class IMAP4(imaplib.IMAP4):
     def getsep(self):
         """Get mailbox separator"""
         ### yes, ugly but cyradm does it in the same way
         ### also more realable then calling NAMESPACE
         ### and it should be also compatibile with other servers
         try:
-            return unquote(self.list(DQUOTE, DQUOTE)[1][0]).split()[1]
+            return listsep(self.list(DQUOTE, DQUOTE)[1]) or DEFAULT_SEP
         except:
             return DEFAULT_SEP
 
+    def _get_capabilities(self):
+        ### Cyrus sends its capabilities with the greeting, spare
+        ### the CAPABILITY round trip imaplib makes after it
+        if 'CAPABILITY' in self.untagged_responses:
+            dat = self.untagged_responses.pop('CAPABILITY')[-1]
+            self.capabilities = tuple(str(dat, self._encoding).upper().split())
+        else:
+            super()._get_capabilities()
+
+    def saslir(self):
+        """True if AUTHENTICATE PLAIN may carry its response (RFC 4959)"""
+        return 'SASL-IR' in self.capabilities and 'AUTH=PLAIN' in self.capabilities
+
     def id(self):
         try:
             typ, dat = self._simple_command('ID', 'NIL')
@@ -130,20 +452,12 @@ class IMAP4(imaplib.IMAP4):
         return self._untagged_response(typ, dat, 'ANNOTATION')
 
     def setannotation(self, mailbox, desc, value):
-        if value:
-            value = quote(value)
-        else:
-            value = "NIL"
-        typ, dat = self._simple_command('SETANNOTATION', mailbox, quote(desc), "(%s %s)" % (quote('value.shared'), value) )
+        typ, dat = self._simple_command('SETANNOTATION', mailbox, quote(desc), annotationlist(value))
         return self._untagged_response(typ, dat, 'ANNOTATION')
 
     def setquota(self, mailbox, limit):
         """Set quota of a mailbox"""
-        if limit == 0:
-            quota = '()'
-        else:
-            quota = '(STORAGE %s)' % limit
-        return self._simple_command('SETQUOTA', mailbox, quota)
+        return self._simple_command('SETQUOTA', mailbox, quotalist(limit))
 
     ### Overridden to support partition
     ### Pychecker will complain about non matching signature
@@ -166,65 +480,200 @@ class IMAP4(imaplib.IMAP4):
     def reconstruct(self, mailbox):
         return self._simple_command('RECONSTRUCT', mailbox)
 
-class IMAP4_SSL(imaplib.IMAP4_SSL):
-    def getsep(self):
-        """Get mailbox separator"""
-        ### yes, ugly but cyradm does it in the same way
-        ### also more realable then calling NAMESPACE
-        ### and it should be also compatibile with other servers
+    ### Streamed responses being read, see Responses
+    streams = ()
+
+    def drain(self, until=None):
+        """Buffer the responses of the streams sent before until, or of all"""
+        for responses in list(self.streams):
+            if responses is until:
+                break
+            responses.drain()
+
+    ### Instrumentation, see cyrusmetrics
+    instruments = ()
+
+    def instrument(self, instrument):
+        """Call instrument.start() and end() for each command"""
+        if not self.instruments:
+            self.instruments = []
+            self.pending = {} # tag: (name, mailbox, sent, start, received)
+            self.sent = self.received = self.mark = 0
+            # bytes are only counted once instrumented
+            self.send = self.__send
+            self.readline = self.__readline
+            self.read = self.__read
+        self.instruments.append(instrument)
+
+    def __send(self, data):
+        self.sent += len(data)
+        return type(self).send(self, data)
+
+    def __readline(self):
+        line = type(self).readline(self)
+        self.received += len(line)
+        return line
+
+    def __read(self, size):
+        data = type(self).read(self, size)
+        self.received += len(data)
+        return data
+
+    def _command(self, name, *args):
+        if not self.instruments:
+            return super()._command(name, *args)
+        mailbox = mailboxarg(name, args)
+        for instrument in self.instruments:
+            instrument.start(cyrusmetrics.Event('imap', name, mailbox, None, None, None, None))
+        sent = self.sent
+        start = perf_counter()
         try:
-            return unquote(self.list(DQUOTE, DQUOTE)[1][0]).split()[1]
-        except:
-            return DEFAULT_SEP
-
-    def id(self):
+            tag = super()._command(name, *args)
+        except self.abort:
+            self.__end(name, mailbox, self.sent - sent, start, self.received, 'ABORT')
+            raise
+        self.pending[tag] = (name, mailbox, self.sent - sent, start, self.received)
+        return tag
+
+    def _get_tagged_response(self, tag, expect_bye=False):
+        if self.streams:
+            self.drain()
+        if not self.instruments:
+            return super()._get_tagged_response(tag, expect_bye)
         try:
-            typ, dat = self._simple_command('ID', 'NIL')
-            res, dat = self._untagged_response(typ, dat, 'ID')
+            typ, dat = super()._get_tagged_response(tag, expect_bye)
+        except self.abort:
+            self._finish(tag, 'ABORT')
+            raise
+        self._finish(tag, typ)
+        return typ, dat
+
+    def _finish(self, tag, result):
+        """End event of the command tag, its response is read"""
+        pending = self.pending.pop(tag, None)
+        if pending is not None:
+            self.__end(*(pending + (result,)))
+
+    def __end(self, name, mailbox, sent, start, received, result):
+        # responses come in order: bytes read since the previous
+        # command completed belong to this one
+        received = self.received - max(received, self.mark)
+        self.mark = self.received
+        event = cyrusmetrics.Event('imap', name, mailbox, sent, received,
+                                   perf_counter() - start, result)
+        for instrument in self.instruments:
+            instrument.end(event)
+
+    def _dispatch(self, name, untagged, *args):
+        """Send a command and wait for it, see _complete()"""
+        return self._complete(self._command(name, *args), untagged)
+
+    def _complete(self, tag, untagged=None):
+        """
+        (typ, data) of the tagged response of tag: on OK data are the
+        untagged responses named untagged ([None] if none came), else
+        the text of the tagged response. Unlike _command_complete()
+        BAD does not raise, only a broken connection does.
+        """
+        typ, dat = self._get_tagged_response(tag)
+        self._check_bye()
+        if typ != 'OK' or untagged is None:
+            return typ, dat
+        return typ, self.untagged_responses.pop(untagged, [None])
+
+class TLSSessions:
+    """
+    Last TLS session of each (host, port), per SSLContext: a session
+    can only be resumed with the context which negotiated it
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = weakref.WeakKeyDictionary() # context: {(host, port): session}
+        self.context = None
+
+    def default_context(self):
+        """Context shared by the connections given none, as unverified as imaplib's"""
+        with self.lock:
+            if self.context is None:
+                self.context = ssl._create_stdlib_context()
+            return self.context
+
+    def get(self, context, host, port):
+        with self.lock:
+            return self.sessions.get(context, {}).get((host, port))
+
+    def put(self, context, host, port, sock):
+        """Keep the session of sock, once the server sent something"""
+        session = getattr(sock, 'session', None)
+        if session is None:
+            return
+        with self.lock:
+            self.sessions.setdefault(context, {})[(host, port)] = session
+
+    def clear(self):
+        with self.lock:
+            self.sessions.clear()
+
+Sessions = TLSSessions()
+
+class IMAP4(CyrusIMAP, imaplib.IMAP4):
+    pass
+
+class IMAP4_SSL(CyrusIMAP, imaplib.IMAP4_SSL):
+    """IMAP4 over TLS, resuming the last session with the same server"""
+
+    def __init__(self, host='', port=imaplib.IMAP4_SSL_PORT, ssl_context=None):
+        imaplib.IMAP4_SSL.__init__(self, host, port,
+                                   ssl_context=ssl_context or Sessions.default_context())
+
+    def _create_socket(self, timeout):
+        sock = imaplib.IMAP4._create_socket(self, timeout)
+        return self.ssl_context.wrap_socket(sock, server_hostname=self.host,
+            session=Sessions.get(self.ssl_context, self.host, self.port))
+
+    def _connect(self):
+        imaplib.IMAP4_SSL._connect(self)
+        ### TLS 1.3 session tickets come after the handshake, with the greeting
+        Sessions.put(self.ssl_context, self.host, self.port, self.sock)
+
+class IMAP4_STARTTLS(CyrusIMAP, imaplib.IMAP4):
+    """IMAP4 switched to TLS by STARTTLS before anything else is sent"""
+
+    def __init__(self, host='', port=imaplib.IMAP4_PORT, ssl_context=None):
+        imaplib.IMAP4.__init__(self, host, port)
+        try:
+            self.starttls(ssl_context)
         except:
-            return False, dat[0]
-        return ok(res), dat[0]
-
-    def getannotation(self, mailbox, pattern='*'):
-        typ, dat = self._simple_command('GETANNOTATION', mailbox, quote(pattern), quote('value.shared'))
-        return self._untagged_response(typ, dat, 'ANNOTATION')
-
-    def setannotation(self, mailbox, desc, value):
-        if value:
-            value = quote(value)
-        else:
-            value = "NIL"
-        typ, dat = self._simple_command('SETANNOTATION', mailbox, quote(desc), "(%s %s)" % (quote('value.shared'), value) )
-        return self._untagged_response(typ, dat, 'ANNOTATION')
-
-    def setquota(self, mailbox, limit):
-        """Set quota of a mailbox"""
-        if limit == 0:
-            quota = '()'
-        else:
-            quota = '(STORAGE %s)' % limit
-        return self._simple_command('SETQUOTA', mailbox, quota)
-
-    ### Overridden to support partition
-    ### Pychecker will complain about non matching signature
-    def create(self, mailbox, partition=None):
-        """Create a mailbox, partition is optional"""
-        if partition is not None:
-            return self._simple_command('CREATE', mailbox, partition)
-        else:
-            return self._simple_command('CREATE', mailbox)
-
-    ### Overridden to support partition
-    ### Pychecker: same here
-    def rename(self, from_mailbox, to_mailbox, partition=None):
-        """Rename a from_mailbox to to_mailbox, partition is optional"""
-        if partition is not None:
-            return self._simple_command('RENAME', from_mailbox, to_mailbox, partition)
-        else:
-            return self._simple_command('RENAME', from_mailbox, to_mailbox)
-
-    def reconstruct(self, mailbox):
-        return self._simple_command('RECONSTRUCT', mailbox)
+            self.shutdown()
+            raise
+
+    def starttls(self, ssl_context=None):
+        """imaplib starttls(), resuming the last session with the same server"""
+        self.ssl_context = ssl_context or Sessions.default_context()
+        if self._tls_established:
+            raise self.abort('TLS session already established')
+        if 'STARTTLS' not in self.capabilities:
+            raise self.abort('TLS not supported by server')
+        typ, dat = self._simple_command('STARTTLS')
+        if typ != 'OK':
+            raise self.error("Couldn't establish TLS session")
+        self.sock = self.ssl_context.wrap_socket(self.sock, server_hostname=self.host,
+            session=Sessions.get(self.ssl_context, self.host, self.port))
+        self.file = self.sock.makefile('rb')
+        self._tls_established = True
+        ### capabilities sent before TLS are not to be trusted
+        self.untagged_responses.pop('CAPABILITY', None)
+        self._get_capabilities()
+        Sessions.put(self.ssl_context, self.host, self.port, self.sock)
+        return self._untagged_response(typ, dat, 'STARTTLS')
+
+### URL scheme: transport class
+Transports = {
+        'imap'         : IMAP4,
+        'imaps'        : IMAP4_SSL,
+        'imap+starttls': IMAP4_STARTTLS
+        }
 
 
 class CYRUS:
@@ -240,6 +689,7 @@ class CYRUS:
     ERROR["LOGINPLAIN"]  = [15, "Encryption needed to use mechanism"]
     ERROR["LOGIN_PLAIN"] = [16, "User or password is wrong"]
     ERROR["CREATE"]      = [20, "Unable create mailbox"]
+    ERROR["PROVISION"]   = [21, "Mailbox given more than once"]
     ERROR["DELETE"]      = [25, "Unable delete mailbox"]
     ERROR["GETACL"]      = [30, "Unable parse GETACL result"]
     ERROR["SETQUOTA"]    = [40, "Invalid integer argument"]
@@ -249,12 +699,13 @@ class CYRUS:
     ERROR["SUBSCRIBE"]   = [70, "User is cyrus administrator, normal user required"]
     ERROR["UNSUBSCRIBE"] = [75, "User is cyrus administrator, normal user required"]
     ERROR["LSUB"]        = [77, "User is cyrus administrator, normal user required"]
+    ERROR["POOL"]        = [80, "No pooled connection available"]
     ERROR["UNKCMD"]      = [98, "Command not implemented"]
     ERROR["IMAPLIB"]     = [99, "Generic imaplib error"]
 
     ENCODING_LIST = ['imap', 'utf-8', 'iso-8859-1']
     
-    def __init__(self, url = 'imap://localhost:143'):
+    def __init__(self, url = 'imap://localhost:143', ssl_context=None):
         self.VERBOSE = False
         self.AUTH = False
         self.USERNAME = None
@@ -263,6 +714,11 @@ class CYRUS:
         self.SEP = DEFAULT_SEP
         self.ENCODING = 'imap'
         self.NORMALIZE = False
+        self.PIPELINE = 100 # commands in flight per pipelined window
+        self.ACLS = {}      # lam() results by mailbox
+        self.TREE = None    # MailboxTree cache, see setCache()
+        self.METADATA = None # METADATA instead of ANNOTATEMORE, None detects
+        self.CAPABILITY = None # capabilities sent with the login response
         self.LOGFD = stdout
         match = re_url.match(url)
         if match:
@@ -273,13 +729,13 @@ class CYRUS:
                 port = 143
         else:
             self.__doraise("INVALID_URL")
+        self.SERVER = "%s:%d" % (host, port)
+        self.ssl = match.group(1) != 'imap'
         try:
-            if match.group(1) == 'imap':
-                self.ssl = False
-                self.m = IMAP4(host, port)
+            if self.ssl:
+                self.m = Transports[match.group(1)](host, port, ssl_context)
             else:
-                self.ssl = True
-                self.m = IMAP4_SSL(host, port)
+                self.m = Transports[match.group(1)](host, port)
         except:
             self.__doraise("CONNECT")
 
@@ -321,21 +777,78 @@ class CYRUS:
         elif not mailbox:
             self.__doexception(command, self.ERROR.get("MBXNULL")[1])
 
+    def __error(self, info):
+        error = info.args[0].split(':').pop().strip()
+        if error.upper().startswith('BAD'):
+            error = error.split('BAD', 1).pop().strip()
+            error = unquote(error[1:-1], '\'')
+        return error
+
+    def __doresponse(self, function, res, msg, *args):
+        """Raise the CYRUSError of a NO or BAD tagged response"""
+        msg = tostr(msg[0])
+        value = ""
+        for arg in args:
+            if arg is not None:
+                value = "%s %s" % (value, arg)
+        self.__verbose( '[%s%s] %s: %s' % (function.upper(), value, res, msg) )
+        idError = self.ERROR.get(function.upper(), self.ERROR["IMAPLIB"])
+        raise CYRUSError( idError[0], function.upper(), msg, res )
+
     def __docommand(self, function, *args):
-        wrapped = getattr(self.m, function, None)
-        if wrapped is None:
+        try:
+            name, untagged = Dispatch[function]
+        except KeyError:
             raise self.__doraise("UNKCMD")
         try:
-            res, msg = wrapped(*args)
-            if ok(res):
-                return res, msg
+            res, msg = self.m._dispatch(name, untagged, *args)
         except Exception as info:
-            error = info.args[0].split(':').pop().strip()
-            if error.upper().startswith('BAD'):
-                error = error.split('BAD', 1).pop().strip()
-                error = unquote(error[1:-1], '\'')
-            self.__doexception(function, error, *args)
-        self.__doexception(function, msg[0], *args)
+            self.__doexception(function, self.__error(info), *args)
+        if ok(res):
+            return res, msg
+        self.__doresponse(function, res, msg, *args)
+
+    def __pipeline(self, commands):
+        """
+        Send (COMMAND, arg, ...) tuples without waiting for each tagged
+        response, at most PIPELINE commands at a time.
+        Returns a list of (ok, msg, status) in the same order, status
+        being that of the tagged response: a NO or BAD response does
+        not raise CYRUSError.
+        """
+        results = []
+        for i in range(0, len(commands), self.PIPELINE):
+            window = commands[i:i + self.PIPELINE]
+            tags = []
+            for command in window:
+                try:
+                    tags.append(self.m._command(*command))
+                except Exception as info:
+                    self.__doexception(command[0], self.__error(info))
+            for command, tag in zip(window, tags):
+                try:
+                    res, msg = self.m._complete(tag)
+                except self.m.abort as info:
+                    self.__doexception(command[0], self.__error(info))
+                except Exception as info:
+                    res, msg = "BAD", [self.__error(info)]
+                msg = tostr(msg[0])
+                self.__verbose( '[%s] %s: %s' % (' '.join([str(arg) for arg in command if arg is not None]), res, msg) )
+                results.append((ok(res), msg, res))
+        return results
+
+    def __pipelineresult(self, commands, result, failures=None):
+        """
+        Pipeline (key, command) pairs, storing the first failed
+        command of each key in the {key: (ok, error)} result dict,
+        and its (COMMAND, status, msg) in the failures dict if given
+        """
+        for (key, command), (res, msg, status) in zip(commands, self.__pipeline([c for k, c in commands])):
+            if not res and result[key][0]:
+                result[key] = (False, '%s: %s' % (command[0], msg))
+                if failures is not None:
+                    failures[key] = (command[0], status, msg)
+        return result
 
     def _normalize(self, mailbox):
         mbxList = mailbox.split("@")
@@ -362,27 +875,92 @@ class CYRUS:
     def id(self):
         self.__prepare('id')
         res, data = self.m.id()
-        data = data.strip()
-        if not res or (len(data) < 3): return False, {}
-        data = data[1:-1] # Strip ()
-        res, rdata = res2dict(data)
-        if not res:
-            self.__verbose( '[ID] Umatched pairs in result' )
-        return res, rdata
-
-    def login(self, username, password, forceNoAdmin = False):
-        if self.AUTH:
-            self.__doexception("LOGIN", self.ERROR.get("AUTH")[1])
+        if not res or data is None: return False, {}
         try:
-            res, msg = self.m.login(username, password)
+            return True, imapparse.parse_id(data)
+        except ValueError as info:
+            self.__verbose( '[ID] BAD: %s' % info )
+            return False, {}
+
+    def __login(self, function, command, username, sep):
+        """
+        Send a login command with the separator discovery pipelined,
+        unless sep is given or known for this server (see Separators)
+        """
+        if sep is None:
+            sep = Separators.get(self.SERVER)
+        try:
+            tag = self.m._command(*command)
+            if sep is None:
+                ### imaplib sends LIST only once authenticated, the
+                ### server fails it as well if the login fails
+                self.m.state = 'AUTH'
+                try:
+                    listtag = self.m._command('LIST', DQUOTE, DQUOTE)
+                finally:
+                    self.m.state = 'NONAUTH'
+            res, msg = self.m._complete(tag)
+            if sep is None:
+                lres, ldat = self.m._complete(listtag, 'LIST')
         except Exception as info:
-            error = info.args[0].split(':').pop().strip()
-            self.__doexception("LOGIN", error)
-        self.SEP = self.m.getsep()
+            self.__doexception(function, self.__error(info))
+        if not ok(res):
+            self.__doresponse(function, res, msg, username)
+        self.m.state = 'AUTH'
+        if sep is None:
+            sep = ok(lres) and listsep(ldat)
+            if sep:
+                Separators[self.SERVER] = sep
+            else:
+                sep = DEFAULT_SEP
+        self.__logged(username, msg, sep)
+        return res, msg
+
+    def __logged(self, username, msg, sep):
+        self.SEP = sep
         self.AUTH = True
         self.USERNAME = username
+        ### Cyrus sends the capabilities of the authenticated state
+        ### with the login response, METADATA included
+        match = re_capability.search(tostr(msg[0]))
+        if match:
+            self.CAPABILITY = self.m.capabilities = tuple(match.group(1).upper().split())
+
+    def login(self, username, password, forceNoAdmin = False, sep = None):
+        """
+        Login, with AUTHENTICATE PLAIN and its initial response if the
+        server takes it (SASL-IR), else with LOGIN. The separator
+        discovery is sent along unless sep is given or known for this
+        server: login takes one round trip.
+        """
+        if self.AUTH:
+            self.__doexception("LOGIN", self.ERROR.get("AUTH")[1])
+        if self.m.saslir():
+            command = ('AUTHENTICATE', 'PLAIN', b2a_base64(sasl_plain('', username, password)).strip())
+        else:
+            command = ('LOGIN', username, self.m._quote(password))
+        res, msg = self.__login("LOGIN", command, username, sep)
         self.__verbose( '[LOGIN %s] %s: %s' % (username, res, msg[0]) )
 
+    def login_plain(self, admin, password, asUser, sep = None):
+        """Login as asUser with the admin password, AUTHENTICATE PLAIN over TLS only"""
+        if self.AUTH:
+            self.__doexception("LOGINPLAIN", self.ERROR.get("AUTH")[1])
+        if not self.ssl:
+            self.__doexception("LOGINPLAIN", self.ERROR.get("LOGINPLAIN")[1])
+        response = sasl_plain(asUser, admin, password)
+        if self.m.saslir():
+            res, msg = self.__login("LOGIN_PLAIN", ('AUTHENTICATE', 'PLAIN', b2a_base64(response).strip()), admin, sep)
+        else:
+            ### the response waits for a continuation, nothing to pipeline
+            try:
+                res, msg = self.m.authenticate('PLAIN', lambda challenge: response)
+            except Exception as info:
+                self.__doexception("LOGIN_PLAIN", self.__error(info))
+            self.__logged(admin, msg, sep or Separators.get(self.SERVER) or self.m.getsep())
+        self.AUSER = asUser
+        self.__verbose( '[LOGIN_PLAIN %s as %s] %s: %s' % (admin, asUser, res, msg[0]) )
+
     def logout(self):
         try:
             res, msg = self.m.logout()
@@ -406,35 +984,21 @@ class CYRUS:
         else:
             raise self.__doraise("ENCODING")
 
-    def __encode(self, text):
-        if re.search("&", text):
-            text = re.sub("/", "+AC8-", text)
-            text = re.sub("&", "+", text)
-            text = str(text, 'utf-7').encode(self.ENCODING)
-        return text
-
+    ### Python strings are unicode, 'utf-8' and 'iso-8859-1' both
+    ### give decoded mailbox names
     def encode(self, text):
         text = self._normalize(text)
         if self.ENCODING == 'imap':
             return text
         elif self.ENCODING in self.ENCODING_LIST:
-            return self.__encode(text)
-
-    def __decode(self, text):
-        text = re.sub("/", "-&", text)
-        text = re.sub(" ", "-@", text)
-        text = str(text, self.ENCODING).encode('utf-7')
-        text = re.sub("-@", " ", text)
-        text = re.sub("-&", "/", text)
-        text = re.sub("\+", "&", text)
-        return text
+            return imaputf7.decode(text)
 
     def decode(self, text):
         text = self._unnormalize(text)
         if self.ENCODING == 'imap':
             return text
         elif self.ENCODING in self.ENCODING_LIST:
-            return self.__decode(text)
+            return imaputf7.encode(text)
 
     def lm(self, pattern="*"):
         """
@@ -450,106 +1014,337 @@ class CYRUS:
 
         """
         self.__prepare('LIST')
+        if self.TREE is None:
+            mbxList = self.iter_mailboxes(pattern)
+        else:
+            if self.TREE.expired():
+                self.refresh()
+            mbxList = [(self.encode(mailbox), flags)
+                       for mailbox, flags in self.TREE.match(self.decode(pattern or "*"))]
+        mb = []
+        for mailbox, flags in mbxList:
+            if 'Noselect' in flags: continue
+            mb.append(mailbox)
+        if not mb:
+            self.__verbose( '[LIST] No results' )
+        return mb
+
+    def setCache(self, mode, ttl=None):
+        """
+        Enable a local mailbox tree answering lm(), loaded with one
+        LIST and kept current by cm(), dm(), rename() and provision().
+        It is reloaded after ttl seconds, or only by refresh() if ttl
+        is None. The encoding and normalization apply as without it.
+        """
+        if mode:
+            self.TREE = MailboxTree(ttl)
+        else:
+            self.TREE = None
+
+    def refresh(self, mailbox=None):
+        """Reload the mailbox tree, or only mailbox and its children"""
+        if self.TREE is None:
+            return
+        if mailbox is None:
+            self.TREE.load(self.__iter_list("*"), self.SEP)
+            return
+        self.TREE.remove(self.decode(mailbox), True)
+        for pattern in (mailbox, "%s%s*" % (mailbox, self.SEP)):
+            for mbx, flags in self.__iter_list(pattern):
+                self.TREE.add(mbx, flags)
+
+    def iter_mailboxes(self, pattern="*"):
+        """
+        Generator variant of lm(), yields (mailbox, flags) while the
+        LIST response is read off the socket. Unlike lm(), Noselect
+        mailboxes are yielded too.
+
+        Other commands may be sent while it runs, e.g. lam() of each
+        mailbox: the rest of the LIST response is then read into memory
+        first, so the generator no longer streams.
+        """
+        for mailbox, flags in self.__iter_list(pattern):
+            yield self.encode(mailbox), flags
+
+    def __iter_list(self, pattern):
+        """(mailbox, flags) of LIST pattern, names as the server sends them"""
+        self.__prepare('LIST')
         if pattern == '': pattern = "*"
         if pattern == '%':
-            res, ml = self.__docommand('list', '', '%')
+            args = (DQUOTE, '%')
         else:
-            res, ml = self.__docommand('list', '*', self.decode(pattern))
+            args = ('*', self.decode(pattern))
+        for typ, data in self.__stream('LIST', *args):
+            if typ != 'LIST': continue
+            try:
+                flags, sep, mailbox = imapparse.parse_list(data)
+            except ValueError:
+                continue
+            yield mailbox, flags
 
+    def __stream(self, command, *args):
+        """Send command, yields its untagged (type, data) as they are read"""
+        try:
+            tag = self.m._command(command, *args)
+        except Exception as info:
+            self.__doexception(command, self.__error(info), *args)
+        responses = Responses(self.m, tag)
+        try:
+            for typ, data in responses:
+                yield typ, data
+        finally:
+            # Generator closed early, skip the rest of the response
+            for typ, data in responses: pass
+        res, msg = responses.result
         if not ok(res):
-            self.__verbose( '[LIST] %s: %s' % (res, ml) )
-            return []
-
-        if (len(ml) == 1) and ml[0] is None:
-            self.__verbose( '[LIST] No results' )
-            return []
+            self.__doexception(command, msg, *args)
 
-        mb = []
-        for mailbox in ml:
-            mailbox = mailbox.decode()
-            res = re_mb.match(mailbox)
-            if res is None: continue
-            mbe = unquote(res.group(2))
-            if 'Noselect' in getflags(res.group(1)): continue
-            mb.append(self.encode(mbe))
-        return mb
+    def provision(self, specs):
+        """
+        Create and set up many mailboxes, pipelining the commands
+
+        specs is a list of dicts with the keys:
+            mailbox         mailbox name
+            partition       partition (optional)
+            acl             dict of {userid: rights} (optional)
+            quota           quota in Kbytes, 0 for unlimited (optional)
+            annotations     dict of {annotation: value} (optional)
+
+        Returns a dict of {mailbox: (ok, error)}, error is the first
+        failed command of that mailbox. Failures do not raise CYRUSError,
+        a mailbox given in more than one spec does before any command.
+        """
+        self.__prepare('PROVISION')
+        seen = set()
+        for spec in specs:
+            if spec['mailbox'] in seen:
+                self.__verbose( '[PROVISION %s] BAD: %s' % (spec['mailbox'], self.ERROR.get("PROVISION")[1]) )
+                self.__doraise("PROVISION", '%s: %s' % (self.ERROR.get("PROVISION")[1], spec['mailbox']))
+            seen.add(spec['mailbox'])
+        result = {}
+        commands = []
+        for spec in specs:
+            mailbox = spec['mailbox']
+            result[mailbox] = (True, None)
+            commands.append((mailbox, ('CREATE', self.decode(mailbox), spec.get('partition'))))
+        self.__pipelineresult(commands, result)
+
+        # Setup only the mailboxes created above
+        commands = []
+        for spec in specs:
+            mailbox = spec['mailbox']
+            if not result[mailbox][0]:
+                continue
+            mbx = self.decode(mailbox)
+            if self.TREE is not None:
+                self.TREE.add(mbx)
+            for userid, rights in spec.get('acl', {}).items():
+                commands.append((mailbox, ('SETACL', mbx, userid, rights)))
+            if spec.get('quota') is not None:
+                try:
+                    limit = int(spec['quota'])
+                except ValueError:
+                    result[mailbox] = (False, 'SETQUOTA: %s %s' % (self.ERROR.get("SETQUOTA")[1], spec['quota']))
+                    continue
+                commands.append((mailbox, ('SETQUOTA', mbx, quotalist(limit))))
+            for annotation, value in spec.get('annotations', {}).items():
+                commands.append((mailbox, ('SETANNOTATION', mbx, quote(annotation), annotationlist(value))))
+        return self.__pipelineresult(commands, result)
 
     def cm(self, mailbox, partition=None):
         """Create mailbox"""
         self.__prepare('CREATE', mailbox)
         res, msg = self.__docommand('create', self.decode(mailbox), partition)
+        if self.TREE is not None:
+            self.TREE.add(self.decode(mailbox))
         self.__verbose( '[CREATE %s partition=%s] %s: %s' % (mailbox, partition, res, msg[0]) )
 
-    def __dm(self, mailbox):
-        if not mailbox:
-            return True
-        self.__docommand("setacl", self.decode(mailbox), self.USERNAME, self.ADMINACL)
-        res, msg = self.__docommand("delete", self.decode(mailbox))
-        self.__verbose( '[DELETE %s] %s: %s' % (mailbox, res, msg[0]) )
+    def __dm(self, mbxList, failures):
+        """Pipeline SETACL and DELETE of the mailboxes"""
+        result = {}
+        commands = []
+        for mailbox in mbxList:
+            result[mailbox] = (True, None)
+            # Skip SETACL if a previous lam() shows we already have the right
+            if self.ADMINACL not in self.ACLS.get(mailbox, {}).get(self.USERNAME, ''):
+                commands.append((mailbox, ('SETACL', self.decode(mailbox), self.USERNAME, self.ADMINACL)))
+            commands.append((mailbox, ('DELETE', self.decode(mailbox))))
+        self.__pipelineresult(commands, result, failures)
+        for mailbox in mbxList:
+            if result[mailbox][0]:
+                self.__uncache(mailbox)
+                if self.TREE is not None:
+                    # Cyrus deletes the children of user mailboxes
+                    mbxTmp = mailbox.split(self.SEP)
+                    self.TREE.remove(self.decode(mailbox), mbxTmp[0] == "user" and len(mbxTmp) == 2)
+        return result
 
     def dm(self, mailbox, recursive=True):
-        """Delete mailbox"""
+        """
+        Delete mailbox, returns a dict of {mailbox: (ok, error)}
+
+        Children are deleted before parents, one pipelined wave per
+        hierarchy level. A failed child does not raise CYRUSError,
+        only a failure to delete mailbox itself does.
+        """
         self.__prepare('DELETE', mailbox)
+        mbxList = []
         mbxTmp = mailbox.split(self.SEP)
         # Cyrus is not recursive for user subfolders and global folders
         if (recursive and mbxTmp[0] != "user") or (len(mbxTmp) > 2):
             mbxList = self.lm("%s%s*" % (mailbox, self.SEP))
-            mbxList.reverse()
-            for mbox in mbxList:
-                self.__dm(mbox)
-        self.__dm(mailbox)
+        waves = {}
+        for mbox in mbxList + [mailbox]:
+            waves.setdefault(mbox.count(self.SEP), []).append(mbox)
+        result = {}
+        failures = {}
+        for depth in sorted(waves, reverse=True):
+            result.update(self.__dm(waves[depth], failures))
+        ### the error of the command which failed, SETACL or DELETE
+        if mailbox in failures:
+            command, status, msg = failures[mailbox]
+            self.__doresponse(command, status, [msg], mailbox)
+        return result
  
     def rename(self, fromMbx, toMbx, partition=None):
         """Rename or change partition"""
         self.__prepare('RENAME', fromMbx)
         # Rename is recursive! Amen!
         res, msg = self.__docommand("rename", self.decode(fromMbx), self.decode(toMbx), partition)
+        self.__uncache(fromMbx)
+        if self.TREE is not None:
+            self.TREE.rename(self.decode(fromMbx), self.decode(toMbx))
         self.__verbose( '[RENAME %s %s] %s: %s' % (fromMbx, toMbx, res, msg[0]) )
 
+    def __uncache(self, mailbox):
+        """Forget cached ACLs of mailbox and its children"""
+        prefix = mailbox + self.SEP
+        for mbox in [m for m in self.ACLS if m == mailbox or m.startswith(prefix)]:
+            del self.ACLS[mbox]
+
     def lam(self, mailbox):
         """List ACLs"""
         self.__prepare('GETACL', mailbox)
         res, acl = self.__docommand("getacl", self.decode(mailbox))
         acls = {}
-        aclList = splitquote(acl.pop().strip())
-        del aclList[0] # mailbox
-        for i in range(0, len(aclList), 2):
-            try:
-                userid = self.encode(aclList[i])
-                rights = aclList[i + 1]
-            except Exception as info:
-                self.__verbose( '[GETACL %s] BAD: %s' % (mailbox, info.args[0]) )
-                raise self.__doraise("GETACL")
-            self.__verbose( '[GETACL %s] %s %s' % (mailbox, userid, rights) )
-            acls[userid] = rights
+        try:
+            rights = imapparse.parse_acl(list(imapparse.responses(acl)).pop()).rights
+        except (IndexError, ValueError) as info:
+            self.__verbose( '[GETACL %s] BAD: %s' % (mailbox, info) )
+            raise self.__doraise("GETACL")
+        for userid in rights:
+            self.__verbose( '[GETACL %s] %s %s' % (mailbox, userid, rights[userid]) )
+            acls[self.encode(userid)] = rights[userid]
+        self.ACLS[mailbox] = dict(acls)
         return acls
 
     def sam(self, mailbox, userid, rights):
         """Set ACL"""
         self.__prepare('SETACL', mailbox)
         res, msg = self.__docommand("setacl", self.decode(mailbox), userid, rights)
+        self.ACLS.pop(mailbox, None)
         self.__verbose( '[SETACL %s %s %s] %s: %s' % (mailbox, userid, rights, res, msg[0]) )
 
+    def acl_scan(self, pattern="*"):
+        """
+        ACLs of every mailbox matching pattern, GETACL commands are
+        pipelined. Yields (mailbox, {userid: rights}), a mailbox
+        whose GETACL failed is skipped.
+        """
+        self.__prepare('GETACL')
+        mbxList = self.lm(pattern)
+        for i in range(0, len(mbxList), self.PIPELINE):
+            window = mbxList[i:i + self.PIPELINE]
+            self.m.untagged_responses.pop('ACL', None)
+            self.__pipeline([('GETACL', self.decode(mailbox)) for mailbox in window])
+            acls = {}
+            for data in imapparse.responses(self.m.untagged_responses.pop('ACL', [])):
+                try:
+                    mbx, rights = imapparse.parse_acl(data)
+                except (IndexError, ValueError):
+                    continue
+                acls[self.encode(mbx)] = dict([(self.encode(userid), rights[userid]) for userid in rights])
+            for mailbox in window:
+                if mailbox in acls:
+                    yield mailbox, acls[mailbox]
+
+    def __bulkacl(self, command, pattern, *args):
+        self.__prepare(command, pattern)
+        result = {}
+        commands = []
+        for mailbox in self.lm(pattern):
+            result[mailbox] = (True, None)
+            commands.append((mailbox, (command, self.decode(mailbox)) + args))
+            self.ACLS.pop(mailbox, None)
+        return self.__pipelineresult(commands, result)
+
+    def bulk_setacl(self, pattern, userid, rights):
+        """
+        Set ACL of every mailbox matching pattern, pipelined.
+        Returns a dict of {mailbox: (ok, error)}.
+        """
+        return self.__bulkacl('SETACL', pattern, userid, rights)
+
+    def bulk_deleteacl(self, pattern, userid):
+        """
+        Remove userid from the ACL of every mailbox matching pattern,
+        pipelined. Returns a dict of {mailbox: (ok, error)}.
+        """
+        return self.__bulkacl('DELETEACL', pattern, userid)
+
     def lq(self, mailbox):
         """List Quota"""
         self.__prepare('GETQUOTA', mailbox)
         res, msg = self.__docommand("getquota", self.decode(mailbox))
-        match = re_q0.match(msg[0])
-        if match:
-            self.__verbose( '[GETQUOTA %s] QUOTA (Unlimited)' % mailbox )
-            return 0, 0
-        match = re_q.match(msg[0])
-        if match is None:
-            self.__verbose( '[GETQUOTA %s] BAD: RegExp not matched, please report' % mailbox )
-            return 0, 0
         try:
-            used = int(match.group(2))
-            quota = int(match.group(3))
-            self.__verbose( '[GETQUOTA %s] %s: QUOTA (%d/%d)' % (mailbox, res, used, quota) )
-            return used, quota
-        except:
+            root, quota = imapparse.parse_quota(msg[0])
+        except (TypeError, ValueError):
             self.__verbose( '[GETQUOTA %s] BAD: Error while parsing results' % mailbox )
             return 0, 0
+        if 'STORAGE' not in quota:
+            self.__verbose( '[GETQUOTA %s] QUOTA (Unlimited)' % mailbox )
+            return 0, 0
+        used, quota = quota['STORAGE']
+        self.__verbose( '[GETQUOTA %s] %s: QUOTA (%d/%d)' % (mailbox, res, used, quota) )
+        return used, quota
+
+    def quota_report(self, pattern="user/%"):
+        """
+        Quota of every mailbox matching pattern, GETQUOTAROOT commands
+        are pipelined. Yields (mailbox, used, limit) where used and
+        limit are dicts by resource, eg. {'STORAGE': 10, 'MESSAGE': 2},
+        empty when the mailbox has no quota. A mailbox whose
+        GETQUOTAROOT failed is skipped.
+        """
+        self.__prepare('GETQUOTAROOT')
+        mbxList = self.lm(pattern)
+        for i in range(0, len(mbxList), self.PIPELINE):
+            window = mbxList[i:i + self.PIPELINE]
+            self.m.untagged_responses.pop('QUOTAROOT', None)
+            self.m.untagged_responses.pop('QUOTA', None)
+            results = self.__pipeline([('GETQUOTAROOT', self.decode(mailbox)) for mailbox in window])
+            quotas = {}
+            for data in imapparse.responses(self.m.untagged_responses.pop('QUOTA', [])):
+                try:
+                    root, quota = imapparse.parse_quota(data)
+                except (TypeError, ValueError):
+                    continue
+                quotas[root] = quota
+            roots = {}
+            for data in imapparse.responses(self.m.untagged_responses.pop('QUOTAROOT', [])):
+                try:
+                    mbx, mbxroots = imapparse.parse_quotaroot(data)
+                except (TypeError, ValueError):
+                    continue
+                if mbxroots:
+                    roots[self.encode(mbx)] = mbxroots[0]
+            for mailbox, (res, msg, status) in zip(window, results):
+                if not res: continue
+                quota = quotas.get(roots.get(mailbox), {})
+                used = dict([(res, quota[res][0]) for res in quota])
+                limit = dict([(res, quota[res][1]) for res in quota])
+                self.__verbose( '[GETQUOTAROOT %s] QUOTA %s/%s' % (mailbox, used, limit) )
+                yield mailbox, used, limit
 
     def sq(self, mailbox, limit):
         """Set Quota"""
@@ -559,25 +1354,27 @@ class CYRUS:
         except ValueError as e:
             self.__verbose( '[SETQUOTA %s] BAD: %s %s' % (mailbox, self.ERROR.get("SETQUOTA")[1], limit) )
             raise self.__doraise("SETQUOTA")
-        res, msg = self.__docommand("setquota", self.decode(mailbox), limit)
+        res, msg = self.__docommand("setquota", self.decode(mailbox), quotalist(limit))
         self.__verbose( '[SETQUOTA %s %s] %s: %s' % (mailbox, limit, res, msg[0]) )
 
     def getannotation(self, mailbox, pattern='*'):
         """Get Annotation"""
         self.__prepare('GETANNOTATION')
-        res, data = self.__docommand('getannotation', self.decode(mailbox), pattern)
+        res, data = self.__docommand('getannotation', self.decode(mailbox), quote(pattern), quote('value.shared'))
         if (len(data) == 1) and data[0] is None:
             self.__verbose( '[GETANNOTATION %s] No results' % (mailbox) )
             return {}
         ann = {}
-        for annotation in data:
-            annotation = annotation.split('"')
-            if len(annotation) != 9:
+        for annotation in imapparse.responses(data):
+            try:
+                mbx, key, attributes = imapparse.parse_annotation(annotation)
+            except ValueError:
+                attributes = {}
+            if 'value.shared' not in attributes:
                 self.__verbose( '[GETANNOTATION] Invalid annotation entry' )
                 continue
-            mbx = self.encode(annotation[1])
-            key = annotation[3]
-            value = annotation[7]
+            mbx = self.encode(mbx)
+            value = attributes['value.shared']
             self.__verbose( '[GETANNOTATION %s] %s: %s' % (mbx, key, value) )
             if mbx not in ann:
                 ann[mbx] = {}
@@ -588,9 +1385,111 @@ class CYRUS:
     def setannotation(self, mailbox, annotation, value):
         """Set Annotation"""
         self.__prepare('SETANNOTATION')
-        res, msg = self.__docommand("setannotation", self.decode(mailbox), annotation, value)
+        res, msg = self.__docommand("setannotation", self.decode(mailbox), quote(annotation), annotationlist(value))
         self.__verbose( '[SETANNOTATION %s] %s: %s' % (mailbox, res, msg[0]) )
 
+    def instrument(self, instrument):
+        """Add an instrument called for each IMAP command, see cyrusmetrics"""
+        self.m.instrument(instrument)
+
+    def setMetadata(self, mode):
+        """Use METADATA (RFC 5464) instead of ANNOTATEMORE, None detects"""
+        if mode is None or type(True) == type(mode):
+            self.METADATA = mode
+
+    def __metadata(self):
+        if self.METADATA is None and self.CAPABILITY is not None:
+            self.METADATA = 'METADATA' in self.CAPABILITY
+        elif self.METADATA is None:
+            try:
+                res, data = self.m.capability()
+                self.METADATA = 'METADATA' in tostr(data[-1]).upper().split()
+            except Exception:
+                self.METADATA = False
+            self.__verbose( '[CAPABILITY] METADATA: %s' % self.METADATA )
+        return self.METADATA
+
+    def iter_annotations(self, mailbox="*", pattern="*"):
+        """
+        Generator variant of getannotation(), yields (mailbox, entry,
+        value) while the response is read off the socket. mailbox may
+        be a LIST pattern.
+        With METADATA, the matching mailboxes are listed and GETMETADATA
+        is pipelined, entries are still reported by annotation name.
+        Other commands sent while it runs buffer the responses of the
+        pending window, as for iter_mailboxes().
+        """
+        self.__prepare('GETANNOTATION')
+        if not self.__metadata():
+            for typ, data in self.__stream('GETANNOTATION', self.decode(mailbox), quote(pattern), quote('value.shared')):
+                if typ != 'ANNOTATION': continue
+                try:
+                    mbx, entry, attributes = imapparse.parse_annotation(data)
+                except ValueError:
+                    continue
+                if attributes.get('value.shared') is not None:
+                    yield self.encode(mbx), entry, attributes['value.shared']
+            return
+        if re.search(r'[*%]', mailbox):
+            mbxList = self.lm(mailbox)
+        else:
+            mbxList = [mailbox]
+        entry, depth, regex = metadatapattern(pattern)
+        for i in range(0, len(mbxList), self.PIPELINE):
+            window = []
+            try:
+                for mbx in mbxList[i:i + self.PIPELINE]:
+                    window.append(Responses(self.m, self.m._command('GETMETADATA', '(DEPTH %s)' % depth, self.decode(mbx), quote(entry))))
+            except Exception as info:
+                self.__doexception('GETMETADATA', self.__error(info))
+            try:
+                for responses in window:
+                    for typ, data in responses:
+                        if typ != 'METADATA': continue
+                        try:
+                            mbx, entries = imapparse.parse_metadata(data)
+                        except ValueError:
+                            continue
+                        for name, value in entries.items():
+                            if value is None or not name.startswith(SHARED + '/'): continue
+                            name = name[len(SHARED):]
+                            if regex is None or regex.match(name):
+                                yield self.encode(mbx), name, value
+                    res, msg = responses.result
+                    if not ok(res):
+                        self.__verbose( '[GETMETADATA] %s: %s' % (res, msg) )
+            finally:
+                # Generator closed early, skip the rest of the window
+                for responses in window:
+                    for typ, data in responses: pass
+
+    def set_annotations(self, mapping):
+        """
+        Set many annotations, pipelining the commands
+
+        mapping is a dict of {mailbox: {entry: value}}, an empty value
+        removes the annotation. Returns a dict of
+        {(mailbox, entry): (ok, error)}, failures do not raise CYRUSError.
+        """
+        self.__prepare('SETANNOTATION')
+        metadata = self.__metadata()
+        keys = []
+        commands = []
+        for mailbox in mapping:
+            for entry, value in mapping[mailbox].items():
+                keys.append((mailbox, entry))
+                if metadata:
+                    commands.append(('SETMETADATA', self.decode(mailbox), metadatalist(entry, value)))
+                else:
+                    commands.append(('SETANNOTATION', self.decode(mailbox), quote(entry), annotationlist(value)))
+        result = {}
+        for key, command, (res, msg, status) in zip(keys, commands, self.__pipeline(commands)):
+            if res:
+                result[key] = (True, None)
+            else:
+                result[key] = (False, '%s: %s' % (command[0], msg))
+        return result
+
     def __reconstruct(self, mailbox):
         if not mailbox:
             return True
@@ -624,11 +1523,12 @@ class CYRUS:
             return []
 
         mb = []
-        for mailbox in ml:
-            res = re_mb.match(mailbox)
-            if res is None: continue
-            mbe = unquote(res.group(2))
-            if 'Noselect' in getflags(res.group(1)): continue
+        for mailbox in imapparse.responses(ml):
+            try:
+                flags, sep, mbe = imapparse.parse_list(mailbox)
+            except ValueError:
+                continue
+            if 'Noselect' in flags: continue
             mb.append(self.encode(mbe))
         return mb
 
@@ -648,3 +1548,221 @@ class CYRUS:
         res, msg = self.__docommand("unsubscribe", self.decode(mailbox))
         self.__verbose( '[UNSUBSCRIBE %s] %s: %s' % (mailbox, res, msg[0]) )
 
+
+
+class CyrusPool:
+    """
+    Pool of authenticated CYRUS sessions for one URL and credential
+
+    Sessions are checked with NOOP when taken from the pool and
+    replaced if the connection was dropped. The separator is learned
+    by the first session and reused by the others. TLS sessions share
+    ssl_context and resume the TLS session of the previous connection.
+
+        pool = CyrusPool("imaps://127.0.0.1:993", "admin", "password", 8)
+        with pool.session() as imap:
+            imap.lm("user/%")
+        pool.call("sq", "user/rei", 10240)
+    """
+
+    def __init__(self, url, username, password, size=4, timeout=None, ssl_context=None):
+        self.url = url
+        self.ssl_context = ssl_context
+        self.username = username
+        self.password = password
+        self.size = size
+        self.timeout = timeout
+        self.SEP = None
+        self.idle = []
+        self.count = 0 # sessions idle or checked out
+        self.cond = threading.Condition()
+        self.instruments = []
+
+    def instrument(self, instrument):
+        """Add an instrument to the sessions opened from now on"""
+        self.instruments.append(instrument)
+
+    def __connect(self):
+        imap = CYRUS(self.url, self.ssl_context)
+        for instrument in self.instruments:
+            imap.instrument(instrument)
+        imap.login(self.username, self.password, sep=self.SEP)
+        self.SEP = imap.SEP
+        return imap
+
+    def __alive(self, imap):
+        try:
+            return ok(imap.m.noop()[0])
+        except (imaplib.IMAP4.error, OSError):
+            return False
+
+    def __close(self, imap):
+        # Don't let __del__ logout from a dead connection
+        imap.AUTH = False
+        try:
+            imap.m.shutdown()
+        except Exception:
+            pass
+
+    def get(self):
+        """Check out a session, waiting while size sessions are in use"""
+        with self.cond:
+            while not self.idle and self.count >= self.size:
+                if not self.cond.wait(self.timeout):
+                    raise CYRUSError(CYRUS.ERROR["POOL"][0], "POOL", CYRUS.ERROR["POOL"][1])
+            if self.idle:
+                imap = self.idle.pop()
+            else:
+                imap = None
+                self.count += 1
+        if imap is not None:
+            if self.__alive(imap):
+                return imap
+            self.__close(imap)
+        try:
+            return self.__connect()
+        except:
+            with self.cond:
+                self.count -= 1
+                self.cond.notify()
+            raise
+
+    def put(self, imap):
+        """Return a session to the pool"""
+        with self.cond:
+            self.idle.append(imap)
+            self.cond.notify()
+
+    @contextmanager
+    def session(self):
+        imap = self.get()
+        try:
+            yield imap
+        finally:
+            self.put(imap)
+
+    def call(self, method, *args, **kwargs):
+        """
+        Run a CYRUS method on a pooled session, reconnecting and
+        retrying once if it failed because the connection was dropped
+        """
+        imap = self.get()
+        try:
+            try:
+                return getattr(imap, method)(*args, **kwargs)
+            except CYRUSError:
+                if self.__alive(imap):
+                    raise
+            self.__close(imap)
+            imap = self.__connect()
+            return getattr(imap, method)(*args, **kwargs)
+        finally:
+            self.put(imap)
+
+    def reconstruct(self, mailbox, recursive=True, concurrency=None, progress=None):
+        """
+        Reconstruct mailbox, its children are spread over up to
+        concurrency pooled sessions (default: the pool size) and the
+        mailbox itself is reconstructed last.
+
+        progress(mailbox, ok, done, total) is called from the worker
+        threads after each mailbox. Returns {mailbox: (ok, error)}.
+        """
+        mbxList = []
+        if recursive:
+            with self.session() as imap:
+                mbxList = imap.lm("%s%s*" % (mailbox, imap.SEP))
+        total = len(mbxList) + 1
+        result = {}
+        lock = threading.Lock()
+
+        def run(mbox):
+            try:
+                self.call('reconstruct', mbox, False)
+                res = (True, None)
+            except CYRUSError as info:
+                res = (False, '%s: %s' % (info.args[1], info.args[2]))
+            with lock:
+                result[mbox] = res
+                done = len(result)
+            if progress is not None:
+                progress(mbox, res[0], done, total)
+
+        if mbxList:
+            with ThreadPoolExecutor(min(concurrency or self.size, self.size)) as executor:
+                list(executor.map(run, mbxList))
+        run(mailbox)
+        return result
+
+    def close(self):
+        """Logout idle sessions"""
+        with self.cond:
+            idle, self.idle = self.idle, []
+            self.count -= len(idle)
+        for imap in idle:
+            try:
+                imap.logout()
+            except Exception:
+                self.__close(imap)
+
+
+class CyrusCluster:
+    """
+    Run the same CYRUS method on several backends concurrently
+
+        cluster = CyrusCluster(["imaps://be1:993", "imaps://be2:993"], "admin", "password")
+        cluster.lm("user/%")
+        > {'be1:993': ['user/rei', ...], 'be2:993': [...]}
+
+    Results are keyed by host:port, two URLs of the same host:port
+    raise CYRUSError INVALID_URL. A backend failing with CYRUSError
+    has the exception as its result, the other backends are not affected.
+    Each backend has a CyrusPool of size sessions.
+    """
+
+    def __init__(self, urls, username, password, size=1, ssl_context=None):
+        self.pools = {}
+        for url in urls:
+            match = re_url.match(url)
+            if not match:
+                raise CYRUSError(CYRUS.ERROR["INVALID_URL"][0], "INVALID_URL", url)
+            port = int(match.group(3) or 143)
+            host = "%s:%d" % (match.group(2), port)
+            if host in self.pools:
+                raise CYRUSError(CYRUS.ERROR["INVALID_URL"][0], "INVALID_URL",
+                                 "%s: %s and %s" % (host, self.pools[host].url, url))
+            self.pools[host] = CyrusPool(url, username, password, size, ssl_context=ssl_context)
+        self.executor = ThreadPoolExecutor(max(1, len(self.pools) * size))
+
+    def __call(self, pool, method, args, kwargs):
+        try:
+            return pool.call(method, *args, **kwargs)
+        except CYRUSError as info:
+            return info
+
+    def call(self, method, *args, **kwargs):
+        """Run method on every backend, returns {host: result}"""
+        futures = {}
+        for host, pool in self.pools.items():
+            futures[host] = self.executor.submit(self.__call, pool, method, args, kwargs)
+        return dict([(host, future.result()) for host, future in futures.items()])
+
+    def lm(self, pattern="*"):
+        return self.call('lm', pattern)
+
+    def lam(self, mailbox):
+        return self.call('lam', mailbox)
+
+    def lq(self, mailbox):
+        return self.call('lq', mailbox)
+
+    def getannotation(self, mailbox, pattern='*'):
+        return self.call('getannotation', mailbox, pattern)
+
+    def reconstruct(self, mailbox, recursive=True):
+        return self.call('reconstruct', mailbox, recursive)
+
+    def close(self):
+        self.executor.shutdown()
+        for pool in self.pools.values():
+            pool.close()
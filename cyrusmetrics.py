@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kedros, a.s. www.kedros.sk
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA.
+#
+
+__all__ = [ 'Event', 'Hook', 'Metrics' ]
+__doc__ = """Per-command instrumentation
+
+An instrument is any object with start(event) and end(event) methods,
+added with CYRUS.instrument() or MANAGESIEVE.instrument(). Both are
+called for every command sent, with an Event:
+
+    protocol  'imap' or 'sieve'
+    command   IMAP or MANAGESIEVE command name, e.g. 'GETACL'
+    mailbox   mailbox argument as sent (the script name for MANAGESIEVE)
+    sent      bytes sent for the command
+    received  bytes received until its response completed
+    latency   seconds from sending the command to its response
+    result    'OK', 'NO', 'BAD', 'BYE' or 'ABORT' (connection lost)
+
+start() gets the protocol, command and mailbox only. Instruments are
+called from the thread running the command. Metrics keeps counters and
+latency histograms per command, Hook wraps plain functions.
+
+    metrics = cyrusmetrics.Metrics()
+    imap.instrument(metrics)
+    imap.dm("user/rei")
+    print(metrics.prometheus())
+
+"""
+
+import threading
+from collections import namedtuple
+
+Event = namedtuple('Event', 'protocol command mailbox sent received latency result')
+
+### latency histogram upper bounds, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Hook:
+    """Instrument calling start(event) and end(event) functions"""
+
+    def __init__(self, start=None, end=None):
+        self.__start = start
+        self.__end = end
+
+    def start(self, event):
+        if self.__start is not None:
+            self.__start(event)
+
+    def end(self, event):
+        if self.__end is not None:
+            self.__end(event)
+
+
+class Metrics:
+    """
+    Instrument counting commands, results, bytes and latency per
+    (protocol, command). One Metrics may be shared by the connections
+    of a pool.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.commands = {} # (protocol, command): stats dict
+
+    def start(self, event):
+        pass
+
+    def end(self, event):
+        key = (event.protocol, event.command)
+        with self.lock:
+            stats = self.commands.get(key)
+            if stats is None:
+                stats = self.commands[key] = {
+                    'count': 0, 'results': {}, 'sent': 0, 'received': 0,
+                    'seconds': 0.0, 'max': 0.0, 'buckets': [0] * len(self.buckets)}
+            stats['count'] += 1
+            stats['results'][event.result] = stats['results'].get(event.result, 0) + 1
+            stats['sent'] += event.sent or 0
+            stats['received'] += event.received or 0
+            latency = event.latency or 0.0
+            stats['seconds'] += latency
+            if latency > stats['max']:
+                stats['max'] = latency
+            for i, bound in enumerate(self.buckets):
+                if latency <= bound:
+                    stats['buckets'][i] += 1
+                    break
+
+    def as_dict(self):
+        """
+        {protocol: {command: stats}}, stats with count, results
+        {result: count}, sent, received, seconds (total), max and
+        buckets {upper bound: count}, cumulative as in Prometheus
+        """
+        res = {}
+        with self.lock:
+            for (protocol, command), stats in self.commands.items():
+                buckets = {}
+                total = 0
+                for bound, count in zip(self.buckets, stats['buckets']):
+                    total += count
+                    buckets[bound] = total
+                buckets[float('inf')] = stats['count']
+                res.setdefault(protocol, {})[command] = dict(stats,
+                    results=dict(stats['results']), buckets=buckets)
+        return res
+
+    def prometheus(self, prefix='cyrus'):
+        """Metrics in the Prometheus text exposition format"""
+        stats = self.as_dict()
+        series = [(protocol, command, stats[protocol][command])
+                  for protocol in sorted(stats) for command in sorted(stats[protocol])]
+        lines = []
+
+        def family(name, typ, text):
+            lines.append('# HELP %s_%s %s' % (prefix, name, text))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, typ))
+
+        family('commands_total', 'counter', 'Commands by response result')
+        for protocol, command, stat in series:
+            for result in sorted(stat['results']):
+                lines.append('%s_commands_total{protocol="%s",command="%s",result="%s"} %d' % (
+                    prefix, protocol, command, result, stat['results'][result]))
+        for name, key, text in (('sent_bytes_total', 'sent', 'Bytes sent for commands'),
+                                ('received_bytes_total', 'received', 'Bytes received for responses')):
+            family(name, 'counter', text)
+            for protocol, command, stat in series:
+                lines.append('%s_%s{protocol="%s",command="%s"} %d' % (
+                    prefix, name, protocol, command, stat[key]))
+        family('command_seconds', 'histogram', 'Command round trip latency')
+        for protocol, command, stat in series:
+            labels = 'protocol="%s",command="%s"' % (protocol, command)
+            for bound, count in stat['buckets'].items():
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_command_seconds_bucket{%s,le="%s"} %d' % (prefix, labels, le, count))
+            lines.append('%s_command_seconds_sum{%s} %r' % (prefix, labels, stat['seconds']))
+            lines.append('%s_command_seconds_count{%s} %d' % (prefix, labels, stat['count']))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kedros, a.s. www.kedros.sk
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA.
+#
+
+__all__ = [ 'tokenize', 'responses', 'parse_list', 'parse_acl', 'parse_quota',
+            'parse_quotaroot', 'parse_annotation', 'parse_metadata',
+            'parse_id' ]
+__doc__ = """IMAP untagged response parser
+
+tokenize() splits the data of an untagged response, as bytes or
+memoryview, in one pass: atoms and quoted strings become bytes, NIL
+becomes None, parenthesized lists become lists and {n} literal markers
+take the next payload of literals. The parse_*() functions return
+typed records with str fields for the responses used by cyruslib,
+responses() joins the pieces of a response imaplib split on literals.
+
+    parse_list(b'(\\\\HasNoChildren) "/" "user/rei"')
+    > List(flags=['HasNoChildren'], sep='/', mailbox='user/rei')
+
+"""
+
+import re
+from collections import namedtuple
+
+re_token = re.compile(br'[ \t]*(?:(\()|(\))|"([^"\\]*(?:\\.[^"\\]*)*)"|\{(\d+)\+?\}|([^ \t()"{]+))', re.S)
+re_esc   = re.compile(br'\\(.)', re.S)
+# the usual LIST response, anything else goes through tokenize()
+re_list  = re.compile(br'\(([^)]*)\) (?:"(\\?.)"|NIL) (?:"([^"\\]*(?:\\.[^"\\]*)*)"|([^ "(){]+))$')
+# ACL and ANNOTATION responses without escapes or literals
+re_word  = re.compile(r'"[^"]*"|[^ ()\r\n]+')
+re_ann   = re.compile(r'"([^"]*)" "([^"]*)" \(([^()]*)\)$')
+
+List       = namedtuple('List', 'flags sep mailbox')
+Acl        = namedtuple('Acl', 'mailbox rights')
+Quota      = namedtuple('Quota', 'root resources')
+QuotaRoot  = namedtuple('QuotaRoot', 'mailbox roots')
+Annotation = namedtuple('Annotation', 'mailbox entry attributes')
+Metadata   = namedtuple('Metadata', 'mailbox entries')
+
+def tokenize(data, literals=()):
+    literals = iter(literals)
+    match = re_token.match
+    res = []
+    stack = []
+    pos = 0
+    end = len(data)
+    while end and data[end - 1] in b' \t\r\n':
+        end -= 1
+    while pos < end:
+        mo = match(data, pos, end)
+        if mo is None:
+            raise ValueError('unexpected data: %r' % bytes(data[pos:end]))
+        pos = mo.end()
+        group = mo.lastindex
+        if group == 5:
+            atom = mo.group(5)
+            res.append(None if atom.upper() == b'NIL' else atom)
+        elif group == 3:
+            text = mo.group(3)
+            if b'\\' in text:
+                text = re_esc.sub(br'\1', text)
+            res.append(text)
+        elif group == 1:
+            stack.append(res)
+            res.append([])
+            res = res[-1]
+        elif group == 2:
+            if not stack:
+                raise ValueError('unmatched ): %r' % bytes(data[:end]))
+            res = stack.pop()
+        else:
+            literal = next(literals, None)
+            if literal is None:
+                raise ValueError('missing literal: %r' % bytes(data[:end]))
+            res.append(bytes(literal))
+    if stack:
+        raise ValueError('unmatched (: %r' % bytes(data[:end]))
+    return res
+
+def text(value):
+    if value is None:
+        return None
+    return value.decode()
+
+def untagged(item):
+    """Tokens of an imaplib untagged response, bytes or (data, literal)"""
+    if isinstance(item, tuple):
+        return tokenize(item[0], item[1:])
+    return tokenize(item)
+
+def responses(data):
+    """Join the pieces imaplib splits a response with literals into"""
+    item = None
+    for piece in data:
+        if piece is None:
+            continue
+        if isinstance(piece, tuple):
+            item = (item[0] + piece[0],) + item[1:] + piece[1:] if item else piece
+            continue
+        if item:
+            yield (item[0] + piece,) + item[1:]
+            item = None
+        else:
+            yield piece
+    if item:
+        yield item
+
+def simple(item):
+    """Response as str if it has no literal and no escaped character"""
+    if isinstance(item, tuple) or b'\\' in item:
+        return None
+    return bytes(item).decode()
+
+def words(data):
+    return [None if word == 'NIL' else word.strip('"') for word in re_word.findall(data)]
+
+### * LIST (flags) "sep" mailbox
+_flags = {}
+
+def listflags(flags):
+    res = _flags.get(flags)
+    if res is None:
+        res = _flags[flags] = [flag.lstrip(b'\\').decode() for flag in flags.split()]
+    return res
+
+def parse_list(item):
+    mo = None
+    if not isinstance(item, tuple):
+        mo = re_list.match(item)
+    if mo is None:
+        flags, sep, mailbox = untagged(item)[:3]
+        return List(listflags(b' '.join(flags)), text(sep), text(mailbox))
+    mailbox = mo.group(3)
+    if mailbox is None:
+        mailbox = mo.group(4)
+    elif b'\\' in mailbox:
+        mailbox = re_esc.sub(br'\1', mailbox)
+    sep = mo.group(2)
+    if sep is not None:
+        sep = sep[-1:].decode()
+    return List(listflags(mo.group(1)), sep, mailbox.decode())
+
+### * ACL mailbox identifier rights ...
+def parse_acl(item):
+    data = simple(item)
+    if data is not None:
+        tokens = words(data)
+        return Acl(tokens[0], dict(zip(tokens[1::2], tokens[2::2])))
+    tokens = untagged(item)
+    rights = {}
+    for i in range(1, len(tokens) - 1, 2):
+        rights[text(tokens[i])] = text(tokens[i + 1])
+    return Acl(text(tokens[0]), rights)
+
+### * QUOTA root (resource usage limit ...)
+def parse_quota(item):
+    root, resources = untagged(item)[:2]
+    res = {}
+    for i in range(0, len(resources) - 2, 3):
+        res[text(resources[i]).upper()] = (int(resources[i + 1]), int(resources[i + 2]))
+    return Quota(text(root), res)
+
+### * QUOTAROOT mailbox root ...
+def parse_quotaroot(item):
+    tokens = untagged(item)
+    return QuotaRoot(text(tokens[0]), [text(root) for root in tokens[1:]])
+
+### * ANNOTATION mailbox entry (attribute value ...)
+def parse_annotation(item):
+    data = simple(item)
+    mo = data and re_ann.match(data)
+    if mo:
+        attributes = words(mo.group(3))
+        return Annotation(mo.group(1), mo.group(2), dict(zip(attributes[::2], attributes[1::2])))
+    mailbox, entry, attributes = untagged(item)[:3]
+    res = {}
+    for i in range(0, len(attributes) - 1, 2):
+        res[text(attributes[i])] = text(attributes[i + 1])
+    return Annotation(text(mailbox), text(entry), res)
+
+### * METADATA mailbox (entry value ...)
+def parse_metadata(item):
+    mailbox, entries = untagged(item)[:2]
+    res = {}
+    for i in range(0, len(entries) - 1, 2):
+        res[text(entries[i])] = text(entries[i + 1])
+    return Metadata(text(mailbox), res)
+
+### * ID ("name" "value" ...) or * ID NIL
+def parse_id(item):
+    tokens = untagged(item)
+    res = {}
+    if tokens and tokens[0]:
+        params = tokens[0]
+        for i in range(0, len(params) - 1, 2):
+            res[text(params[i])] = text(params[i + 1])
+    return res
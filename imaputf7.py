@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kedros, a.s. www.kedros.sk
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA.
+#
+
+__all__ = [ 'encode', 'decode' ]
+__doc__ = """IMAP modified UTF-7 mailbox name codec (RFC 3501, 5.1.3)
+
+    encode("user/rei/café")     -> "user/rei/caf&AOk-"
+    decode("user/rei/caf&AOk-") -> "user/rei/café"
+
+Base64 runs are converted through LRU caches, the same accented
+folder names repeat for every user of a listing. Names without "&"
+(or, when encoding, without non-ASCII characters) are returned as is.
+decode() raises ValueError on malformed names: characters outside the
+modified base64 alphabet, a run which is not whole UTF-16 characters
+or a shift without its closing "-".
+
+"""
+
+import re
+from binascii import a2b_base64, b2a_base64
+from functools import lru_cache
+
+CACHE_SIZE = 65536
+
+re_direct = re.compile(r"([^\x20-\x7e]+)")   # characters needing base64
+re_base64 = re.compile(r"[A-Za-z0-9+,]*$")   # modified base64 of a run
+
+to_imap   = bytes.maketrans(b'/', b',')
+from_imap = bytes.maketrans(b',', b'/')
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _encode(run):
+    data = b2a_base64(run.encode('utf-16-be'), newline=False)
+    return '&%s-' % data.rstrip(b'=').translate(to_imap).decode('ascii')
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _decode(run):
+    if not run:
+        return '&'
+    if not re_base64.match(run):
+        raise ValueError('invalid modified base64: &%s-' % run)
+    data = run.encode('ascii').translate(from_imap)
+    return a2b_base64(data + b'=' * (-len(data) % 4)).decode('utf-16-be')
+
+def encode(text):
+    """Unicode mailbox name to modified UTF-7"""
+    if '&' not in text and text.isascii() and text.isprintable():
+        return text
+    parts = re_direct.split(text.replace('&', '&-'))
+    for i in range(1, len(parts), 2):
+        parts[i] = _encode(parts[i])
+    return ''.join(parts)
+
+def decode(text):
+    """Modified UTF-7 mailbox name to unicode"""
+    if '&' not in text:
+        return text
+    parts = text.split('&')
+    res = [parts[0]]
+    for part in parts[1:]:
+        run, shift, rest = part.partition('-')
+        if not shift:
+            raise ValueError('unterminated shift: %r' % text)
+        res.append(_decode(run))
+        res.append(rest)
+    return ''.join(res)
@@ -3,7 +3,7 @@ setup(
     name="cyruslib",
     version="0.9.0",
     packages=find_packages(),
-    py_modules=["cyruslib", "sievelib"],
+    py_modules=["cyruslib", "sievelib", "aiocyruslib", "imaputf7", "imapparse", "aiosievelib", "cyrusmetrics"],
 
     # metadata to display on PyPI
     author="Kedros, a.s.",
@@ -36,15 +36,21 @@ Hartmut Goebel <h.goebel@crazy-compilers.com>
 Ulrich Eck <ueck@net-labs.de> April 2001
 """
 
-import binascii, re, socket, time, random, sys
+import binascii, hashlib, re, socket, time, random, sys, threading
+import cyrusmetrics
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from time import perf_counter
 
-__all__ = [ 'MANAGESIEVE', 'SIEVE_PORT', 'OK', 'NO', 'BYE', 'Debug']
+__all__ = [ 'MANAGESIEVE', 'SievePool', 'SIEVE_PORT', 'OK', 'NO', 'BYE', 'Debug']
 
 #from imaplib import _log, _mesg
 
 Debug = 0
 CRLF = '\r\n'
 SIEVE_PORT = 2000
+BUFSIZE = 65536
+PIPELINE = 100 # commands in flight per pipelined window
 
 OK = 'OK'
 NO = 'NO'
@@ -59,13 +65,15 @@ commands = {
     # name          valid states
     'AUTHENTICATE': ('NONAUTH',),
     'LOGOUT':       ('NONAUTH', 'AUTH', 'LOGOUT'),
-    'CABABILTY':    ('NONAUTH', 'AUTH'),
+    'CAPABILITY':   ('NONAUTH', 'AUTH'),
+    'STARTTLS':     ('NONAUTH',),
     'GETSCRIPT':    ('AUTH', ),
     'PUTSCRIPT':    ('AUTH', ),
     'SETACTIVE':    ('AUTH', ),
     'DELETESCRIPT': ('AUTH', ),
     'LISTSCRIPTS':  ('AUTH', ),
     'HAVESPACE':    ('AUTH', ),
+    'UNAUTHENTICATE': ('AUTH', ),
     }
 
 ### needed
@@ -76,16 +84,34 @@ Oknobye = re.compile(r'(?P<type>(OK|NO|BYE))'
 # contain a '+' (plus sign) behind teh digits, but timsieved does not
 # send one. Thus we are less strikt here:
 Literal = re.compile(r'.*{(?P<size>\d+)\+?}$')
-re_dquote  = re.compile(r'"(([^"\\]|\\.)*)"')
+re_literal = re.compile(r'{(?P<size>\d+)\+?}$')
+re_dquote  = re.compile(r'"([^"\\]*(?:\\.[^"\\]*)*)"')
 re_esc_quote = re.compile(r'\\([\\"])')
+# "name" or "name" ACTIVE, the usual LISTSCRIPTS and CAPABILITY lines
+re_strings = re.compile(r'"([^"\\]*)"(?: "([^"\\]*)"| ([^ "{]+))?$')
+
+
+### commands whose first argument is a script name, for instruments
+script_commands = ('GETSCRIPT', 'PUTSCRIPT', 'SETACTIVE', 'DELETESCRIPT', 'HAVESPACE')
 
 
 def sieve_name(name):
     # todo: correct quoting
     return '"%s"' % name
 
+def sieve_bytes(data):
+    if isinstance(data, bytes):
+        return data
+    return data.encode('utf-8')
+
 def sieve_string(string):
-    return '{%d+}%s%s' % ( len(string), CRLF, string )
+    # the size of a literal is in octets
+    string = sieve_bytes(string)
+    return b'{%d+}\r\n%s' % (len(string), string)
+
+def sasl_plain(authzid, authcid, password):
+    data = ("%s\0%s\0%s" % (authzid, authcid, password)).encode('utf-8')
+    return binascii.b2a_base64(data).strip().decode('ascii')
 
 
 class MANAGESIEVE:
@@ -145,6 +171,10 @@ class MANAGESIEVE:
         self.loginmechs = []
         self.implementation = ''
         self.supports_tsl = 0
+        self.supports_unauthenticate = 0
+
+        self.instruments = []
+        self.received = self.mark = 0
 
         # Open socket to server.
         try:
@@ -187,8 +217,10 @@ class MANAGESIEVE:
                 self.loginmechs = cap[1].split()
             elif cap[0] == "SIEVE":
                 self.capabilities = cap[1].split()
-            elif cap[0] == "STARTTSL":
+            elif cap[0] == "STARTTLS":
                 self.supports_tsl = 1
+            elif cap[0] == "UNAUTHENTICATE":
+                self.supports_unauthenticate = 1
             else:
                 # A client implementation MUST ignore any other
                 # capabilities given that it does not understand.
@@ -205,32 +237,68 @@ class MANAGESIEVE:
 
     #### Private methods ###
     def _open(self, host, port):
-        """Setup 'self.sock' and 'self.file'."""
+        """Setup 'self.sock' and the receive buffer."""
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((self.host, self.port))
-        self.file = self.sock.makefile('r')
+        # writes are already coalesced per command or pipeline window
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rbuf = bytearray()
+        self.lines = [] # decoded lines not yet parsed, last one first
 
     def _close(self):
-        self.file.close()
         self.sock.close()
 
+    def _recv(self):
+        data = self.sock.recv(BUFSIZE)
+        if not data:
+            raise self.abort('socket error: EOF')
+        self.rbuf += data
+
     def _read(self, size):
         """Read 'size' bytes from remote."""
-        return self.file.read(size)
-
-    def _readline(self):
-        """Read line from remote."""
-        return self.file.readline()
+        data = bytearray(size)
+        view = memoryview(data)
+        got = min(size, len(self.rbuf))
+        view[:got] = self.rbuf[:got]
+        del self.rbuf[:got]
+        if self.instruments:
+            self.received += size
+        # The rest of a large literal goes straight into its buffer
+        while got < size:
+            n = self.sock.recv_into(view[got:])
+            if not n:
+                raise self.abort('socket error: EOF')
+            got += n
+        return bytes(data)
+
+    def _readlines(self):
+        """Decode all complete lines in the buffer, up to a literal."""
+        start = 0
+        while True:
+            end = self.rbuf.rfind(b'\n', start)
+            if end >= 0:
+                break
+            start = len(self.rbuf)
+            self._recv()
+        # the octets of a literal are left for _read()
+        mark = self.rbuf.find(b'}\r\n', 0, end + 1)
+        if mark >= 0:
+            end = mark + 2
+        # Protocol mandates all lines terminated by CRLF
+        lines = self.rbuf[:end - 1].decode('utf-8').split(CRLF)
+        del self.rbuf[:end + 1]
+        lines.reverse()
+        self.lines = lines
 
     def _send(self, data):
-        return self.sock.send(data)
+        return self.sock.sendall(data)
 
     def _get_line(self):
-        line = self._readline()
-        if not line:
-            raise self.abort('socket error: EOF')
-        # Protocol mandates all lines terminated by CRLF
-        line = line[:-2]
+        if not self.lines:
+            self._readlines()
+        line = self.lines.pop()
+        if self.instruments:
+            self.received += len(line.encode('utf-8')) + 2
         if __debug__:
             if self.debug >= 4:
                 self._mesg('< %s' % line)
@@ -259,47 +327,114 @@ class MANAGESIEVE:
         The responce code and text may be found in <instance>.response_code
         and <instance>.response_text, respectivly.
         """
+        data = self._format(name, arg1, arg2, *options)
+        if not self.instruments:
+            self._write(data)
+            return self._get_response()
+        pending = self._start(name, arg1, len(data))
+        try:
+            self._write(data)
+            typ, data = self._get_response()
+        except self.abort:
+            self._end(pending, 'ABORT')
+            raise
+        self._end(pending, typ)
+        return typ, data
+
+
+    def _start(self, name, arg1, sent):
+        """Start event of a command, returns what _end() needs"""
+        scriptname = None
+        if name in script_commands and arg1:
+            scriptname = sieve_bytes(arg1).decode('utf-8').strip('"')
+        for instrument in self.instruments:
+            instrument.start(cyrusmetrics.Event('sieve', name, scriptname, None, None, None, None))
+        return name, scriptname, sent, perf_counter(), self.received
+
+
+    def _end(self, pending, result):
+        name, scriptname, sent, start, received = pending
+        # bytes read since the previous response belong to this one
+        received = self.received - max(received, self.mark)
+        self.mark = self.received
+        event = cyrusmetrics.Event('sieve', name, scriptname, sent, received,
+                                   perf_counter() - start, result)
+        for instrument in self.instruments:
+            instrument.end(event)
+
+
+    def _format(self, name, arg1=None, arg2=None, *options):
+        """Command line and its options as bytes, ready to send."""
         if self.state not in commands[name]:
             raise self.error(
                 'Command %s illegal in state %s' % (name, self.state))
         # concatinate command and arguments (if any)
-        data = " ".join([_f for _f in (name, arg1, arg2) if _f])
+        data = b" ".join([sieve_bytes(_f) for _f in (name, arg1, arg2) if _f])
+        # data may hold a script, format it only when debugging
         if __debug__:
             if self.debug >= 4: self._mesg('> %r' % data)
-            else: self._log('> %s' % data)
+        lines = [data]
+        for o in options:
+            if __debug__:
+                if self.debug >= 4: self._mesg('> %r' % o)
+            lines.append(sieve_bytes(o))
+        lines.append(b'')
+        return b'\r\n'.join(lines)
+
+
+    def _write(self, data):
         try:
-            self._send('%s%s' % (data, CRLF))
-            for o in options:
-                if __debug__:
-                    if self.debug >= 4: self._mesg('> %r' % o)
-                    else: self._log('> %r' % data)
-                self._send('%s%s' % (o, CRLF))
+            # One write per command, a literal sent apart would wait
+            # for the delayed ACK of the command line
+            self._send(data)
         except (socket.error, OSError) as val:
             raise self.abort('socket error: %s' % val)
-        return self._get_response()
-
-
-    def _readstring(self, data):
-        if data[0] == ' ': # space -> error
-            raise self.error('Unexpected space: %r' % data)
-        elif data[0] == '"': # handle double quote:
-            if not self._match(re_dquote, data):
-                raise self.error('Unmatched quote: %r' % data)
-            snippet = self.mo.group(1)
-            return re_esc_quote.sub(r'\1', snippet), data[self.mo.end():]
-        elif self._match(Literal, data):
-            # read a 'literal' string
-            size = int(self.mo.group('size'))
+
+
+    def _strings(self, line):
+        """Strings of a response line, literals are read as needed."""
+        res = []
+        pos = 0
+        end = len(line)
+        while 1:
+            char = line[pos:pos + 1]
+            if char == '"': # handle double quote:
+                mo = re_dquote.match(line, pos)
+                if mo is None:
+                    raise self.error('Unmatched quote: %r' % line)
+                value = mo.group(1)
+                if '\\' in value:
+                    value = re_esc_quote.sub(r'\1', value)
+                pos = mo.end()
+            elif char == ' ': # space -> error
+                raise self.error('Unexpected space: %r' % line)
+            else:
+                mo = None
+                if char == '{':
+                    mo = re_literal.match(line, pos)
+                if mo is not None:
+                    # read a 'literal' string
+                    size = int(mo.group('size'))
+                    if __debug__:
+                        if self.debug >= 4:
+                            self._mesg('read literal size %s' % size)
+                    value = self._read(size).decode('utf-8')
+                    line = self._get_line()
+                    pos = 0
+                    end = len(line)
+                else: # atom up to the next space
+                    start = pos
+                    pos = line.find(' ', start)
+                    if pos < 0:
+                        pos = end
+                    value = line[start:pos]
             if __debug__:
                 if self.debug >= 4:
-                    self._mesg('read literal size %s' % size)
-            return self._read(size), self._get_line()
-        else:
-            for i in range(len(data)):
-                if data[i] == ' ':
-                    return data[:i], data[i+1:]
-            else:
-                return data, ''
+                    self._mesg('read: %r' % (value,))
+            res.append(value)
+            if pos >= end or line[pos] != ' ':
+                return res
+            pos += 1
 
     def _get_response(self):
         """
@@ -333,52 +468,31 @@ class MANAGESIEVE:
 [A-Z-]+ CRLF
 
         """
-        data = [] ; dat = None
-        resp = self._get_line()
+        data = []
         while 1:
-            if self._match(Oknobye, resp):
-                typ, code, dat = self.mo.group('type','code','data')
-                if __debug__:
-                    if self.debug >= 1:
-                        self._mesg('%s response: %s %s' % (typ, code, dat))
-                self.response_code = code
-                self.response_text = None
-                if dat:
-                    self.response_text = self._readstring(dat)[0]
-                return typ, data
-##             elif 0:
-##                 dat2 = None
-##                 dat, resp = self._readstring(resp)
-##                 if resp.startswith(' '):
-##                     dat2, resp = self._readstring(resp[1:])
-##                 data.append( (dat, dat2))
-##                 resp = self._get_line()
-            else:
-                dat = []
-                while 1:
-                    dat1, resp = self._readstring(resp)
-                    if __debug__:
-                        if self.debug >= 4:
-                            self._mesg('read: %r' % (dat1,))
-                        if self.debug >= 5:
-                            self._mesg('rest: %r' % (resp,))
-                    dat.append(dat1)
-                    if not resp.startswith(' '):
-                        break
-                    resp = resp[1:]
-                data.append(dat)
-                resp = self._get_line()
-        return self.error('Should not come here')
-
-
-    def _match(self, cre, s):
-        # Run compiled regular expression match method on 's'.
-        # Save result, return success.
-        self.mo = cre.match(s)
-        if __debug__:
-            if self.mo is not None and self.debug >= 5:
-                self._mesg("\tmatched r'%s' => %s" % (cre.pattern, repr(self.mo.groups())))
-        return self.mo is not None
+            resp = self._get_line()
+            # data lines are strings, quoted or literal
+            mo = None
+            if resp[:1] not in ('"', '{'):
+                mo = Oknobye.match(resp)
+            if mo is None:
+                mo = re_strings.match(resp)
+                if mo is None:
+                    data.append(self._strings(resp))
+                elif mo.lastindex == 1:
+                    data.append([mo.group(1)])
+                else:
+                    data.append([mo.group(1), mo.group(mo.lastindex)])
+                continue
+            typ, code, dat = mo.group('type','code','data')
+            if __debug__:
+                if self.debug >= 1:
+                    self._mesg('%s response: %s %s' % (typ, code, dat))
+            self.response_code = code
+            self.response_text = None
+            if dat:
+                self.response_text = self._strings(dat)[0]
+            return typ, data
 
 
     ### Public methods ###
@@ -392,13 +506,13 @@ class MANAGESIEVE:
 
         if mechanism == 'PLAIN':
             if admin != '':
-                encoded = binascii.b2a_base64("%s\0%s\0%s" % (user, admin, password)).strip()
+                encoded = sasl_plain(user, admin, password)
             else:
-                encoded = binascii.b2a_base64("%s\0%s\0%s" % (user, user, password)).strip()
+                encoded = sasl_plain(user, user, password)
 
             typ, data = self._command('AUTHENTICATE', sieve_name(mech)+" {"+str(len(encoded))+"+}", None, encoded)
         elif mechanism == 'LOGIN':
-            encoded = binascii.b2a_base64("%s\0%s\0%s" % (user, user, password)).strip()
+            encoded = sasl_plain(user, user, password)
             typ, data = self._command('AUTHENTICATE', sieve_name(mech)+" {"+str(len(encoded))+"+}", encoded)
         else:
             raise self.error("Authentication %s dont implemented." % mech)
@@ -410,6 +524,16 @@ class MANAGESIEVE:
             return False
 
 
+    def unauthenticate(self):
+        """Return to the non-authenticated state (RFC 5804)."""
+        # command-unauthenticate = "UNAUTHENTICATE" CRLF
+        # response-unauthenticate = response-oknobye
+        typ = self._simple_command('UNAUTHENTICATE')
+        if typ == 'OK':
+            self.state = 'NONAUTH'
+        return typ
+
+
     def logout(self):
         """Terminate connection to server."""
         # command-logout        = "LOGOUT" CRLF
@@ -455,12 +579,11 @@ class MANAGESIEVE:
         if typ != 'OK': return typ, data
         if len(data) != 1:
             self.error('GETSCRIPT returned more than one string/script')
-        # todo: decode data?
         return typ, data[0][0]
     
 
     def putscript(self, scriptname, scriptdata):
-        """Put a script onto the server."""
+        """Put a script onto the server, str or UTF-8 bytes."""
         # command-putscript     = "PUTSCRIPT" SP sieve-name SP string CRLF
         # response-putscript    = response-oknobye
         return self._simple_command('PUTSCRIPT',
@@ -490,6 +613,132 @@ class MANAGESIEVE:
                                     str(size))
 
 
+    def pipeline(self, commands):
+        """Send several commands before reading their responses.
+
+        (typ, [data]) list = <instance>.pipeline(commands)
+
+        'commands' is a list of (name, arg, ...) tuples as taken by
+        _command(), at most PIPELINE are written at once. Results are
+        in the same order, 'data' is the text of the response when
+        'typ' is not 'OK'. Every command is sent, a failed one does
+        not stop the following ones.
+        Commands changing the state (AUTHENTICATE, LOGOUT) must not
+        be pipelined.
+        """
+        results = []
+        for i in range(0, len(commands), PIPELINE):
+            window = commands[i:i + PIPELINE]
+            data = [self._format(*command) for command in window]
+            pending = []
+            if self.instruments:
+                pending = [self._start(command[0], (command[1:] or [None])[0], len(dat))
+                           for command, dat in zip(window, data)]
+            try:
+                self._write(b''.join(data))
+                for command in window:
+                    typ, data = self._get_response()
+                    if typ != 'OK':
+                        data = [self.response_text]
+                    results.append((typ, data))
+                    if pending:
+                        self._end(pending.pop(0), typ)
+            except self.abort:
+                for started in pending:
+                    self._end(started, 'ABORT')
+                raise
+        return results
+
+
+    def instrument(self, instrument):
+        """Call instrument.start() and end() for each command, see cyrusmetrics"""
+        self.instruments.append(instrument)
+
+
+    def getscripts(self):
+        """Get all scripts of the user, GETSCRIPT is pipelined.
+
+        (typ, scripts) = <instance>.getscripts()
+
+        if 'typ' is 'OK', 'scripts' is a dict of {scriptname: scriptdata},
+        a script which could not be read is left out.
+        """
+        typ, scripts = self.listscripts()
+        if typ != 'OK': return typ, scripts
+        names = [name for name, active in scripts]
+        res = {}
+        results = self.pipeline([('GETSCRIPT', sieve_name(name)) for name in names])
+        for name, (typ, data) in zip(names, results):
+            if typ == 'OK' and len(data) == 1:
+                res[name] = data[0][0]
+        return 'OK', res
+
+
+    def deletescripts(self, scriptnames):
+        """Delete several scripts, pipelined.
+
+        Returns a dict of {scriptname: typ}.
+        """
+        results = self.pipeline([('DELETESCRIPT', sieve_name(name)) for name in scriptnames])
+        return dict([(name, typ) for name, (typ, data) in zip(scriptnames, results)])
+
+
+    def installscript(self, scriptname, scriptdata, activate=True):
+        """HAVESPACE and PUTSCRIPT in one round trip, then SETACTIVE.
+
+        (typ, [data]) = <instance>.installscript(scriptname, scriptdata)
+
+        'typ' is that of the first command which failed, with
+        'data' its response text, or 'OK'. SETACTIVE is only sent
+        once both HAVESPACE and PUTSCRIPT succeeded, so a failed
+        upload never activates the previous script of that name.
+        """
+        data = sieve_bytes(scriptdata)
+        commands = [('HAVESPACE', sieve_name(scriptname), str(len(data))),
+                    ('PUTSCRIPT', sieve_name(scriptname), sieve_string(data))]
+        for typ, data in self.pipeline(commands):
+            if typ != 'OK':
+                return typ, data
+        if activate:
+            typ = self.setactive(scriptname)
+            if typ != 'OK':
+                return typ, [self.response_text]
+        return 'OK', []
+
+
+    def syncscript(self, scriptname, scriptdata, activate=True):
+        """Upload a script only if the server holds other content.
+
+        (typ, [data]) = <instance>.syncscript(scriptname, scriptdata)
+
+        LISTSCRIPTS and GETSCRIPT are pipelined to compare the script
+        on the server. HAVESPACE is only asked when the script grows,
+        SETACTIVE only sent when another script is active. If 'typ'
+        is 'OK', 'data' lists the commands which changed something,
+        empty when the script was already there; otherwise 'data' is
+        ['COMMAND: response text'] of the failed command.
+        """
+        data = sieve_bytes(scriptdata)
+        (typ, scripts), (gtyp, current) = self.pipeline(
+            [('LISTSCRIPTS',), ('GETSCRIPT', sieve_name(scriptname))])
+        if typ != 'OK':
+            return typ, ['LISTSCRIPTS: %s' % scripts[0]]
+        active = [dat[0] for dat in scripts if len(dat) == 2]
+        commands = []
+        if gtyp != 'OK' or len(current) != 1 or sieve_bytes(current[0][0]) != data:
+            if gtyp != 'OK' or len(data) > len(sieve_bytes(current[0][0])):
+                typ = self.havespace(scriptname, len(data))
+                if typ != 'OK':
+                    return typ, ['HAVESPACE: %s' % self.response_text]
+            commands.append(('PUTSCRIPT', sieve_name(scriptname), sieve_string(data)))
+        if activate and active != [scriptname]:
+            commands.append(('SETACTIVE', sieve_name(scriptname)))
+        for command, (typ, dat) in zip(commands, self.pipeline(commands)):
+            if typ != 'OK':
+                return typ, ['%s: %s' % (command[0], dat[0])]
+        return 'OK', [command[0] for command in commands]
+
+
     def capability(self):
         """
         Isse a CAPABILITY command and return the result.
@@ -511,3 +760,215 @@ class MANAGESIEVE:
 
     # command-starttls      = "STARTTLS" CRLF
     # response-starttls     = response-oknobye
+
+
+class SievePool:
+    """Pool of MANAGESIEVE connections for one server.
+
+    Instantiate with: SievePool(host, port, admin, password [, size])
+
+    Each session authenticates as a user with the admin password,
+    through the PLAIN authorization-id (see MANAGESIEVE.login()).
+    When the session ends, servers offering UNAUTHENTICATE keep the
+    connection for the next user, so only the first sessions pay for
+    the connect and greeting; other servers get a new connection.
+
+        pool = SievePool("127.0.0.1", 4190, "admin", "password", 8)
+        with pool.session("rei") as sieve:
+            sieve.listscripts()
+        pool.deploy({"rei": ("vacation", script)})
+    """
+
+    def __init__(self, host='', port=SIEVE_PORT, admin='', password='', size=4, timeout=None):
+        self.host = host
+        self.port = port
+        self.admin = admin
+        self.password = password
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.count = 0 # connections idle or checked out
+        self.cond = threading.Condition()
+        self.instruments = []
+
+    def instrument(self, instrument):
+        """Add an instrument to the connections opened from now on"""
+        self.instruments.append(instrument)
+
+    def _connect(self):
+        sieve = MANAGESIEVE(self.host, self.port)
+        if not sieve.alive:
+            raise MANAGESIEVE.abort('unable to connect to %s:%s' % (self.host, self.port))
+        for instrument in self.instruments:
+            sieve.instrument(instrument)
+        return sieve
+
+    def _discard(self, sieve):
+        with self.cond:
+            self.count -= 1
+            self.cond.notify()
+        if sieve is None:
+            return
+        try:
+            sieve._close()
+        except Exception:
+            pass
+
+    def get(self, user):
+        """Check out a connection authenticated as user"""
+        with self.cond:
+            while not self.idle and self.count >= self.size:
+                if not self.cond.wait(self.timeout):
+                    raise MANAGESIEVE.error('No pooled connection available')
+            if self.idle:
+                sieve = self.idle.pop()
+            else:
+                sieve = None
+                self.count += 1
+        try:
+            if sieve is None:
+                sieve = self._connect()
+            if not sieve.login('PLAIN', user, self.password, self.admin):
+                raise MANAGESIEVE.error('AUTHENTICATE %s: %s' % (user, sieve.response_text))
+        except (MANAGESIEVE.abort, socket.error):
+            self._discard(sieve)
+            raise
+        except:
+            if sieve is None:
+                self._discard(sieve)
+            else:
+                self.put(sieve)
+            raise
+        return sieve
+
+    def put(self, sieve):
+        """Return a connection to the pool"""
+        if sieve.state == 'AUTH':
+            try:
+                if not sieve.supports_unauthenticate or sieve.unauthenticate() != OK:
+                    sieve.logout()
+            except (MANAGESIEVE.error, socket.error):
+                pass
+        if sieve.state != 'NONAUTH':
+            return self._discard(sieve)
+        with self.cond:
+            self.idle.append(sieve)
+            self.cond.notify()
+
+    @contextmanager
+    def session(self, user):
+        sieve = self.get(user)
+        dropped = False
+        try:
+            yield sieve
+        except (MANAGESIEVE.abort, socket.error):
+            dropped = True
+            raise
+        finally:
+            # any other exception leaves the connection usable
+            if dropped:
+                self._discard(sieve)
+            else:
+                self.put(sieve)
+
+    def _deploy(self, user, scriptname, scriptdata, activate):
+        with self.session(user) as sieve:
+            typ = sieve.putscript(scriptname, scriptdata)
+            if typ != OK:
+                return False, 'PUTSCRIPT: %s' % sieve.response_text
+            ### only activate what was uploaded
+            if activate:
+                typ = sieve.setactive(scriptname)
+                if typ != OK:
+                    return False, 'SETACTIVE: %s' % sieve.response_text
+        return True, None
+
+    def _run(self, function, user_scripts, concurrency, progress):
+        """function(user, scriptname, scriptdata) for every user, threaded"""
+        total = len(user_scripts)
+        result = {}
+        lock = threading.Lock()
+
+        def run(user):
+            scriptname, scriptdata = user_scripts[user]
+            try:
+                try:
+                    res = function(user, scriptname, scriptdata)
+                except (MANAGESIEVE.abort, socket.error):
+                    # A reused connection may have been dropped, retry once
+                    res = function(user, scriptname, scriptdata)
+            except (MANAGESIEVE.error, socket.error) as info:
+                res = (False, str(info))
+            with lock:
+                result[user] = res
+                done = len(result)
+            if progress is not None:
+                progress(user, res[0], done, total)
+
+        if user_scripts:
+            with ThreadPoolExecutor(min(concurrency or self.size, self.size)) as executor:
+                list(executor.map(run, user_scripts))
+        return result
+
+    def deploy(self, user_scripts, activate=True, concurrency=None, progress=None):
+        """
+        Upload a script for many users, spread over up to concurrency
+        pooled connections (default: the pool size), and make it the
+        active one unless activate is False.
+
+        user_scripts is a dict of {user: (scriptname, scriptdata)}.
+        progress(user, ok, done, total) is called from the worker
+        threads after each user. Returns {user: (ok, error)}.
+        """
+        def deploy(user, scriptname, scriptdata):
+            return self._deploy(user, scriptname, scriptdata, activate)
+        return self._run(deploy, user_scripts, concurrency, progress)
+
+    def sync_scripts(self, desired, activate=True, digests=None, concurrency=None, progress=None):
+        """
+        As deploy(), but only scripts which differ from those on the
+        server are uploaded, see MANAGESIEVE.syncscript().
+
+        digests is an optional mapping kept between runs (a dict or a
+        shelve) of {user: (scriptname, sha256, active)} for the scripts
+        synced before: users whose entry matches are skipped without
+        connecting, so changes made on the server behind its back are
+        not seen. Returns {user: (ok, commands)}, commands being the
+        list of commands which changed something, or the error.
+        """
+        lock = threading.Lock()
+
+        def sync(user, scriptname, scriptdata):
+            digest = hashlib.sha256(sieve_bytes(scriptdata)).hexdigest()
+            if digests is not None:
+                with lock:
+                    known = digests.get(user)
+                if known is not None and tuple(known[:2]) == (scriptname, digest) \
+                        and (known[2] or not activate):
+                    return True, []
+            with self.session(user) as sieve:
+                typ, data = sieve.syncscript(scriptname, scriptdata, activate)
+            res = (typ == OK, data if typ == OK else data[0])
+            if digests is not None:
+                with lock:
+                    if res[0]:
+                        digests[user] = (scriptname, digest, activate)
+                    elif user in digests:
+                        del digests[user]
+            return res
+
+        return self._run(sync, desired, concurrency, progress)
+
+    def close(self):
+        """Logout idle connections"""
+        with self.cond:
+            idle, self.idle = self.idle, []
+            self.count -= len(idle)
+        for sieve in idle:
+            try:
+                sieve.logout()
+            except Exception:
+                try:
+                    sieve._close()
+                except Exception:
+                    pass
@@ -0,0 +1,117 @@
+#
+# aiocyruslib tests, against the fake Cyrus IMAP server of bench/
+#
+#   python3 -m pytest tests
+#
+
+import asyncio, os, ssl, sys, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+import aiocyruslib
+import cyruslib
+import fakeimapd
+
+CERT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'keycert.pem')
+
+
+class Server(unittest.TestCase):
+    """A fake server with a few users, session() runs with an AsyncCYRUS logged in"""
+
+    def setUp(self):
+        self.server, self.state = fakeimapd.start(fakeimapd.State('/'))
+        self.state.populate(12)
+        self.url = "imap://127.0.0.1:%d" % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def session(self, function, ssl_context=None):
+        async def main():
+            async with aiocyruslib.AsyncCYRUS(self.url, ssl_context) as imap:
+                await imap.login("cyrus", "password")
+                return await function(imap)
+        return asyncio.run(main())
+
+
+class CommandTest(Server):
+
+    def test_lm(self):
+        async def lm(imap):
+            return await imap.lm("user/%")
+        self.assertEqual(self.session(lm), sorted(name for name in self.state.mailboxes
+                                                  if name.count('/') == 1))
+
+    def test_concurrent(self):
+        # commands in flight at once get their own responses
+        async def lam(imap):
+            return await asyncio.gather(*[imap.lam(name) for name in ('user/u000000', 'user/u000001')])
+        self.state.acls['user/u000001'] = {'cyrus': 'lrs'}
+        self.assertEqual(self.session(lam), [{'cyrus': fakeimapd.ADMIN_RIGHTS}, {'cyrus': 'lrs'}])
+
+    def test_create_delete(self):
+        async def cmdm(imap):
+            await imap.cm("user/rei")
+            await imap.cm("user/rei/Trash")
+            await imap.sq("user/rei", 100)
+            quota = await imap.lq("user/rei")
+            return quota, await imap.dm("user/rei")
+        quota, result = self.session(cmdm)
+        self.assertEqual(quota, (0, 100))
+        self.assertEqual(result, {'user/rei': (True, None)})
+        self.assertNotIn('user/rei', self.state.mailboxes)
+
+    def test_annotation(self):
+        async def annotation(imap):
+            await imap.setannotation("user/u000001", "/comment", "hello")
+            return await imap.getannotation("user/u000001")
+        self.assertEqual(self.session(annotation), {'user/u000001': {'/comment': 'hello'}})
+
+
+class StartTLSTest(Server):
+
+    def test_starttls(self):
+        self.state.tls = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.state.tls.load_cert_chain(CERT)
+        self.url = self.url.replace('imap://', 'imap+starttls://')
+        async def lm(imap):
+            return imap.writer.get_extra_info('ssl_object') is not None, await imap.lm("user/%")
+        tls, mailboxes = self.session(lm, ssl.create_default_context(cafile=CERT))
+        self.assertTrue(tls)
+        self.assertEqual(mailboxes, ['user/u000000', 'user/u000001'])
+
+
+class ErrorTest(Server):
+
+    def error(self, function):
+        with self.assertRaises(cyruslib.CYRUSError) as cm:
+            self.session(function)
+        return cm.exception
+
+    def test_create(self):
+        async def cm(imap):
+            await imap.cm("user/u000001")
+        error = self.error(cm)
+        self.assertEqual((error.code, error.command, error.status), (20, 'CREATE', 'NO'))
+        self.assertEqual(error.message, 'Mailbox already exists')
+
+    def test_dm_nonexistent(self):
+        # as with CYRUS, the error of SETACL, which goes first
+        async def dm(imap):
+            await imap.dm("user/nonexistent")
+        error = self.error(dm)
+        self.assertEqual((error.code, error.command), (99, 'SETACL'))
+        self.assertEqual((error.status, error.rcode), ('NO', 'NONEXISTENT'))
+
+    def test_login(self):
+        async def nothing(imap):
+            pass
+        self.state.password = 'secret'
+        error = self.error(nothing)
+        self.assertEqual((error.code, error.command), (10, 'LOGIN'))
+        self.assertEqual((error.status, error.rcode), ('NO', 'AUTHENTICATIONFAILED'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#
+# aiosievelib tests, against the fake MANAGESIEVE server of bench/
+#
+#   python3 -m pytest tests
+#
+
+import asyncio, os, socket, sys, threading, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+import aiosievelib
+import fakesieved
+
+
+class Server(unittest.TestCase):
+    """A fake server with two users, session() runs with an AsyncManageSieve logged in"""
+
+    def setUp(self):
+        self.server, self.state = fakesieved.start(fakesieved.State())
+        self.state.populate(2)
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def session(self, function):
+        async def main():
+            async with aiosievelib.AsyncManageSieve('127.0.0.1', self.port) as sieve:
+                await sieve.login('PLAIN', 'u000000', 'password', 'cyrus')
+                return await function(sieve)
+        return asyncio.run(main())
+
+
+class CommandTest(Server):
+
+    def test_scripts(self):
+        async def scripts(sieve):
+            await sieve.putscript('new', 'keep;\r\n')
+            await sieve.setactive('new')
+            return await sieve.listscripts(), await sieve.getscript('new')
+        (typ, scripts), (gtyp, data) = self.session(scripts)
+        self.assertEqual((typ, gtyp), ('OK', 'OK'))
+        self.assertEqual(scripts, [('new', True), ('script0', False)])
+        self.assertEqual(data, 'keep;\r\n')
+        self.assertEqual(self.state.active['u000000'], 'new')
+
+    def test_pipelined(self):
+        # many large commands in flight, more than the transport buffers
+        data = fakesieved.script(256 * 1024).decode('utf-8')
+        async def put(sieve):
+            return await asyncio.gather(*[sieve.putscript('s%02d' % i, data) for i in range(40)])
+        self.assertEqual(self.session(put), ['OK'] * 40)
+        self.assertEqual(len(self.state.scripts['u000000']), 41)
+        self.assertEqual(self.state.scripts['u000000']['s39'], data.encode('utf-8'))
+
+    def test_backpressure(self):
+        # a peer which stops reading: the commands wait for the transport
+        # to drain instead of piling up in its buffer
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        peer = []
+        def serve():
+            conn, addr = listener.accept()
+            conn.sendall(b'OK "not reading"\r\n')
+            peer.append(conn)
+        threading.Thread(target=serve, daemon=True).start()
+        async def main():
+            sieve = aiosievelib.AsyncManageSieve('127.0.0.1', listener.getsockname()[1])
+            await sieve.connect()
+            sieve.state = 'AUTH'
+            data = 'x' * (1024 * 1024)
+            tasks = [asyncio.ensure_future(sieve.putscript('s%02d' % i, data)) for i in range(40)]
+            done, pending = await asyncio.wait(tasks, timeout=0.5)
+            buffered = sieve.writer.transport.get_write_buffer_size()
+            sieve.close()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            return len(done), buffered
+        try:
+            done, buffered = asyncio.run(main())
+        finally:
+            for conn in peer:
+                conn.close()
+            listener.close()
+        self.assertEqual(done, 0)
+        self.assertLess(buffered, 4 * 1024 * 1024)
+
+    def test_closed(self):
+        # a command after LOGOUT fails and leaves the connection closed
+        async def main():
+            sieve = aiosievelib.AsyncManageSieve('127.0.0.1', self.port)
+            await sieve.connect()
+            await sieve.login('PLAIN', 'u000000', 'password', 'cyrus')
+            await sieve.logout()
+            with self.assertRaises(sieve.abort):
+                await sieve.listscripts()
+            self.assertFalse(sieve.alive)
+        asyncio.run(main())
+
+
+if __name__ == '__main__':
+    unittest.main()
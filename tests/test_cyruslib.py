@@ -0,0 +1,690 @@
+#
+# cyruslib tests, against the fake Cyrus IMAP server of bench/
+#
+#   python3 -m pytest tests
+#
+
+import os, ssl, sys, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+import cyruslib
+import cyrusmetrics
+import fakeimapd
+
+CERT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'keycert.pem')
+
+
+class Server(unittest.TestCase):
+    """A fake server with a few users, and a CYRUS logged in"""
+
+    def setUp(self):
+        self.server, self.state = fakeimapd.start(fakeimapd.State('/'))
+        self.state.populate(12)
+        self.imap = cyruslib.CYRUS("imap://127.0.0.1:%d" % self.server.server_address[1])
+        self.imap.login("cyrus", "password")
+
+    def tearDown(self):
+        self.imap.logout()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MailboxTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = cyruslib.MailboxTree()
+        self.tree.load([('user/rei', ['HasChildren']), ('user/rei/Sent', []),
+                        ('user/rei/Sent/2020', []), ('user/joe', []), ('Shared/a', [])], '/')
+
+    def match(self, pattern):
+        return [mailbox for mailbox, flags in self.tree.match(pattern)]
+
+    def test_match(self):
+        self.assertEqual(self.match('user/%'), ['user/joe', 'user/rei'])
+        self.assertEqual(self.match('user/*'), ['user/joe', 'user/rei', 'user/rei/Sent', 'user/rei/Sent/2020'])
+        self.assertEqual(self.match('user/rei/S*'), ['user/rei/Sent', 'user/rei/Sent/2020'])
+        self.assertEqual(self.match('%'), [])
+        self.assertEqual(self.match('Shared'), [])
+        self.assertEqual(self.match('user/rei'), ['user/rei'])
+        self.assertEqual(list(self.tree.match('user/rei')), [('user/rei', ['HasChildren'])])
+
+    def test_remove(self):
+        self.tree.remove('user/rei/Sent')
+        self.assertEqual(self.match('user/rei/*'), ['user/rei/Sent/2020'])
+        self.tree.remove('user/rei', True)
+        self.assertEqual(self.match('user/*'), ['user/joe'])
+        self.tree.remove('Shared/a')
+        self.assertEqual(self.tree.root[1].get('Shared'), None)
+
+    def test_rename(self):
+        self.tree.rename('user/rei/Sent', 'user/joe/Sent')
+        self.assertEqual(self.match('user/*'), ['user/joe', 'user/joe/Sent', 'user/joe/Sent/2020', 'user/rei'])
+
+    def test_expired(self):
+        self.assertFalse(self.tree.expired())
+        self.assertTrue(cyruslib.MailboxTree().expired())
+        self.tree.ttl = 0
+        self.tree.loaded -= 1
+        self.assertTrue(self.tree.expired())
+
+
+class MailboxArgTest(unittest.TestCase):
+
+    def test_mailbox(self):
+        self.assertEqual(cyruslib.mailboxarg('GETACL', ('"user/rei"',)), 'user/rei')
+        self.assertEqual(cyruslib.mailboxarg('LIST', ('*', 'user/%')), 'user/%')
+        self.assertEqual(cyruslib.mailboxarg('CREATE', ('user/rei', None)), 'user/rei')
+
+    def test_options(self):
+        args = ('(DEPTH infinity)', 'user/rei', '"/shared/comment"')
+        self.assertEqual(cyruslib.mailboxarg('GETMETADATA', args), 'user/rei')
+        self.assertEqual(cyruslib.mailboxarg('GETMETADATA', (b'(DEPTH 1)', b'user/rei')), 'user/rei')
+
+    def test_none(self):
+        self.assertIsNone(cyruslib.mailboxarg('NOOP', ()))
+        self.assertIsNone(cyruslib.mailboxarg('GETACL', ()))
+        self.assertIsNone(cyruslib.mailboxarg('GETMETADATA', ('(DEPTH 1)',)))
+
+
+class MetadataPatternTest(unittest.TestCase):
+
+    def match(self, pattern, names):
+        regex = cyruslib.metadatapattern(pattern)[2]
+        return [name for name in names if regex.match(name)]
+
+    def test_exact(self):
+        self.assertEqual(cyruslib.metadatapattern('/vendor/cmu/size'),
+                         ('/shared/vendor/cmu/size', '0', None))
+
+    def test_star(self):
+        entry, depth, regex = cyruslib.metadatapattern('*')
+        self.assertEqual((entry, depth), ('/shared', 'infinity'))
+        self.assertEqual(self.match('*', ['/comment', '/vendor/cmu/size']),
+                         ['/comment', '/vendor/cmu/size'])
+
+    def test_no_slash(self):
+        entry, depth, regex = cyruslib.metadatapattern('vendor*')
+        self.assertEqual((entry, depth), ('/shared', 'infinity'))
+        self.assertEqual(self.match('vendor*', ['/vendor/cmu/size', 'vendor']), ['vendor'])
+
+    def test_percent(self):
+        entry, depth, regex = cyruslib.metadatapattern('/vendor/%')
+        self.assertEqual((entry, depth), ('/shared/vendor', 'infinity'))
+        self.assertEqual(self.match('/vendor/%', ['/vendor/cmu', '/vendor/cmu/size', '/comment']),
+                         ['/vendor/cmu'])
+
+
+class InstrumentTest(Server):
+
+    def events(self, function):
+        events = []
+        self.imap.instrument(cyrusmetrics.Hook(end=events.append))
+        function()
+        return events
+
+    def test_getmetadata(self):
+        self.imap.setannotation('user/u000001', '/comment', 'hello')
+        events = self.events(lambda: list(self.imap.iter_annotations('user/u000001')))
+        self.assertEqual([(e.command, e.mailbox, e.result) for e in events],
+                         [('GETMETADATA', 'user/u000001', 'OK')])
+
+    def test_getacl(self):
+        events = self.events(lambda: self.imap.lam('user/u000001'))
+        self.assertEqual([(e.command, e.mailbox) for e in events], [('GETACL', 'user/u000001')])
+
+
+class StreamTest(Server):
+
+    def test_iter_mailboxes(self):
+        self.assertEqual([mailbox for mailbox, flags in self.imap.iter_mailboxes('*')],
+                         self.imap.lm('*'))
+        self.assertEqual(list(self.imap.iter_mailboxes('user/u000001')),
+                         [('user/u000001', ['HasNoChildren'])])
+
+    def test_interleaved(self):
+        # lam() while the LIST response is being read
+        acls = dict([(mailbox, self.imap.lam(mailbox)) for mailbox, flags
+                     in self.imap.iter_mailboxes('user/%')])
+        self.assertEqual(acls, {'user/u000000': {'cyrus': fakeimapd.ADMIN_RIGHTS},
+                                'user/u000001': {'cyrus': fakeimapd.ADMIN_RIGHTS}})
+        self.assertEqual(list(self.imap.m.streams), [])
+
+    def test_nested(self):
+        pairs = [(outer, inner) for outer, flags in self.imap.iter_mailboxes('user/%')
+                 for inner, flags in self.imap.iter_mailboxes(outer + '/%')]
+        self.assertEqual(len(pairs), len(self.imap.lm('user/%/%')))
+
+    def test_closed(self):
+        # a generator closed early leaves the connection usable
+        mailboxes = self.imap.iter_mailboxes('*')
+        next(mailboxes)
+        mailboxes.close()
+        self.assertEqual(list(self.imap.m.streams), [])
+        self.assertEqual(self.imap.lm('user/%'), ['user/u000000', 'user/u000001'])
+
+    def test_annotations(self):
+        self.imap.setannotation('user/u000000', '/comment', 'a')
+        self.imap.setannotation('user/u000001', '/comment', 'b')
+        seen = []
+        for mailbox, entry, value in self.imap.iter_annotations('user/%', '/comment'):
+            seen.append((mailbox, value, self.imap.lam(mailbox)['cyrus']))
+        self.assertEqual(seen, [('user/u000000', 'a', fakeimapd.ADMIN_RIGHTS),
+                                ('user/u000001', 'b', fakeimapd.ADMIN_RIGHTS)])
+
+
+class AnnotationTest(Server):
+    """Through METADATA, AnnotateMoreTest through ANNOTATEMORE"""
+
+    METADATA = True
+
+    def setUp(self):
+        self.server, self.state = fakeimapd.start(fakeimapd.State('/', metadata=self.METADATA))
+        self.state.populate(12)
+        self.imap = cyruslib.CYRUS("imap://127.0.0.1:%d" % self.server.server_address[1])
+        self.imap.login("cyrus", "password")
+
+    def test_set(self):
+        result = self.imap.set_annotations({'user/u000000': {'/comment': 'a', '/vendor/cmu/x': 'b'},
+                                            'user/u000001': {'/comment': 'c'}})
+        self.assertEqual(result, {('user/u000000', '/comment'): (True, None),
+                                  ('user/u000000', '/vendor/cmu/x'): (True, None),
+                                  ('user/u000001', '/comment'): (True, None)})
+        self.assertEqual(self.state.annotations['user/u000000'], {'/comment': 'a', '/vendor/cmu/x': 'b'})
+        self.assertEqual(sorted(self.imap.iter_annotations('user/%')),
+                         [('user/u000000', '/comment', 'a'), ('user/u000000', '/vendor/cmu/x', 'b'),
+                          ('user/u000001', '/comment', 'c')])
+        self.assertEqual(list(self.imap.iter_annotations('user/%', '/comment')),
+                         [('user/u000000', '/comment', 'a'), ('user/u000001', '/comment', 'c')])
+
+    def test_remove(self):
+        self.imap.setannotation('user/u000000', '/comment', 'a')
+        self.assertEqual(self.imap.set_annotations({'user/u000000': {'/comment': ''}}),
+                         {('user/u000000', '/comment'): (True, None)})
+        self.assertEqual(list(self.imap.iter_annotations('user/u000000')), [])
+
+    def test_failed(self):
+        result = self.imap.set_annotations({'user/nonexistent': {'/comment': 'a'},
+                                            'user/u000001': {'/comment': 'b'}})
+        ok, error = result[('user/nonexistent', '/comment')]
+        self.assertFalse(ok)
+        self.assertTrue(error.startswith('SETMETADATA: ' if self.METADATA else 'SETANNOTATION: '))
+        self.assertEqual(result[('user/u000001', '/comment')], (True, None))
+        self.assertEqual(self.state.annotations['user/u000001'], {'/comment': 'b'})
+
+
+class AnnotateMoreTest(AnnotationTest):
+
+    METADATA = False
+
+
+class CacheTest(Server):
+
+    PATTERNS = ('*', 'user/%', 'user/*', 'user/u000001/%', 'user/u000001', '%', 'user/u0*')
+
+    def setUp(self):
+        Server.setUp(self)
+        self.uncached = dict([(pattern, self.imap.lm(pattern)) for pattern in self.PATTERNS])
+        self.imap.setCache(True)
+        self.events = []
+        self.imap.instrument(cyrusmetrics.Hook(end=self.events.append))
+
+    def lists(self):
+        return len([e for e in self.events if e.command == 'LIST'])
+
+    def test_lm(self):
+        for pattern in self.PATTERNS:
+            self.assertEqual(self.imap.lm(pattern), self.uncached[pattern], pattern)
+        self.assertEqual(self.lists(), 1)
+
+    def test_changes(self):
+        self.imap.lm()
+        self.imap.cm('user/rei')
+        self.imap.provision([{'mailbox': 'user/rei/Trash'}])
+        self.imap.rename('user/u000000', 'user/joe')
+        self.imap.dm('user/u000001')
+        cached = self.imap.lm('user/*')
+        self.assertEqual(self.lists(), 1)
+        self.imap.setCache(False)
+        self.assertEqual(cached, self.imap.lm('user/*'))
+        self.assertEqual([name for name in cached if not name.startswith('user/joe/')],
+                         ['user/joe', 'user/rei', 'user/rei/Trash'])
+
+    def test_refresh(self):
+        self.imap.lm()
+        self.state.add('user/rei')
+        self.assertNotIn('user/rei', self.imap.lm('user/%'))
+        self.imap.refresh('user/rei')
+        self.assertIn('user/rei', self.imap.lm('user/%'))
+        self.imap.setCache(True, ttl=0)
+        self.state.add('user/joe')
+        self.assertIn('user/joe', self.imap.lm('user/%'))
+
+    def test_encoding(self):
+        self.imap.setEncoding('utf-8')
+        self.imap.provision([{'mailbox': 'user/u000001/Café'}])
+        self.assertIn('user/u000001/Café', self.imap.lm('user/u000001/%'))
+        self.assertIn('user/u000001/Archív', self.imap.lm('user/u000001/Arch*'))
+        self.imap.setEncoding('imap')
+        self.assertIn('user/u000001/Caf&AOk-', self.imap.lm('user/u000001/%'))
+
+
+class ProvisionTest(Server):
+
+    SPECS = [{'mailbox': 'user/rei', 'quota': 100, 'acl': {'johndoe': 'lrs'},
+              'annotations': {'/comment': 'hello'}},
+             {'mailbox': 'user/rei/Trash', 'partition': 'default'}]
+
+    def test_provision(self):
+        result = self.imap.provision(self.SPECS)
+        self.assertEqual(result, {'user/rei': (True, None), 'user/rei/Trash': (True, None)})
+        self.assertEqual(self.state.acls['user/rei']['johndoe'], 'lrs')
+        self.assertEqual(self.state.quotas['user/rei'], 100)
+        self.assertEqual(self.state.annotations['user/rei'], {'/comment': 'hello'})
+        self.assertIn('user/rei/Trash', self.state.mailboxes)
+
+    def test_existing(self):
+        # no setup for a mailbox which was not created
+        result = self.imap.provision([{'mailbox': 'user/u000001', 'quota': 100}])
+        self.assertFalse(result['user/u000001'][0])
+        self.assertTrue(result['user/u000001'][1].startswith('CREATE: '))
+        self.assertNotIn('user/u000001', self.state.quotas)
+
+    def test_bad_quota(self):
+        result = self.imap.provision([{'mailbox': 'user/rei', 'quota': 'lots'}])
+        self.assertFalse(result['user/rei'][0])
+        self.assertTrue(result['user/rei'][1].startswith('SETQUOTA: '))
+
+    def test_duplicate(self):
+        specs = self.SPECS + [{'mailbox': 'user/rei'}]
+        with self.assertRaises(cyruslib.CYRUSError) as cm:
+            self.imap.provision(specs)
+        self.assertEqual((cm.exception.code, cm.exception.command), (21, 'PROVISION'))
+        self.assertNotIn('user/rei', self.state.mailboxes)
+
+
+class DeleteTest(Server):
+
+    def setUp(self):
+        Server.setUp(self)
+        for name in ('Shared', 'Shared/a', 'Shared/a/x', 'Shared/a/y', 'Shared/b'):
+            self.state.add(name)
+
+    def test_waves(self):
+        # children first, deepest level first
+        events = []
+        self.imap.instrument(cyrusmetrics.Hook(end=events.append))
+        result = self.imap.dm('Shared')
+        self.assertEqual(result, dict([(name, (True, None)) for name in
+                                       ('Shared', 'Shared/a', 'Shared/a/x', 'Shared/a/y', 'Shared/b')]))
+        deleted = [e.mailbox for e in events if e.command == 'DELETE']
+        self.assertEqual(sorted(deleted[:2]), ['Shared/a/x', 'Shared/a/y'])
+        self.assertEqual(sorted(deleted[2:4]), ['Shared/a', 'Shared/b'])
+        self.assertEqual(deleted[4], 'Shared')
+        self.assertEqual([name for name in self.state.mailboxes if name.startswith('Shared')], [])
+
+    def test_not_recursive(self):
+        self.assertEqual(self.imap.dm('Shared/a/x', recursive=False), {'Shared/a/x': (True, None)})
+        self.assertIn('Shared/a', self.state.mailboxes)
+
+    def test_failed_child(self):
+        # gone behind the back of the cached listing: the child fails,
+        # the others and the mailbox itself are deleted without raising
+        self.imap.setCache(True)
+        self.imap.lm('*')
+        self.state.remove('Shared/a/x')
+        result = self.imap.dm('Shared')
+        self.assertFalse(result['Shared/a/x'][0])
+        self.assertTrue(result['Shared/a/x'][1].startswith('SETACL: '))
+        self.assertEqual(result['Shared'], (True, None))
+
+
+class LoginTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server, self.state = fakeimapd.start(fakeimapd.State('/'))
+        self.state.populate(12)
+        self.url = "imap://127.0.0.1:%d" % self.server.server_address[1]
+        cyruslib.Separators.clear()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def login(self, capabilities=None):
+        """A CYRUS logged in, and the commands sent for it"""
+        events = []
+        imap = cyruslib.CYRUS(self.url)
+        imap.instrument(cyrusmetrics.Hook(end=events.append))
+        if capabilities is not None:
+            imap.m.capabilities = capabilities
+        imap.login("cyrus", "password")
+        self.addCleanup(imap.logout)
+        return imap, [e.command for e in events]
+
+    def test_saslir(self):
+        # one round trip, the separator discovery sent along
+        imap, commands = self.login()
+        self.assertEqual(commands, ['AUTHENTICATE', 'LIST'])
+        self.assertEqual(self.state.commands, 2)
+        self.assertEqual((imap.SEP, cyruslib.Separators[imap.SERVER]), ('/', '/'))
+        self.assertIn('METADATA', imap.CAPABILITY)
+        self.assertEqual(imap.lm('user/%'), ['user/u000000', 'user/u000001'])
+
+    def test_no_saslir(self):
+        imap, commands = self.login(('IMAP4REV1', 'AUTH=PLAIN'))
+        self.assertEqual(commands, ['LOGIN', 'LIST'])
+        self.assertTrue(imap.AUTH)
+
+    def test_separators(self):
+        # later sessions with the server know its separator
+        self.login()
+        imap, commands = self.login()
+        self.assertEqual(commands, ['AUTHENTICATE'])
+        self.assertEqual(imap.SEP, '/')
+
+    def test_metadata(self):
+        # METADATA is known from the login response, not asked again
+        imap, commands = self.login()
+        events = []
+        imap.instrument(cyrusmetrics.Hook(end=events.append))
+        imap.set_annotations({'user/u000001': {'/comment': 'hello'}})
+        self.assertEqual([e.command for e in events], ['SETMETADATA'])
+
+    def test_failed(self):
+        self.state.password = 'secret'
+        imap = cyruslib.CYRUS(self.url)
+        with self.assertRaises(cyruslib.CYRUSError) as cm:
+            imap.login("cyrus", "password")
+        self.assertEqual((cm.exception.code, cm.exception.command), (10, 'LOGIN'))
+        self.assertFalse(imap.AUTH)
+        self.assertNotIn(imap.SERVER, cyruslib.Separators)
+        imap.login("cyrus", "secret")
+        self.assertTrue(imap.AUTH)
+        imap.logout()
+
+    def test_login_plain(self):
+        # over TLS only
+        imap = cyruslib.CYRUS(self.url)
+        with self.assertRaises(cyruslib.CYRUSError) as cm:
+            imap.login_plain("cyrus", "password", "u000000")
+        self.assertEqual(cm.exception.code, 15)
+        self.assertFalse(imap.AUTH)
+
+
+class ErrorTest(Server):
+
+    def test_dm_nonexistent(self):
+        # SETACL goes first, and fails
+        with self.assertRaises(cyruslib.CYRUSError) as cm:
+            self.imap.dm('user/nonexistent')
+        error = cm.exception
+        self.assertEqual((error.code, error.command), (99, 'SETACL'))
+        self.assertEqual((error.status, error.rcode), ('NO', 'NONEXISTENT'))
+
+    def test_dm_delete(self):
+        # the ACL read before spares SETACL, DELETE fails
+        self.imap.lam('user/u000001/Sent')
+        self.state.remove('user/u000001/Sent')
+        with self.assertRaises(cyruslib.CYRUSError) as cm:
+            self.imap.dm('user/u000001/Sent')
+        error = cm.exception
+        self.assertEqual((error.code, error.command), (25, 'DELETE'))
+        self.assertEqual((error.status, error.rcode), ('NO', 'NONEXISTENT'))
+
+    def test_dm_child(self):
+        result = self.imap.dm('user/u000001')
+        self.assertEqual(result, {'user/u000001': (True, None)})
+        self.assertEqual(self.imap.lm('user/u000001*'), [])
+
+
+class AclTest(Server):
+
+    def test_scan(self):
+        self.state.acls['user/u000001/Sent'] = {'cyrus': 'lrs', 'rei': 'lr'}
+        acls = dict(self.imap.acl_scan('user/*'))
+        self.assertEqual(sorted(acls), self.imap.lm('user/*'))
+        self.assertEqual(acls['user/u000001/Sent'], {'cyrus': 'lrs', 'rei': 'lr'})
+        self.assertEqual(acls['user/u000001'], {'cyrus': fakeimapd.ADMIN_RIGHTS})
+
+    def test_scan_failed(self):
+        # removed behind the back of the cached listing: GETACL fails
+        self.imap.setCache(True)
+        mailboxes = self.imap.lm('user/%')
+        self.state.remove('user/u000001')
+        self.assertEqual([mailbox for mailbox, acls in self.imap.acl_scan('user/%')],
+                         [mbx for mbx in mailboxes if mbx != 'user/u000001'])
+
+    def test_bulk(self):
+        mailboxes = self.imap.lm('user/u000001*')
+        self.imap.lam('user/u000001')
+        result = self.imap.bulk_setacl('user/u000001*', 'rei', 'lrs')
+        self.assertEqual(result, dict([(mbx, (True, None)) for mbx in mailboxes]))
+        self.assertEqual([self.state.acls[mbx]['rei'] for mbx in mailboxes], ['lrs'] * len(mailboxes))
+        # the rights read before are not reused
+        self.assertEqual(self.imap.lam('user/u000001')['rei'], 'lrs')
+        result = self.imap.bulk_deleteacl('user/u000001*', 'rei')
+        self.assertEqual(result, dict([(mbx, (True, None)) for mbx in mailboxes]))
+        self.assertNotIn('rei', self.imap.lam('user/u000001'))
+
+    def test_bulk_failed(self):
+        self.imap.setCache(True)
+        self.imap.lm('user/u000001*')
+        self.state.remove('user/u000001/Sent')
+        result = self.imap.bulk_setacl('user/u000001*', 'rei', 'lrs')
+        self.assertFalse(result['user/u000001/Sent'][0])
+        self.assertTrue(result['user/u000001/Sent'][1].startswith('SETACL: '))
+        self.assertEqual(result['user/u000001'], (True, None))
+
+
+class QuotaReportTest(Server):
+
+    def test_report(self):
+        self.imap.sq('user/u000001', 100)
+        report = dict([(mailbox, (used, limit)) for mailbox, used, limit
+                       in self.imap.quota_report('user/%')])
+        self.assertEqual(report['user/u000001'][1]['STORAGE'], 100)
+        self.assertEqual(report['user/u000000'], ({}, {}))
+
+    def test_failed(self):
+        # removed behind the back of the cached listing: GETQUOTAROOT fails
+        self.imap.setCache(True)
+        mailboxes = self.imap.lm('user/%')
+        self.state.remove('user/u000001')
+        report = [mailbox for mailbox, used, limit in self.imap.quota_report('user/%')]
+        self.assertEqual(report, [mbx for mbx in mailboxes if mbx != 'user/u000001'])
+
+
+class PoolServer(unittest.TestCase):
+    """A fake server with a few users, and a CyrusPool of 2 sessions"""
+
+    def setUp(self):
+        self.server, self.state = fakeimapd.start(fakeimapd.State('/'))
+        self.state.populate(12)
+        url = "imap://127.0.0.1:%d" % self.server.server_address[1]
+        self.pool = cyruslib.CyrusPool(url, "cyrus", "password", 2, timeout=0.2)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class PoolTest(PoolServer):
+
+    def test_reuse(self):
+        with self.pool.session() as imap:
+            first = imap
+            self.assertEqual(imap.lm('user/%'), ['user/u000000', 'user/u000001'])
+        with self.pool.session() as imap:
+            self.assertIs(imap, first)
+        self.assertEqual(self.pool.call('lam', 'user/u000001'), {'cyrus': fakeimapd.ADMIN_RIGHTS})
+        self.assertEqual((self.state.sessions, self.pool.count), (1, 1))
+        self.assertEqual(self.pool.SEP, '/')
+
+    def test_size(self):
+        first, second = self.pool.get(), self.pool.get()
+        with self.assertRaises(cyruslib.CYRUSError) as cm:
+            self.pool.get()
+        self.assertEqual((cm.exception.code, cm.exception.command), (80, 'POOL'))
+        self.pool.put(first)
+        self.assertIs(self.pool.get(), first)
+        self.pool.put(first)
+        self.pool.put(second)
+
+    def test_dropped(self):
+        # a dropped session is replaced when taken from the pool
+        with self.pool.session() as imap:
+            imap.m.shutdown()
+        self.assertEqual(self.pool.call('lm', 'user/%'), ['user/u000000', 'user/u000001'])
+        self.assertEqual((self.state.sessions, self.pool.count), (2, 1))
+
+    def test_error(self):
+        # a command error goes to the caller, the session stays
+        with self.assertRaises(cyruslib.CYRUSError):
+            self.pool.call('cm', 'user/u000001')
+        self.assertEqual((len(self.pool.idle), self.pool.count), (1, 1))
+
+
+class ReconstructTest(PoolServer):
+
+    def test_recursive(self):
+        calls = []
+        result = self.pool.reconstruct('user/u000001', progress=lambda *args: calls.append(args))
+        mailboxes = ['user/u000001'] + self.state.children('user/u000001')
+        self.assertEqual(result, dict([(name, (True, None)) for name in mailboxes]))
+        # the mailbox itself last, once its children are done
+        self.assertEqual(calls[-1], ('user/u000001', True, len(mailboxes), len(mailboxes)))
+        self.assertEqual(sorted(call[2] for call in calls), list(range(1, len(mailboxes) + 1)))
+        self.assertLessEqual(self.pool.count, 2)
+
+    def test_not_recursive(self):
+        self.assertEqual(self.pool.reconstruct('user/u000001', recursive=False),
+                         {'user/u000001': (True, None)})
+
+    def test_failed(self):
+        result = self.pool.reconstruct('user/nonexistent')
+        self.assertFalse(result['user/nonexistent'][0])
+        self.assertTrue(result['user/nonexistent'][1].startswith('RECONSTRUCT: '))
+
+
+class ClusterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = []
+        self.urls = []
+        for count in (3, 5):
+            server, state = fakeimapd.start(fakeimapd.State('/'))
+            state.populate(count)
+            self.servers.append(server)
+            self.urls.append("imap://127.0.0.1:%d" % server.server_address[1])
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def test_lm(self):
+        cluster = cyruslib.CyrusCluster(self.urls, "cyrus", "password")
+        try:
+            result = cluster.lm("user/%")
+        finally:
+            cluster.close()
+        self.assertEqual(dict([(host, len(mailboxes)) for host, mailboxes in result.items()]),
+                         {self.urls[0][7:]: 1, self.urls[1][7:]: 1})
+
+    def test_failed_backend(self):
+        self.servers[1].shutdown()
+        self.servers[1].server_close()
+        self.servers.pop()
+        cluster = cyruslib.CyrusCluster(self.urls, "cyrus", "password")
+        try:
+            result = cluster.lm("user/%")
+        finally:
+            cluster.close()
+        self.assertEqual(result[self.urls[0][7:]], ['user/u000000'])
+        self.assertIsInstance(result[self.urls[1][7:]], cyruslib.CYRUSError)
+
+    def test_duplicate(self):
+        urls = self.urls + [self.urls[0].replace('imap://', 'imap+starttls://')]
+        with self.assertRaises(cyruslib.CYRUSError) as cm:
+            cyruslib.CyrusCluster(urls, "cyrus", "password")
+        self.assertEqual((cm.exception.code, cm.exception.command), (1, 'INVALID_URL'))
+
+
+
+class StartTLSTest(unittest.TestCase):
+    """A fake server offering STARTTLS with the self-signed CERT"""
+
+    def setUp(self):
+        self.server, self.state = fakeimapd.start(fakeimapd.State('/'))
+        self.state.populate(12)
+        self.state.tls = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.state.tls.load_cert_chain(CERT)
+        self.url = "imap+starttls://127.0.0.1:%d" % self.server.server_address[1]
+        cyruslib.Sessions.clear()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_starttls(self):
+        imap = cyruslib.CYRUS(self.url)
+        self.assertIsInstance(imap.m.sock, ssl.SSLSocket)
+        # the capabilities sent before TLS are dropped
+        self.assertNotIn('STARTTLS', imap.m.capabilities)
+        imap.login("cyrus", "password")
+        try:
+            self.assertEqual(imap.lm("user/%"), ['user/u000000', 'user/u000001'])
+        finally:
+            imap.logout()
+
+    def connect(self, ssl_context):
+        imap = cyruslib.CYRUS(self.url, ssl_context)
+        imap.login("cyrus", "password")
+        reused = imap.m.sock.session_reused
+        imap.logout()
+        return reused
+
+    def test_resume(self):
+        # the session of the last connection is offered on the next one
+        context = ssl.create_default_context(cafile=CERT)
+        self.assertEqual([self.connect(context) for i in range(3)], [False, True, True])
+        cyruslib.Sessions.clear()
+        self.assertFalse(self.connect(context))
+        # a session is only resumed with the context which negotiated it
+        self.assertFalse(self.connect(ssl.create_default_context(cafile=CERT)))
+
+    def test_verified(self):
+        with self.assertRaises(cyruslib.CYRUSError) as cm:
+            cyruslib.CYRUS(self.url, ssl.create_default_context())
+        self.assertEqual(cm.exception.command, 'CONNECT')
+
+    def test_pool(self):
+        context = ssl.create_default_context(cafile=CERT)
+        pool = cyruslib.CyrusPool(self.url, "cyrus", "password", 2, ssl_context=context)
+        try:
+            with pool.session() as first, pool.session() as second:
+                self.assertIs(first.m.ssl_context, context)
+                self.assertTrue(second.m.sock.session_reused)
+        finally:
+            pool.close()
+
+    def test_login_plain(self):
+        imap = cyruslib.CYRUS(self.url)
+        imap.login_plain("cyrus", "password", "u000000")
+        try:
+            self.assertEqual((imap.AUTH, imap.AUSER), (True, 'u000000'))
+            self.assertEqual(imap.lm('user/%'), ['user/u000000', 'user/u000001'])
+        finally:
+            imap.logout()
+
+    def test_not_offered(self):
+        self.state.tls = None
+        with self.assertRaises(cyruslib.CYRUSError) as cm:
+            cyruslib.CYRUS(self.url)
+        self.assertEqual((cm.exception.code, cm.exception.command), (0, 'CONNECT'))
+
+
+if __name__ == '__main__':
+    unittest.main()
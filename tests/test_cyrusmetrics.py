@@ -0,0 +1,123 @@
+#
+# cyrusmetrics tests, from events and against the fake servers of bench/
+#
+#   python3 -m pytest tests
+#
+
+import os, sys, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+import cyruslib
+import cyrusmetrics
+import sievelib
+import fakeimapd
+import fakesieved
+
+
+def event(command, latency, result='OK', sent=10, received=20):
+    return cyrusmetrics.Event('imap', command, 'user/rei', sent, received, latency, result)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = cyrusmetrics.Metrics(buckets=(0.1, 0.01, 1.0))
+        for e in (event('GETACL', 0.005), event('GETACL', 0.05, 'NO'),
+                  event('GETACL', 5.0), event('LIST', 0.1, received=1000)):
+            self.metrics.start(e._replace(sent=None, received=None, latency=None, result=None))
+            self.metrics.end(e)
+
+    def test_as_dict(self):
+        stats = self.metrics.as_dict()['imap']
+        self.assertEqual(stats['GETACL']['count'], 3)
+        self.assertEqual(stats['GETACL']['results'], {'OK': 2, 'NO': 1})
+        self.assertEqual((stats['GETACL']['sent'], stats['GETACL']['received']), (30, 60))
+        self.assertAlmostEqual(stats['GETACL']['seconds'], 5.055)
+        self.assertEqual(stats['GETACL']['max'], 5.0)
+        # cumulative, the bounds sorted, and one more for everything
+        self.assertEqual(stats['GETACL']['buckets'], {0.01: 1, 0.1: 2, 1.0: 2, float('inf'): 3})
+        self.assertEqual(stats['LIST']['buckets'], {0.01: 0, 0.1: 1, 1.0: 1, float('inf'): 1})
+
+    def test_prometheus(self):
+        lines = self.metrics.prometheus().splitlines()
+        self.assertIn('# TYPE cyrus_commands_total counter', lines)
+        self.assertIn('cyrus_commands_total{protocol="imap",command="GETACL",result="NO"} 1', lines)
+        self.assertIn('cyrus_received_bytes_total{protocol="imap",command="LIST"} 1000', lines)
+        self.assertIn('cyrus_command_seconds_bucket{protocol="imap",command="GETACL",le="0.1"} 2', lines)
+        self.assertIn('cyrus_command_seconds_bucket{protocol="imap",command="GETACL",le="+Inf"} 3', lines)
+        self.assertIn('cyrus_command_seconds_count{protocol="imap",command="LIST"} 1', lines)
+
+    def test_reset(self):
+        self.metrics.reset()
+        self.assertEqual(self.metrics.as_dict(), {})
+
+
+class ImapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server, self.state = fakeimapd.start(fakeimapd.State('/'))
+        self.state.populate(12)
+        self.url = "imap://127.0.0.1:%d" % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_commands(self):
+        metrics = cyrusmetrics.Metrics()
+        imap = cyruslib.CYRUS(self.url)
+        imap.instrument(metrics)
+        imap.login("cyrus", "password")
+        try:
+            imap.lam("user/u000001")
+            self.assertRaises(cyruslib.CYRUSError, imap.lam, "user/nonexistent")
+        finally:
+            imap.logout()
+        stats = metrics.as_dict()['imap']
+        self.assertEqual(stats['GETACL']['results'], {'OK': 1, 'NO': 1})
+        self.assertGreater(stats['GETACL']['sent'], len('GETACL user/u000001'))
+        self.assertGreater(stats['GETACL']['received'], len('* ACL user/u000001 cyrus'))
+
+    def test_pool(self):
+        # the connections a pool opens share its instruments
+        metrics = cyrusmetrics.Metrics()
+        pool = cyruslib.CyrusPool(self.url, "cyrus", "password", 2)
+        pool.instrument(metrics)
+        try:
+            with pool.session() as first, pool.session() as second:
+                first.lam("user/u000000")
+                second.lam("user/u000001")
+        finally:
+            pool.close()
+        self.assertEqual(metrics.as_dict()['imap']['GETACL']['count'], 2)
+
+
+class SieveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server, self.state = fakesieved.start(fakesieved.State())
+        self.state.populate(2)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_pipeline(self):
+        events = []
+        sieve = sievelib.MANAGESIEVE('127.0.0.1', self.server.server_address[1])
+        sieve.instrument(cyrusmetrics.Hook(end=events.append))
+        sieve.login('PLAIN', 'u000000', 'password', 'cyrus')
+        try:
+            sieve.syncscript('new', 'keep;\r\n')
+        finally:
+            sieve.logout()
+        self.assertEqual([(e.protocol, e.command, e.mailbox, e.result) for e in events[1:-1]],
+                         [('sieve', 'LISTSCRIPTS', None, 'OK'), ('sieve', 'GETSCRIPT', 'new', 'NO'),
+                          ('sieve', 'HAVESPACE', 'new', 'OK'), ('sieve', 'PUTSCRIPT', 'new', 'OK'),
+                          ('sieve', 'SETACTIVE', 'new', 'OK')])
+        self.assertGreater(events[4].sent, len('keep;\r\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#
+# imapparse tests, no server needed
+#
+#   python3 -m pytest tests
+#
+
+import os, sys, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import imapparse
+
+
+class TokenizeTest(unittest.TestCase):
+
+    def test_atoms(self):
+        self.assertEqual(imapparse.tokenize(b'FOO 12 \\Noselect'), [b'FOO', b'12', b'\\Noselect'])
+
+    def test_nil(self):
+        self.assertEqual(imapparse.tokenize(b'NIL nil "NIL"'), [None, None, b'NIL'])
+
+    def test_quoted(self):
+        self.assertEqual(imapparse.tokenize(b'"user/rei" ""'), [b'user/rei', b''])
+
+    def test_escapes(self):
+        self.assertEqual(imapparse.tokenize(br'"a \"b\" c\\d"'), [b'a "b" c\\d'])
+
+    def test_nested(self):
+        self.assertEqual(imapparse.tokenize(b'a (b (c NIL) ()) d'),
+                         [b'a', [b'b', [b'c', None], []], b'd'])
+
+    def test_literal(self):
+        self.assertEqual(imapparse.tokenize(b'x {5} y {3+}', [b'he(l)', b'"q"']),
+                         [b'x', b'he(l)', b'y', b'"q"'])
+
+    def test_memoryview(self):
+        self.assertEqual(imapparse.tokenize(memoryview(b'("a" b) \r\n')), [[b'a', b'b']])
+
+    def test_malformed(self):
+        for data in (b'(a b', b'a b)', b'"unterminated', b'{abc}', b'{3}'):
+            self.assertRaises(ValueError, imapparse.tokenize, data)
+
+
+class ResponsesTest(unittest.TestCase):
+
+    def test_join(self):
+        data = [b'"a" "b"', (b'"c" {3}', b'x y'), b' z', None, (b'"d" {1}', b'1'), (b' {1}', b'2'), b'']
+        self.assertEqual(list(imapparse.responses(data)),
+                         [b'"a" "b"', (b'"c" {3} z', b'x y'), (b'"d" {1} {1}', b'1', b'2')])
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_list(self):
+        self.assertEqual(imapparse.parse_list(b'(\\HasNoChildren) "/" "user/rei"'),
+                         imapparse.List(['HasNoChildren'], '/', 'user/rei'))
+        self.assertEqual(imapparse.parse_list(b'(\\Noselect \\HasChildren) "." user.rei'),
+                         imapparse.List(['Noselect', 'HasChildren'], '.', 'user.rei'))
+        self.assertEqual(imapparse.parse_list(b'() NIL "a\\"b"'),
+                         imapparse.List([], None, 'a"b'))
+
+    def test_list_literal(self):
+        self.assertEqual(imapparse.parse_list((b'() "/" {8}', b'user/r b')),
+                         imapparse.List([], '/', 'user/r b'))
+
+    def test_acl(self):
+        self.assertEqual(imapparse.parse_acl(b'user/rei rei lrswipkxtecda "anyone" lrs'),
+                         imapparse.Acl('user/rei', {'rei': 'lrswipkxtecda', 'anyone': 'lrs'}))
+        self.assertEqual(imapparse.parse_acl(b'"a\\\\b" rei lrs'),
+                         imapparse.Acl('a\\b', {'rei': 'lrs'}))
+
+    def test_quota(self):
+        self.assertEqual(imapparse.parse_quota(b'user/rei (STORAGE 10 100 message 1 5)'),
+                         imapparse.Quota('user/rei', {'STORAGE': (10, 100), 'MESSAGE': (1, 5)}))
+        self.assertEqual(imapparse.parse_quota(b'"" ()'), imapparse.Quota('', {}))
+        self.assertRaises(ValueError, imapparse.parse_quota, b'root (STORAGE x 100)')
+
+    def test_quotaroot(self):
+        self.assertEqual(imapparse.parse_quotaroot(b'user/rei/Sent user/rei'),
+                         imapparse.QuotaRoot('user/rei/Sent', ['user/rei']))
+        self.assertEqual(imapparse.parse_quotaroot(b'user/rei'), imapparse.QuotaRoot('user/rei', []))
+
+    def test_annotation(self):
+        self.assertEqual(imapparse.parse_annotation(b'"user/rei" "/comment" ("value.shared" "hi")'),
+                         imapparse.Annotation('user/rei', '/comment', {'value.shared': 'hi'}))
+        self.assertEqual(imapparse.parse_annotation(b'"user/rei" "/comment" ("value.shared" NIL)'),
+                         imapparse.Annotation('user/rei', '/comment', {'value.shared': None}))
+        item, = imapparse.responses([(b'"user/rei" "/comment" ("value.shared" {6}', b'a\r\nb()'), b')'])
+        self.assertEqual(imapparse.parse_annotation(item),
+                         imapparse.Annotation('user/rei', '/comment', {'value.shared': 'a\r\nb()'}))
+
+    def test_metadata(self):
+        self.assertEqual(imapparse.parse_metadata(b'"user/rei" (/shared/comment "caf\xc3\xa9" /shared/x NIL)'),
+                         imapparse.Metadata('user/rei', {'/shared/comment': 'café', '/shared/x': None}))
+
+    def test_id(self):
+        self.assertEqual(imapparse.parse_id(b'("name" "Cyrus IMAP" "version" "3.8")'),
+                         {'name': 'Cyrus IMAP', 'version': '3.8'})
+        self.assertEqual(imapparse.parse_id(b'NIL'), {})
+
+    def test_malformed(self):
+        self.assertRaises(ValueError, imapparse.parse_metadata, b'"user/rei" (/shared/x "a"')
+        self.assertRaises(ValueError, imapparse.parse_list, (b'() "/" {8}',))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#
+# imaputf7 tests, no server needed
+#
+#   python3 -m pytest tests
+#
+
+import os, random, sys, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+import imaputf7
+import bench_codec
+
+# (unicode, modified UTF-7)
+NAMES = [
+    ('INBOX', 'INBOX'),
+    ('user/rei/Café', 'user/rei/Caf&AOk-'),
+    ('~peter/mail/台北/日本語', '~peter/mail/&U,BTFw-/&ZeVnLIqe-'),
+    ('Tom & Jerry', 'Tom &- Jerry'),
+    ('&', '&-'),
+    ('&-', '&--'),
+    ('x-é-y', 'x-&AOk--y'),
+    ('a+b,c', 'a+b,c'),
+    ('tab\there', 'tab&AAk-here'),
+    ('😀', '&2D3eAA-'),
+    ('a😀é&b', 'a&2D3eAADp-&-b'),
+    ('𝄞/𝄞', '&2DTdHg-/&2DTdHg-'),
+]
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_names(self):
+        for text, imap in NAMES:
+            self.assertEqual(imaputf7.encode(text), imap)
+            self.assertEqual(imaputf7.decode(imap), text)
+
+    def test_unchanged(self):
+        for text in ('', 'user/rei', 'user.rei.Sent', 'a-b', 'a,b+c'):
+            self.assertIs(imaputf7.encode(text), text)
+            self.assertIs(imaputf7.decode(text), text)
+
+    def test_surrogates(self):
+        # a non-BMP character is one run of its UTF-16 surrogate pair
+        self.assertEqual(imaputf7.encode('\U0010FFFF'), '&2,,f,w-')
+        self.assertEqual(imaputf7.decode('&2,,f,w-'), '\U0010FFFF')
+        self.assertEqual(len(imaputf7.decode('&2D3eANg93gE-')), 2)
+
+    def test_roundtrip(self):
+        rng = random.Random(3501)
+        alphabet = 'az AZ09&-+,./~\t\x7fé€ž台北😀𝄞'
+        for i in range(2000):
+            text = ''.join(rng.choice(alphabet) for j in range(rng.randrange(12)))
+            imap = imaputf7.encode(text)
+            self.assertTrue(all(' ' <= c <= '~' for c in imap), imap)
+            self.assertEqual(imaputf7.decode(imap), text)
+
+    def test_previous(self):
+        # the re.sub/utf-7 chain cyruslib used before, where it was right:
+        # no '&', '+' or '~' and no ',' in the base64
+        names = [text for folder in bench_codec.FOLDERS
+                 for text in ('user/rei/' + folder, folder + ' 2020', folder)]
+        names += ['Ünïcödé Straße', '日本語', 'x-é-y', 'a b/é c', '😀']
+        for text in names:
+            self.assertEqual(imaputf7.encode(text), bench_codec.old_encode(text))
+            self.assertEqual(imaputf7.decode(bench_codec.old_encode(text)), text)
+            self.assertEqual(bench_codec.old_decode(imaputf7.encode(text)), text)
+
+    def test_invalid(self):
+        for imap in ('&!!!-',     # not base64
+                     '&U/BTFw-',  # '/' instead of ','
+                     '&A-',       # not a whole base64 byte
+                     '&AO-',      # half a UTF-16 character
+                     '&2D0-',     # high surrogate alone
+                     '&3gA-'):    # low surrogate alone
+            self.assertRaises(ValueError, imaputf7.decode, imap)
+
+    def test_unterminated(self):
+        for imap in ('&', 'caf&AOk', 'a&-b&AOk', '&ZeVnLIqe'):
+            self.assertRaises(ValueError, imaputf7.decode, imap)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,296 @@
+#
+# sievelib tests, against the fake MANAGESIEVE server of bench/ and
+# responses replayed from memory
+#
+#   python3 -m pytest tests
+#
+
+import os, sys, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+import sievelib
+import fakesieved
+import bench_sieve_parse
+
+OLD = b'keep;\r\n'
+NEW = b'discard;\r\n'
+
+
+class ResponseTest(unittest.TestCase):
+    """Responses replayed from memory, and through the parser used before"""
+
+    def response(self, data):
+        res = []
+        for cls in (bench_sieve_parse.Replay, bench_sieve_parse.OldReplay):
+            sieve = cls(data)
+            sieve.rewind()
+            res.append((sieve._get_response(), sieve.response_code, sieve.response_text))
+        self.assertEqual(res[0], res[1])
+        return res[0]
+
+    def test_listscripts(self):
+        self.assertEqual(self.response(b'"s1" ACTIVE\r\n"s2"\r\nOK "done"\r\n'),
+                         (('OK', [['s1', 'ACTIVE'], ['s2']]), None, 'done'))
+
+    def test_escapes(self):
+        self.assertEqual(self.response(b'"a \\"b\\" c\\\\d"\r\nOK\r\n'),
+                         (('OK', [['a "b" c\\d']]), None, None))
+
+    def test_literal(self):
+        self.assertEqual(self.response(b'{7}\r\n"x"\r\n\xc3\xa9\r\nOK\r\n'),
+                         (('OK', [['"x"\r\n\xe9']]), None, None))
+        self.assertEqual(self.response(b'"SIEVE" {5+}\r\nab cd\r\n"SASL" ""\r\nOK\r\n'),
+                         (('OK', [['SIEVE', 'ab cd'], ['SASL', '']]), None, None))
+
+    def test_codes(self):
+        self.assertEqual(self.response(b'NO (QUOTA/MAXSIZE) "too big"\r\n'),
+                         (('NO', []), 'QUOTA/MAXSIZE', 'too big'))
+        self.assertEqual(self.response(b'BYE (REFERRAL "sieve://x") "go"\r\n'),
+                         (('BYE', []), 'REFERRAL "sieve://x"', 'go'))
+        self.assertEqual(self.response(b'OK (WARNINGS) {4}\r\nwarn\r\n'),
+                         (('OK', []), 'WARNINGS', 'warn'))
+
+    def test_malformed(self):
+        sieve = bench_sieve_parse.Replay(b'"unterminated\r\nOK\r\n')
+        sieve.rewind()
+        self.assertRaises(sievelib.MANAGESIEVE.error, sieve._get_response)
+
+
+class Server(unittest.TestCase):
+    """A fake server whose users have an active script0 of OLD"""
+
+    def setUp(self):
+        self.server, self.state = fakesieved.start(fakesieved.State(maxsize=64))
+        self.state.populate(2)
+        for user in self.state.users():
+            self.state.scripts[user]['script0'] = OLD
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SessionServer(Server):
+    """The fake server, and a MANAGESIEVE logged in as u000000"""
+
+    def setUp(self):
+        Server.setUp(self)
+        self.sieve = sievelib.MANAGESIEVE('127.0.0.1', self.port)
+        self.sieve.login('PLAIN', 'u000000', 'password', 'cyrus')
+
+    def tearDown(self):
+        self.sieve.logout()
+        Server.tearDown(self)
+
+
+class InstallTest(SessionServer):
+
+    def test_install(self):
+        self.assertEqual(self.sieve.installscript('new', NEW), ('OK', []))
+        self.assertEqual(self.state.active['u000000'], 'new')
+
+    def test_toolarge(self):
+        typ, data = self.sieve.installscript('script1', NEW * 10)
+        self.assertEqual(typ, 'NO')
+        self.assertNotIn('script1', self.state.scripts['u000000'])
+        self.assertEqual(self.state.active['u000000'], 'script0')
+
+    def test_toolarge_existing(self):
+        # the old script of that name stays as it was, not activated
+        self.state.active['u000000'] = 'other'
+        typ, data = self.sieve.installscript('script0', NEW * 10)
+        self.assertEqual(typ, 'NO')
+        self.assertEqual(self.state.scripts['u000000']['script0'], OLD)
+        self.assertEqual(self.state.active['u000000'], 'other')
+
+
+class TransferTest(SessionServer):
+
+    def test_large(self):
+        # literals of several receive buffers, with UTF-8 across their ends
+        self.state.maxsize = None
+        data = fakesieved.script(4 * sievelib.BUFSIZE + 1)
+        self.assertEqual(self.sieve.putscript('large', data), 'OK')
+        self.assertEqual(self.state.scripts['u000000']['large'], data)
+        self.assertEqual(self.sieve.getscript('large'), ('OK', data.decode('utf-8')))
+        self.assertEqual(self.sieve.listscripts(), ('OK', [('large', False), ('script0', True)]))
+
+    def test_str(self):
+        # the size of the literal is in octets, not characters
+        self.assertEqual(self.sieve.putscript('café', '# été\r\n'), 'OK')
+        self.assertEqual(self.state.scripts['u000000']['café'], '# été\r\n'.encode('utf-8'))
+        self.assertEqual(self.sieve.getscript('café'), ('OK', '# été\r\n'))
+
+
+class PipelineTest(SessionServer):
+
+    def setUp(self):
+        SessionServer.setUp(self)
+        self.state.scripts['u000000']['other'] = NEW
+
+    def test_pipeline(self):
+        # a failed command does not stop the following ones
+        commands = [('GETSCRIPT', '"none"'), ('GETSCRIPT', '"other"')] + \
+                   [('HAVESPACE', '"x"', '1')] * sievelib.PIPELINE
+        results = self.sieve.pipeline(commands)
+        self.assertEqual(results[:2], [('NO', ['Script does not exist']), ('OK', [[NEW.decode('utf-8')]])])
+        self.assertEqual(results[2:], [('OK', [])] * sievelib.PIPELINE)
+        self.assertEqual(self.sieve.listscripts()[0], 'OK')
+
+    def test_getscripts(self):
+        self.assertEqual(self.sieve.getscripts(),
+                         ('OK', {'script0': OLD.decode('utf-8'), 'other': NEW.decode('utf-8')}))
+
+    def test_deletescripts(self):
+        self.assertEqual(self.sieve.deletescripts(['script0', 'other', 'none']),
+                         {'script0': 'NO', 'other': 'OK', 'none': 'NO'})
+        self.assertEqual(sorted(self.state.scripts['u000000']), ['script0'])
+
+    def test_syncscript(self):
+        commands = self.state.commands
+        self.assertEqual(self.sieve.syncscript('script0', OLD), ('OK', []))
+        self.assertEqual(self.state.commands - commands, 2)
+        self.assertEqual(self.sieve.syncscript('script0', b'stop;\r\n'), ('OK', ['PUTSCRIPT']))
+        self.assertEqual(self.sieve.syncscript('other', NEW), ('OK', ['SETACTIVE']))
+        self.assertEqual(self.sieve.syncscript('new', NEW, activate=False), ('OK', ['PUTSCRIPT']))
+        self.assertEqual(self.state.scripts['u000000']['script0'], b'stop;\r\n')
+        self.assertEqual(self.state.scripts['u000000']['new'], NEW)
+        self.assertEqual(self.state.active['u000000'], 'other')
+
+    def test_syncscript_toolarge(self):
+        typ, data = self.sieve.syncscript('script0', NEW * 10)
+        self.assertEqual(typ, 'NO')
+        self.assertTrue(data[0].startswith('HAVESPACE: '))
+        self.assertEqual(self.state.scripts['u000000']['script0'], OLD)
+
+
+class PoolServer(Server):
+    """A SievePool of two connections to the fake server"""
+
+    def setUp(self):
+        Server.setUp(self)
+        self.pool = sievelib.SievePool('127.0.0.1', self.port, 'cyrus', 'password', 2, timeout=0.2)
+
+    def tearDown(self):
+        self.pool.close()
+        Server.tearDown(self)
+
+
+class PoolTest(PoolServer):
+
+    def test_reuse(self):
+        # UNAUTHENTICATE keeps the connection for the next user
+        for user in ('u000000', 'u000001', 'u000000'):
+            with self.pool.session(user) as sieve:
+                self.assertEqual(sieve.getscript('script0'), ('OK', OLD.decode('utf-8')))
+        self.assertEqual((self.state.sessions, self.state.auths), (1, 3))
+        self.assertEqual((self.pool.count, len(self.pool.idle)), (1, 1))
+
+    def test_no_unauthenticate(self):
+        self.state.unauthenticate = False
+        for user in ('u000000', 'u000001'):
+            with self.pool.session(user) as sieve:
+                sieve.listscripts()
+        self.assertEqual(self.state.sessions, 2)
+        self.assertEqual(self.pool.count, 0)
+
+    def test_size(self):
+        with self.pool.session('u000000'), self.pool.session('u000001'):
+            self.assertRaises(sievelib.MANAGESIEVE.error, self.pool.get, 'u000000')
+        self.assertEqual(self.pool.count, 2)
+
+    def test_exception(self):
+        # an error of the caller leaves the connection usable
+        with self.assertRaises(KeyError):
+            with self.pool.session('u000000') as sieve:
+                raise KeyError('script1')
+        self.assertEqual(self.pool.idle, [sieve])
+        with self.pool.session('u000001') as sieve:
+            sieve.listscripts()
+        self.assertEqual(self.state.sessions, 1)
+
+    def test_abort(self):
+        # a connection which broke is not handed out again
+        with self.assertRaises(sievelib.MANAGESIEVE.abort):
+            with self.pool.session('u000000') as sieve:
+                raise sieve.abort('socket error: EOF')
+        self.assertEqual((self.pool.count, self.pool.idle), (0, []))
+        with self.pool.session('u000001') as sieve:
+            sieve.listscripts()
+        self.assertEqual(self.state.sessions, 2)
+
+    def test_login_failed(self):
+        self.state.password = 'secret'
+        self.assertRaises(sievelib.MANAGESIEVE.error, self.pool.get, 'u000000')
+        self.assertEqual((self.pool.count, len(self.pool.idle)), (1, 1))
+        self.state.password = 'password'
+        with self.pool.session('u000000') as sieve:
+            sieve.listscripts()
+        self.assertEqual(self.state.sessions, 1)
+
+
+class DeployTest(PoolServer):
+
+    def test_deploy(self):
+        result = self.pool.deploy({'u000000': ('new', NEW), 'u000001': ('new', NEW)})
+        self.assertEqual(result, {'u000000': (True, None), 'u000001': (True, None)})
+        self.assertEqual(self.state.active, {'u000000': 'new', 'u000001': 'new'})
+
+    def test_deploy_toolarge(self):
+        self.state.active['u000000'] = 'other'
+        result = self.pool.deploy({'u000000': ('script0', NEW * 10)})
+        ok, error = result['u000000']
+        self.assertFalse(ok)
+        self.assertTrue(error.startswith('PUTSCRIPT: '))
+        self.assertEqual(self.state.active['u000000'], 'other')
+
+
+
+class SyncTest(PoolServer):
+
+    def test_sync(self):
+        desired = {'u000000': ('script0', OLD), 'u000001': ('new', NEW)}
+        self.assertEqual(self.pool.sync_scripts(desired),
+                         {'u000000': (True, []), 'u000001': (True, ['PUTSCRIPT', 'SETACTIVE'])})
+        self.assertEqual(self.state.scripts['u000001']['new'], NEW)
+        self.assertEqual(self.state.active, {'u000000': 'script0', 'u000001': 'new'})
+
+    def test_digests(self):
+        # users synced before with the same script are not connected
+        digests = {}
+        desired = {'u000000': ('script0', OLD), 'u000001': ('new', NEW)}
+        self.pool.sync_scripts(desired, digests=digests)
+        self.assertEqual(sorted(digests), ['u000000', 'u000001'])
+        commands = self.state.commands
+        self.assertEqual(self.pool.sync_scripts(desired, digests=digests),
+                         {'u000000': (True, []), 'u000001': (True, [])})
+        self.assertEqual(self.state.commands, commands)
+        desired['u000001'] = ('new', OLD)
+        self.assertEqual(self.pool.sync_scripts(desired, digests=digests),
+                         {'u000000': (True, []), 'u000001': (True, ['PUTSCRIPT'])})
+        self.assertEqual(self.state.scripts['u000001']['new'], OLD)
+
+    def test_digests_activate(self):
+        # a script synced without activating it is not taken as active
+        digests = {}
+        desired = {'u000000': ('new', NEW)}
+        self.pool.sync_scripts(desired, activate=False, digests=digests)
+        self.assertEqual(self.pool.sync_scripts(desired, digests=digests),
+                         {'u000000': (True, ['SETACTIVE'])})
+        self.assertEqual(self.state.active['u000000'], 'new')
+
+    def test_failed(self):
+        digests = {}
+        self.pool.sync_scripts({'u000000': ('script0', OLD)}, digests=digests)
+        result = self.pool.sync_scripts({'u000000': ('script0', NEW * 10)}, digests=digests)
+        ok, error = result['u000000']
+        self.assertFalse(ok)
+        self.assertTrue(error.startswith('HAVESPACE: '))
+        self.assertEqual(digests, {})
+        self.assertEqual(self.state.scripts['u000000']['script0'], OLD)
+
+
+if __name__ == '__main__':
+    unittest.main()